@@ -36,30 +36,185 @@ DOCUMENTATION = '''
             required: True
             env:
                 - name: SPOTINST_API_TOKEN
+
+        spotinst_api_url:
+            description: Spotinst API base URL
+            default: https://api.spotinst.io
+            env:
+                - name: SPOTINST_API_URL
+
+        spotinst_api_rate_limit:
+            description:
+                - Maximum number of Spotinst API requests per second, 0 for no limit.
+            type: float
+            default: 0
+            env:
+                - name: SPOTINST_API_RATE_LIMIT
+
+        spotinst_api_max_retries:
+            description:
+                - Number of times a throttled (HTTP 429) or failed Spotinst API request is retried, with exponential
+                  backoff or as told by the C(Retry-After) header.
+            type: int
+            default: 3
+            env:
+                - name: SPOTINST_API_MAX_RETRIES
+
+        max_concurrency:
+            description:
+                - Maximum number of ESGs for which stateful instances are fetched at once.
+                - Also bounds the number of concurrent batched EC2 DescribeInstances calls.
+                - Set to 1 to query ESGs one after another.
+            type: int
+            default: 10
+            env:
+                - name: SPOTINST_MAX_CONCURRENCY
+
+        esg_cache_ttl:
+            description:
+                - Number of seconds a cached ESG stays valid, set to 0 to only rely on C(cache_timeout).
+                - The inventory is cached per ESG. When the cache is refreshed, groups and the stateful instances of
+                  stateful ESGs are listed again, as a recycle does not change the C(updatedAt) of its ESG. ESGs
+                  without stateful instances are only queried again when their C(updatedAt) changed or their entry
+                  expired, their instances are still looked up again by tag as spot replacements and scale events do
+                  not change it either.
+                - EC2 data is never fetched again for stateful instances already known from the cache.
+            type: int
+            default: 3600
+
+        cache_compression:
+            description:
+                - Compress the cached inventory with gzip, the cache plugin then stores it as a base64 string.
+                - Shrinks the cache several times for accounts with many stateful instances.
+            choices: ['none', 'gzip']
+            default: none
+
+        include_groups:
+            description:
+                - Only keep the ESGs matching one of these filters, every ESG is kept when empty.
+                - A filter is either an ESG id or name glob (Example C(va-prism-kafka--*)), C(regex:<expression>)
+                  searched in the ESG name or C(tag:<key>) / C(tag:<key>=<value>) matching the ESG instances tags.
+                - Filters apply before any stateful or EC2 call. When they are all ESG ids (Example C(sig-1234)), those
+                  ESGs are fetched directly instead of listing every ESG of the account.
+            type: list
+            default: []
+
+        exclude_groups:
+            description:
+                - Drop the ESGs matching one of these filters, same syntax as C(include_groups).
+            type: list
+            default: []
+
+        regions:
+            description:
+                - Only keep the ESGs running in these AWS regions, every region when empty.
+                - EC2 instances are always described in the region of their ESG, no region is ever scanned.
+            type: list
+            default: []
+
+        non_stateful_groups:
+            description:
+                - Also expose the instances of ESGs without stateful instances.
+                - Their instances are found with a single DescribeInstances call per region (and per 200 ESGs) filtered
+                  on the C(spotinst:aws:ec2:group:id) tag Spotinst sets on every instance it launches.
+                - Those hosts have a C(spotinst_stateful) hostvar set to false and their EC2 instance id as C(spotinst_id).
+            type: bool
+            default: True
+
+        metrics_sink:
+            description:
+                - Where to export the inventory metrics (API calls per endpoint, latencies, bytes received, EC2 calls
+                  and query time), C(statsd://host:port) for a StatsD daemon, a path ending with C(.prom) for a
+                  Prometheus text file or any other path for a JSON file.
+                - Metrics are always displayed with C(-vvv).
+            env:
+                - name: SPOTINST_METRICS_SINK
+
+        watch_address:
+            description:
+                - Address of a C(spotinst-esg-watch) daemon watching the account, C(unix://<path>) or
+                  C(http://<host>:<port>).
+                - The inventory is then read from its snapshot, without any Spotinst API or EC2 call. Spotinst API is
+                  queried as usual when the daemon can not be reached or its snapshot is older than C(watch_max_age).
+                - C(include_groups), C(exclude_groups), C(regions) and C(non_stateful_groups) apply to the snapshot as
+                  they do to Spotinst API, the daemon may watch more ESGs than the inventory exposes.
+            env:
+                - name: SPOTINST_WATCH_ADDRESS
+
+        watch_max_age:
+            description:
+                - Number of seconds after which the C(watch_address) snapshot is ignored.
+            type: int
+            default: 15
 '''
 
 # Borrowed from aws_ec2.py
-from ansible.errors import AnsibleError
-from ansible.module_utils._text import to_native
+import base64
+import fnmatch
+import gzip
+import io
+import json
+import os
+import re
+import threading
+import time
+
+from multiprocessing.pool import ThreadPool
+
+from ansible.errors import AnsibleError, AnsibleParserError
+from ansible.module_utils._text import to_bytes, to_native, to_text
 
-from ansible.module_utils.basic import json
-from ansible.module_utils.urls import open_url
 from ansible.plugins.inventory import BaseInventoryPlugin, Constructable, Cacheable
 from ansible.utils.display import Display
 
 try:
-    import boto3
-    import botocore
+    import ansible.module_utils.spotinst_api
 except ImportError:
-    raise AnsibleError('The spotinst_esg dynamic inventory plugin requires boto3 and botocore.')
+    # Custom module_utils are only shipped to modules, expose the ones from this repository to the controller too
+    import ansible.module_utils
+    ansible.module_utils.__path__.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..', 'module_utils'))
+
+from ansible.module_utils.spotinst_api import get_spotinst_client
+from ansible.module_utils.spotinst_aws import get_client, invalidate_clients, is_expired_credentials_error
+from ansible.module_utils.spotinst_metrics import Metrics
+from ansible.module_utils.spotinst_watch import SnapshotClient
 
 display = Display()
 
+# boto3 and botocore are imported by _import_boto once an EC2 call is needed, a cached inventory never loads them
+boto3 = None
+botocore = None
+
+
+def _import_boto():
+    '''
+        Import boto3 and botocore on first use.
+    '''
+    global boto3, botocore
+    if boto3 is None:
+        try:
+            import boto3
+            import botocore.exceptions
+            import botocore.session
+        except ImportError:
+            raise AnsibleError('The spotinst_esg dynamic inventory plugin requires boto3 and botocore.')
+
 
 class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
 
     NAME = 'spotinst_esg'  # used internally by Ansible, it should match the file name but not required
 
+    # Maximum number of instance IDs sent in a single DescribeInstances call
+    EC2_BATCH_SIZE = 200
+
+    # Bumped whenever the layout of cached data changes, older caches are ignored
+    CACHE_VERSION = 7
+
+    # Tag set by Spotinst on every EC2 instance of an ESG
+    ESG_ID_TAG = 'spotinst:aws:ec2:group:id'
+
+    ESG_ID = re.compile(r'^sig-[0-9a-z]+$')
+
     def __init__(self):
         super(InventoryModule, self).__init__()
 
@@ -67,11 +222,17 @@ class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
 
         # credentials
         self.spotinst_api_token = None
+        self.spotinst_client = None
+
+        # API calls and timings of this inventory source
+        self.metrics = Metrics()
 
         self.boto_profile = None
         self.aws_secret_access_key = None
         self.aws_access_key_id = None
         self.aws_security_token = None
+        self._aws_credentials = None
+        self._aws_lock = threading.Lock()
 
     def verify_file(self, path):
         '''
@@ -88,8 +249,32 @@ class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
     def _get_credentials(self):
         '''
             Borrowed from aws_ec2 inventory.
+            AWS credentials are resolved on the first call only, right before the first EC2 call.
             :return A dictionary of boto client credentials
         '''
+        with self._aws_lock:
+            if self._aws_credentials is None:
+                self._aws_credentials = self._resolve_aws_credentials()
+            return self._aws_credentials
+
+    def _resolve_aws_credentials(self):
+        '''
+            Fall back on the botocore credential chain when no credentials are configured.
+            :return A dictionary of boto client credentials
+        '''
+        _import_boto()
+
+        if not self.boto_profile and not (self.aws_access_key_id and self.aws_secret_access_key):
+            session = botocore.session.get_session()
+            if session.get_credentials() is not None:
+                self.aws_access_key_id = session.get_credentials().access_key
+                self.aws_secret_access_key = session.get_credentials().secret_key
+                self.aws_security_token = session.get_credentials().token
+
+        if not self.boto_profile and not (self.aws_access_key_id and self.aws_secret_access_key):
+            raise AnsibleError("Insufficient boto credentials found. Please provide them in your "
+                               "inventory configuration file or set them as environment variables.")
+
         boto_params = {}
         for credential in (('aws_access_key_id', self.aws_access_key_id),
                            ('aws_secret_access_key', self.aws_secret_access_key),
@@ -102,36 +287,32 @@ class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
     def _set_credentials(self):
         '''
             Borrowed from aws_ec2 inventory and extended to spotinst.
-            Set Spotinst and AWS credentials.
+            Set Spotinst credentials and read AWS ones, those are only resolved by _get_credentials.
         '''
         self.spotinst_api_token = self.get_option('spotinst_api_token')
+        self.spotinst_client = get_spotinst_client(self.spotinst_api_token,
+                                                   api_url=self.get_option('spotinst_api_url'),
+                                                   rate_limit=self.get_option('spotinst_api_rate_limit'),
+                                                   max_retries=self.get_option('spotinst_api_max_retries'),
+                                                   metrics=self.metrics)
 
         self.boto_profile = self.get_option('aws_profile')
         self.aws_access_key_id = self.get_option('aws_access_key')
         self.aws_secret_access_key = self.get_option('aws_secret_key')
         self.aws_security_token = self.get_option('aws_security_token')
-
-        if not self.boto_profile and not (self.aws_access_key_id and self.aws_secret_access_key):
-            session = botocore.session.get_session()
-            if session.get_credentials() is not None:
-                self.aws_access_key_id = session.get_credentials().access_key
-                self.aws_secret_access_key = session.get_credentials().secret_key
-                self.aws_security_token = session.get_credentials().token
-
-        if not self.boto_profile and not (self.aws_access_key_id and self.aws_secret_access_key):
-            raise AnsibleError("Insufficient boto credentials found. Please provide them in your "
-                               "inventory configuration file or set them as environment variables.")
+        self._aws_credentials = None
 
     def _get_connection(self, credentials, region='us-east-1'):
         '''
             Borrowed from aws_ec2 inventory.
+            Clients are reused across calls through the process level client cache.
         '''
         try:
-            connection = boto3.session.Session(profile_name=self.boto_profile).client('ec2', region, **credentials)
+            connection = get_client('ec2', region, profile=self.boto_profile, **credentials)
         except (botocore.exceptions.ProfileNotFound, botocore.exceptions.PartialCredentialsError) as e:
             if self.boto_profile:
                 try:
-                    connection = boto3.session.Session(profile_name=self.boto_profile).client('ec2', region)
+                    connection = get_client('ec2', region, profile=self.boto_profile)
                 except (botocore.exceptions.ProfileNotFound, botocore.exceptions.PartialCredentialsError) as e:
                     raise AnsibleError("Insufficient credentials found: %s" % to_native(e))
             else:
@@ -170,11 +351,32 @@ class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
             connection = self._get_connection(credentials, region)
             yield connection, region
 
-    def _get_instances_by_region(self, regions, ids, strict_permissions=False):
+    def _refresh_credentials(self):
+        '''
+            Drop cached clients and resolve credentials again once they have expired.
+        '''
+        display.vvv("AWS credentials have expired, resolving them again")
+        invalidate_clients(profile=self.boto_profile)
+        self._set_credentials()
+
+    def _describe_instances(self, connection, filters):
+        '''
+            :param connection: a boto3 EC2 client
+            :param filters: a list of DescribeInstances filters
+            :return A list of instance dictionaries
+        '''
+        paginator = connection.get_paginator('describe_instances')
+        reservations = paginator.paginate(Filters=filters).build_full_result().get('Reservations')
+        instances = []
+        for r in reservations:
+            instances.extend(r['Instances'])
+        return instances
+
+    def _get_instances_by_region(self, regions, filters, strict_permissions=False):
         '''
             Borrowed from aws_ec2 inventory.
             :param regions: a list of regions in which to describe instances
-            :param ids: a list of EC2 ids
+            :param filters: a list of DescribeInstances filters
             :param strict_permissions: a boolean determining whether to fail or ignore 403 error codes
             :return A list of instance dictionaries
         '''
@@ -182,11 +384,15 @@ class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
 
         for connection, region in self._boto3_conn(regions):
             try:
-                paginator = connection.get_paginator('describe_instances')
-                reservations = paginator.paginate(InstanceIds=ids).build_full_result().get('Reservations')
-                instances = []
-                for r in reservations:
-                    instances.extend(r['Instances'])
+                try:
+                    with self.metrics.timer('ec2_describe_instances_seconds', region=region):
+                        instances = self._describe_instances(connection, filters)
+                except botocore.exceptions.ClientError as e:
+                    if not is_expired_credentials_error(e):
+                        raise
+                    # Retry once with a fresh client
+                    self._refresh_credentials()
+                    instances = self._describe_instances(self._get_connection(self._get_credentials(), region), filters)
             except botocore.exceptions.ClientError as e:
                 if e.response['ResponseMetadata']['HTTPStatusCode'] == 403 and not strict_permissions:
                     instances = []
@@ -197,92 +403,448 @@ class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
 
             all_instances.extend(instances)
 
-        return sorted(all_instances, key=lambda x: x['InstanceId'])
+        return all_instances
 
     def _request_spotinst(self, endpoint, method='GET'):
         '''
             Interract with Spotinst API.
             :param endpoint: The spotinst API endpoint to query
         '''
-        spotinst_api = "https://api.spotinst.io"
+        return self.spotinst_client.request(endpoint, method=method)
 
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": "Bearer {}".format(self.spotinst_api_token)
-        }
+    def _iter_spotinst(self, endpoint):
+        '''
+            Stream the items of a Spotinst API list endpoint.
+            :param endpoint: The spotinst API endpoint to query
+            :return A generator of items, yielded while the response is still downloading
+        '''
+        return self.spotinst_client.iter_items(endpoint)
+
+    def _map(self, func, items):
+        '''
+            Apply func to every item, using up to max_concurrency threads.
+            :param func: a function taking a single item
+            :param items: a list of items, or a generator whose items are submitted as soon as they are produced
+            :return A list of results in the same order as items
+        '''
+        max_concurrency = self.get_option('max_concurrency') or 1
+        if isinstance(items, (list, tuple)):
+            max_concurrency = min(max_concurrency, len(items))
+        if max_concurrency <= 1:
+            return [func(item) for item in items]
+
+        pool = ThreadPool(max_concurrency)
+        try:
+            pending = [pool.apply_async(func, (item,)) for item in items]
+            return [result.get() for result in pending]
+        finally:
+            pool.close()
+            pool.join()
+
+    def _get_tags(self, esg):
+        '''
+            :param esg: An ESG object as returned by Spotinst API, or an ESG entry of an inventory
+            :return The tags of the ESG, as a list of tagKey / tagValue dictionaries
+        '''
+        if 'tags' in esg:
+            return esg['tags']
+        return esg.get('compute', {}).get('launchSpecification', {}).get('tags') or []
+
+    def _match_group(self, esg, group_filter):
+        '''
+            :param esg: An ESG object as returned by Spotinst API
+            :param group_filter: An ESG id or name glob, regex:<expression> or tag:<key>[=<value>]
+            :return Whether the ESG matches the filter
+        '''
+        if group_filter.startswith('regex:'):
+            return re.search(group_filter[len('regex:'):], esg['name']) is not None
 
-        uri = "{}/{}".format(spotinst_api, endpoint)
-        req = open_url(uri, method=method, headers=headers, validate_certs=True)
-        res = json.loads(req.read())
+        if group_filter.startswith('tag:'):
+            key, sep, value = group_filter[len('tag:'):].partition('=')
+            tags = self._get_tags(esg)
+            return any(tag.get('tagKey') == key and (not sep or tag.get('tagValue') == value) for tag in tags)
 
-        return res
+        return fnmatch.fnmatchcase(esg['id'], group_filter) or fnmatch.fnmatchcase(esg['name'], group_filter)
 
-    def _query(self, account_id):
+    def _is_selected(self, esg):
+        '''
+            Tell whether an ESG (as returned by Spotinst API or an ESG entry of an inventory) passes the include_groups,
+            exclude_groups and regions options.
         '''
-            Generate a map of ESGs -> Instances. The Instance object comes from Spotinst API and is then
-            enriched with AWS EC2 privateIp data.
+        include_groups = self.get_option('include_groups')
+        if include_groups and not any(self._match_group(esg, f) for f in include_groups):
+            return False
+        if any(self._match_group(esg, f) for f in self.get_option('exclude_groups')):
+            return False
+
+        regions = self.get_option('regions')
+        return not regions or esg['region'] in regions
 
+    def _list_esgs(self, account_id):
+        '''
+            List the ESGs of an account selected by the include_groups, exclude_groups and regions options.
             :param account_id: A spotinst account ID to retrieve ESGs from
+            :return A generator of ESG objects as returned by Spotinst API
         '''
-        esg_instances = {}
-        try:
+        include_groups = self.get_option('include_groups')
+        if include_groups and all(self.ESG_ID.match(f) for f in include_groups):
+            # Only a few known ESGs are wanted, get them directly instead of listing the whole account
+            endpoints = ["aws/ec2/group/{}?accountId={}".format(esg_id, account_id) for esg_id in include_groups]
+        else:
             # https://api.spotinst.com/spotinst-api/elastigroup/amazon-web-services/list-all-groups/
-            esgs = self._request_spotinst(endpoint="aws/ec2/group?accountId={}".format(account_id))
-
-            for item in esgs['response']['items']:
-                # https://api.spotinst.com/spotinst-api/elastigroup/amazon-web-services/stateful-api/list-stateful-instances
-                esg_details = self._request_spotinst(endpoint="aws/ec2/group/{}/statefulInstance?accountId={}".format(item['id'], account_id))
-
-                # Collect all instance IDs part of the ESG
-                for instance in esg_details['response']['items']:
-                    # Add attributes to instance object
-                    instance['accountId'] = account_id
-                    instance['esg_id'] = item['id']
-                    instance['esg_name'] = item['name']
-                    # Append instance to ESG group (id and name)
-                    esg_instances.setdefault(item['id'], []).append(instance)
-                    esg_instances.setdefault(item['name'], []).append(instance)
-
-                # If stateful instances found, then gather ips
-                if item['id'] in esg_instances:
-                    # Get private ips of ESG instances
-                    ec2s = self._get_instances_by_region([item['region']], [i['instanceId'] for i in esg_instances[item['id']]])
-
-                    # For each instance update object to append privateIp from AWS
-                    for instance in esg_instances[item['id']]:
-                        instance.update(
-                            {'privateIp': list(filter(lambda ec2: ec2['InstanceId'] == instance['instanceId'], ec2s))[0]['PrivateIpAddress']}
-                        )
-                else:
-                    # TODO Deal with non stateful instances...
-                    #   aws/ec2/group/{groupid} does not contain information about instanceId
-                    #   if the group is not stateful. Might need to query AWS based on tags
-                    pass
+            endpoints = ["aws/ec2/group?accountId={}".format(account_id)]
+
+        for endpoint in endpoints:
+            for esg in self._iter_spotinst(endpoint=endpoint):
+                if self._is_selected(esg):
+                    yield esg
+
+    def _get_stateful_instances(self, account_id, esg):
+        '''
+            Get the stateful instances of an ESG from Spotinst API.
+            :param account_id: A spotinst account ID the ESG belongs to
+            :param esg: An ESG dictionary with at least its id, name and region
+            :return A list of instance dictionaries
+        '''
+        # https://api.spotinst.com/spotinst-api/elastigroup/amazon-web-services/stateful-api/list-stateful-instances
+        instances = []
+        for instance in self._iter_spotinst(endpoint="aws/ec2/group/{}/statefulInstance?accountId={}".format(esg['id'], account_id)):
+            # Add attributes to instance object
+            instance['accountId'] = account_id
+            instance['esg_id'] = esg['id']
+            instance['esg_name'] = esg['name']
+            instance['region'] = esg['region']
+            instance['stateful'] = True
+            instances.append(instance)
+
+        return instances
+
+    def _batches(self, values_by_region):
+        '''
+            :param values_by_region: A dictionary of region -> list of filter values
+            :return A list of (region, values) with at most EC2_BATCH_SIZE values each
+        '''
+        batches = []
+        for region, values in values_by_region.items():
+            for i in range(0, len(values), self.EC2_BATCH_SIZE):
+                batches.append((region, values[i:i + self.EC2_BATCH_SIZE]))
+        return batches
+
+    def _get_non_stateful_instances(self, account_id, esgs):
+        '''
+            Find the EC2 instances of ESGs without stateful instances, from the tag Spotinst sets on them. All ESGs of
+            a region are looked up at once, with a single DescribeInstances call per EC2_BATCH_SIZE ESGs.
+            :param account_id: A spotinst account ID the ESGs belong to
+            :param esgs: A list of ESG dictionaries with at least their id, name and region
+            :return A dictionary of ESG id -> list of instance dictionaries shaped like stateful ones
+        '''
+        esgs_by_id = dict((esg['id'], esg) for esg in esgs)
+        esg_ids_by_region = {}
+        for esg in esgs:
+            esg_ids_by_region.setdefault(esg['region'], []).append(esg['id'])
+
+        batches = self._batches(esg_ids_by_region)
+        results = self._map(lambda batch: self._get_instances_by_region([batch[0]], [
+            {'Name': 'tag:{}'.format(self.ESG_ID_TAG), 'Values': batch[1]},
+            {'Name': 'instance-state-name', 'Values': ['pending', 'running']},
+        ]), batches)
+
+        instances_by_esg = {}
+        for ec2s in results:
+            for ec2 in ec2s:
+                if 'PrivateIpAddress' not in ec2:
+                    continue
+                tags = dict((tag['Key'], tag['Value']) for tag in ec2.get('Tags', []))
+                esg = esgs_by_id.get(tags.get(self.ESG_ID_TAG))
+                if esg is None:
+                    continue
+                instances_by_esg.setdefault(esg['id'], []).append({
+                    'id': ec2['InstanceId'],
+                    'instanceId': ec2['InstanceId'],
+                    'privateIp': ec2['PrivateIpAddress'],
+                    'state': ec2['State']['Name'],
+                    'launchedAt': to_text(ec2['LaunchTime'].isoformat()) if 'LaunchTime' in ec2 else None,
+                    'availabilityZone': ec2.get('Placement', {}).get('AvailabilityZone'),
+                    'accountId': account_id,
+                    'esg_id': esg['id'],
+                    'esg_name': esg['name'],
+                    'region': esg['region'],
+                    'stateful': False,
+                })
+
+        return instances_by_esg
+
+    def _get_ec2_instances(self, instance_ids_by_region):
+        '''
+            Describe EC2 instances with a few batched calls per region instead of one call per ESG.
+            :param instance_ids_by_region: A dictionary of region -> list of EC2 ids
+            :return A dictionary of region -> dictionary of EC2 id -> instance dictionary
+        '''
+        batches = self._batches(instance_ids_by_region)
+
+        # Filtering (instead of InstanceIds) does not fail the whole call when an id no longer exists
+        results = self._map(lambda batch: self._get_instances_by_region([batch[0]], [{'Name': 'instance-id', 'Values': batch[1]}]),
+                            batches)
+
+        ec2s_by_region = {}
+        for (region, _), ec2s in zip(batches, results):
+            index = ec2s_by_region.setdefault(region, {})
+            for ec2 in ec2s:
+                index[ec2['InstanceId']] = ec2
+
+        return ec2s_by_region
+
+    def _get_private_ip(self, instance, ec2):
+        '''
+            Get the privateIp of a stateful instance from its EC2 counterpart.
+            :param instance: A stateful instance object as returned by Spotinst API
+            :param ec2: The matching EC2 instance dictionary, None if it could not be found
+            :return The private IP address, None if the instance is missing or terminated
+        '''
+        if ec2 is None:
+            reason = "could not be found"
+        elif 'PrivateIpAddress' not in ec2:
+            reason = "has no private IP (EC2 state: {})".format(ec2.get('State', {}).get('Name', 'unknown'))
+        else:
+            return ec2['PrivateIpAddress']
+
+        message = "Stateful instance {} of ESG {} ({}): EC2 instance {} {}".format(
+            instance['id'], instance['esg_name'], instance['esg_id'], instance['instanceId'], reason)
+        if self.get_option('strict'):
+            raise AnsibleError(message)
+
+        display.warning("{}, skipping it.".format(message))
+        return None
+
+    def _get_fingerprint(self, esg):
+        '''
+            :param esg: An ESG object as returned by Spotinst API
+            :return A value changing whenever the ESG is updated, None if unknown. Recycling a stateful instance does
+                    not update its ESG, so stateful ESGs are never reused from the fingerprint alone.
+        '''
+        return esg.get('updatedAt')
+
+    def _is_expired(self, cached_esg, now):
+        '''
+            :param cached_esg: A cached ESG entry
+            :param now: The current timestamp
+            :return True if the entry is older than esg_cache_ttl
+        '''
+        ttl = self.get_option('esg_cache_ttl')
+        return bool(ttl) and now - cached_esg['cached_at'] > ttl
+
+    def _query(self, account_id, cached=None):
+        '''
+            Generate an inventory of ESGs and their Instances. The Instance object comes from Spotinst API and is then
+            enriched with AWS EC2 privateIp data. Instances of non stateful ESGs come from AWS EC2 only.
+
+            :param account_id: A spotinst account ID to retrieve ESGs from
+            :param cached: An inventory from a previous query, the metadata of unchanged ESGs is reused instead of
+                           queried again
+            :return An inventory dictionary made of
+                'esgs': a list of ESG entries (id, name, region, tags, fingerprint, cached_at, stateful and instances
+                        as a list of host ids) in listing order
+                'hosts': a dictionary of host id (stateful instance id, EC2 id for non stateful ESGs) -> instance,
+                         each host being stored once
+        '''
+        cached = cached or {}
+        cached_esgs = dict((cached_esg['id'], cached_esg) for cached_esg in cached.get('esgs', []))
+        cached_hosts = cached.get('hosts', {})
+        now = time.time()
+
+        esg_entries = []
+        hosts = {}
+        stale = []
+        reused = []
+
+        def stale_esgs():
+            # Groups are streamed, only the few fields kept in esg_entry stay in memory
+            for item in self._list_esgs(account_id):
+                fingerprint = self._get_fingerprint(item)
+                cached_esg = cached_esgs.get(item['id'])
+                # Reuse unchanged ESGs without stateful instances from cache, only query the others. Spot replacements
+                # and scale events do not update the ESG either, so only its metadata is reused and its instances are
+                # looked up again
+                unchanged = cached_esg is not None and fingerprint is not None and cached_esg['fingerprint'] == fingerprint
+                if unchanged and not cached_esg['stateful'] and not self._is_expired(cached_esg, now):
+                    esg_entry = dict(cached_esg, instances=[])
+                    esg_entries.append(esg_entry)
+                    reused.append(esg_entry)
+                    continue
+
+                esg_entry = {'id': item['id'], 'name': item['name'], 'region': item['region'],
+                             'tags': self._get_tags(item), 'fingerprint': fingerprint, 'cached_at': now, 'stateful': False, 'instances': []}
+                esg_entries.append(esg_entry)
+                stale.append((esg_entry, cached_esg))
+                yield esg_entry
 
+        try:
+            # Stateful instances are fetched concurrently, starting while groups are still listed, but merged back in
+            # listing order
+            results = self._map(lambda esg_entry: self._get_stateful_instances(account_id, esg_entry), stale_esgs())
+
+            display.vvv("spotinst_esg: {} ESGs reused from cache, {} to query".format(len(esg_entries) - len(stale), len(stale)))
+            self.metrics.incr('inventory_esgs', len(esg_entries) - len(stale), source='cache')
+            self.metrics.incr('inventory_esgs', len(stale), source='api')
+
+            # Private IPs and availability zones of instances already known from cache do not change, only describe
+            # new ones
+            known_hosts = {}
+            for esg_entry, cached_esg in stale:
+                for ssi in (cached_esg or {}).get('instances', []):
+                    known_hosts[cached_hosts[ssi]['instanceId']] = cached_hosts[ssi]
+
+            # Collect all instance IDs of all ESGs by region
+            instance_ids_by_region = {}
+            non_stateful = list(reused)
+            for (esg_entry, cached_esg), instances in zip(stale, results):
+                ids = [i['instanceId'] for i in instances if i['instanceId'] not in known_hosts]
+                if ids:
+                    instance_ids_by_region.setdefault(esg_entry['region'], []).extend(ids)
+                elif not instances:
+                    # aws/ec2/group/{groupid} does not contain information about instanceId if the group is not
+                    # stateful, its instances are looked up by tag instead
+                    non_stateful.append(esg_entry)
+
+            # Get private ips of all ESG instances
+            ec2s_by_region = self._get_ec2_instances(instance_ids_by_region)
+
+            for (esg_entry, cached_esg), instances in zip(stale, results):
+                # Even when none of them has a private IP yet, as when all of them are being recycled
+                esg_entry['stateful'] = bool(instances)
+                ec2s = ec2s_by_region.get(esg_entry['region'], {})
+                for instance in instances:
+                    known_host = known_hosts.get(instance['instanceId'])
+                    if known_host is not None:
+                        private_ip = known_host['privateIp']
+                        availability_zone = known_host.get('availabilityZone')
+                    else:
+                        ec2 = ec2s.get(instance['instanceId'])
+                        private_ip = self._get_private_ip(instance, ec2)
+                        availability_zone = (ec2 or {}).get('Placement', {}).get('AvailabilityZone')
+                    if private_ip is None:
+                        continue
+
+                    # Update instance object to append privateIp and availabilityZone from AWS
+                    instance.update({'privateIp': private_ip, 'availabilityZone': availability_zone})
+                    esg_entry['instances'].append(instance['id'])
+                    hosts[instance['id']] = instance
+
+            if non_stateful and self.get_option('non_stateful_groups'):
+                instances_by_esg = self._get_non_stateful_instances(account_id, non_stateful)
+                for esg_entry in non_stateful:
+                    for instance in instances_by_esg.get(esg_entry['id'], []):
+                        esg_entry['instances'].append(instance['id'])
+                        hosts[instance['id']] = instance
+
+        except AnsibleError:
+            raise
         except Exception as e:
             raise AnsibleError("An error occured while parsing Spotinst response: %s" % to_native(e))
 
-        return esg_instances
+        self.metrics.incr('inventory_hosts', len(hosts))
+        return {'esgs': esg_entries, 'hosts': hosts}
 
-    def _add_hosts(self, hosts, group):
+    def _add_hosts(self, hosts):
         '''
             Borrowed from aws_ec2 inventory.
-            :param hosts: a list of hosts to be added to a group
-            :param group: the name of the group to which the hosts belong
-            :param hostnames: a list of hostname destination variables in order of preference
-        '''
-        for host in hosts:
-            self.inventory.add_host(host['privateIp'], group=group)
-            for hostvar, hostval in host.items():
-                self.inventory.set_variable(host['privateIp'],
-                                            "{}{}".format(self.hostvar_prefix, hostvar),
-                                            hostval)
-
-    def _populate(self, groups):
-        for group, hosts in groups.items():
-            self.inventory.add_group(group)
-            self._add_hosts(hosts=hosts, group=group)
-            self.inventory.add_child('all', group)
+            Register each host once, set its variables and apply the compose, groups and keyed_groups options to it.
+            :param hosts: a list of (host name, hostvars, names of the groups the host belongs to)
+        '''
+        strict = self.get_option('strict')
+        compose = self.get_option('compose')
+        conditional_groups = self.get_option('groups')
+        keyed_groups = self.get_option('keyed_groups')
+
+        for name, hostvars, groups in hosts:
+            self.inventory.add_host(name, group=groups[0])
+            for group in groups[1:]:
+                self.inventory.add_child(group, name)
+
+            host = self.inventory.get_host(name)
+            for hostvar, hostval in hostvars.items():
+                host.set_variable(hostvar, hostval)
+
+            # Composed variables, then conditional and keyed groups, from the spotinst_ prefixed hostvars
+            self._set_composite_vars(compose, hostvars, name, strict=strict)
+            self._add_host_to_composed_groups(conditional_groups, hostvars, name, strict=strict)
+            self._add_host_to_keyed_groups(keyed_groups, hostvars, name, strict=strict)
+
+    def _populate(self, inventory):
+        '''
+            Add ESG groups and their hosts to the inventory, hosts are gathered first so that each of them is added once.
+            :param inventory: An inventory as returned by _query
+        '''
+        # Host name -> (hostvars, groups), in listing order
+        names = []
+        hosts = {}
+        # Host field -> prefixed hostvar name, built once per field instead of once per host
+        hostvar_names = {}
+
+        for esg in inventory['esgs']:
+            if not esg['instances']:
+                continue
+
+            # Each ESG is exposed as two groups (id and name) sharing the same hosts
+            esg_groups = [esg['id'], esg['name']]
+            for group in esg_groups:
+                self.inventory.add_group(group)
+                self.inventory.add_child('all', group)
+                for var in ('id', 'name', 'region'):
+                    self.inventory.set_variable(group, "{}esg_{}".format(self.hostvar_prefix, var), esg[var])
+
+            for ssi in esg['instances']:
+                instance = inventory['hosts'][ssi]
+                name = instance['privateIp']
+                if name not in hosts:
+                    names.append(name)
+                    hosts[name] = ({}, [])
+                hostvars, groups = hosts[name]
+
+                for field, value in instance.items():
+                    hostvar = hostvar_names.get(field)
+                    if hostvar is None:
+                        hostvar = hostvar_names[field] = self.hostvar_prefix + field
+                    hostvars[hostvar] = value
+                for group in esg_groups:
+                    if group not in groups:
+                        groups.append(group)
+
+        self._add_hosts([(name, hosts[name][0], hosts[name][1]) for name in names])
+
+    def _dump_cache(self, inventory):
+        '''
+            :param inventory: An inventory as returned by _query
+            :return The value stored by the cache plugin, gzipped when cache_compression is enabled
+        '''
+        data = dict(inventory, version=self.CACHE_VERSION)
+        if self.get_option('cache_compression') != 'gzip':
+            return data
+
+        out = io.BytesIO()
+        f = gzip.GzipFile(fileobj=out, mode='wb', mtime=0)
+        try:
+            f.write(to_bytes(json.dumps(data, separators=(',', ':'))))
+        finally:
+            f.close()
+        return {'version': self.CACHE_VERSION, 'gzip': to_text(base64.b64encode(out.getvalue()))}
+
+    def _load_cache(self, cached):
+        '''
+            :param cached: The value stored by the cache plugin
+            :return The cached inventory, None if it was written by another version of this plugin
+        '''
+        if not isinstance(cached, dict) or cached.get('version') != self.CACHE_VERSION:
+            return None
+
+        if 'gzip' in cached:
+            f = gzip.GzipFile(fileobj=io.BytesIO(base64.b64decode(cached['gzip'])))
+            try:
+                cached = json.loads(to_text(f.read()))
+            finally:
+                f.close()
+
+        return cached
 
     def parse(self, inventory, loader, path, cache=False):
         '''
@@ -303,22 +865,89 @@ class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
             # get the user-specified directive
             cache = self.get_option('cache')
 
-        # Generate inventory
+        # Generate inventory, a fresh spotinst-esg-watch snapshot needs neither the cache nor any API call
         cache_needs_update = False
-        if cache:
-            try:
-                results = self.cache.get(cache_key)
-            except KeyError:
-                # if cache expires or cache file doesn't exist
-                cache_needs_update = True
+        results = self._get_snapshot(account_id)
+        if results is None:
+            # Load cached ESGs, even when refreshing as unchanged ESGs do not need to be queried again
+            cached = None
+            if self.get_option('cache'):
+                try:
+                    cached = self._load_cache(self.cache.get(cache_key))
+                except KeyError:
+                    # if cache expires or cache file doesn't exist
+                    pass
 
-        if not cache or cache_needs_update:
-            results = self._query(account_id)
+            if cache and cached is not None and not any(self._is_expired(e, time.time()) for e in cached['esgs']):
+                results = cached
+            else:
+                with self.metrics.timer('inventory_query_seconds'):
+                    results = self._query(account_id, cached)
+                cache_needs_update = self.get_option('cache')
 
-        # print(results)
-        self._populate(results)
+        with self.metrics.timer('inventory_populate_seconds'):
+            self._populate(results)
 
         # If the cache has expired/doesn't exist or if refresh_inventory/flush cache is used
         # when the user is using caching, update the cached inventory
-        if cache_needs_update or (not cache and self.get_option('cache')):
-            self.cache.set(cache_key, results)
+        if cache_needs_update:
+            self.cache.set(cache_key, self._dump_cache(results))
+
+        self._report_metrics()
+
+    def _get_snapshot(self, account_id):
+        '''
+            :param account_id: A spotinst account ID
+            :return The inventory watched by the spotinst-esg-watch daemon at watch_address, None if unavailable
+        '''
+        address = self.get_option('watch_address')
+        if not address:
+            return None
+
+        try:
+            client = SnapshotClient(address, max_age=self.get_option('watch_max_age'))
+        except ValueError as e:
+            raise AnsibleParserError("Invalid watch_address: {}".format(to_native(e)))
+
+        snapshot = client.get_inventory(account_id)
+        if snapshot is None:
+            display.warning("No fresh spotinst-esg-watch snapshot at {}, querying Spotinst API".format(address))
+            return None
+
+        # The daemon watches the whole account, as scoped by its own inventory file
+        snapshot = self._select(snapshot)
+        self.metrics.incr('inventory_esgs', len(snapshot['esgs']), source='watch')
+        return snapshot
+
+    def _select(self, inventory):
+        '''
+            Apply the include_groups, exclude_groups, regions and non_stateful_groups options to an inventory queried
+            with other ones, such as the one of a spotinst-esg-watch daemon.
+            :param inventory: An inventory as returned by _query
+            :return The inventory restricted to the selected ESGs and their hosts
+        '''
+        non_stateful_groups = self.get_option('non_stateful_groups')
+        esgs = []
+        hosts = {}
+        for esg in inventory['esgs']:
+            if not self._is_selected(esg):
+                continue
+            if not esg['stateful'] and not non_stateful_groups:
+                esg = dict(esg, instances=[])
+            esgs.append(esg)
+            for host_id in esg['instances']:
+                hosts[host_id] = inventory['hosts'][host_id]
+        return {'esgs': esgs, 'hosts': hosts}
+
+    def _report_metrics(self):
+        '''
+            Display metrics with -vvv and export them to metrics_sink, failing to export them is not an error.
+        '''
+        display.vvv("spotinst_esg: metrics {}".format(json.dumps(self.metrics.to_dict(), sort_keys=True)))
+
+        sink = self.get_option('metrics_sink')
+        if sink:
+            try:
+                self.metrics.export(sink)
+            except (IOError, OSError) as e:
+                display.warning("Unable to export spotinst_esg metrics to {}: {}".format(sink, to_native(e)))
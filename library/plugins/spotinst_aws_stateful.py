@@ -31,38 +31,156 @@ short_description: Manage Stateful Spotinst Elastigroups.
 description:
     - A module to manage Stateful Spotinst Elastigroups using Spotinst API.
     - This module is able to recycle a stateful instance from an Elastigroup.
+    - Many stateful instances, possibly of several Elastigroups, can be recycled by a single task with
+      C(stateful_instance_ids). They share the Spotinst and EC2 clients and the polled stateful instances lists, at
+      most C(max_in_flight) instances of an Elastigroup are recycled at once.
+    - With C(wait=false) the recycle is only requested and a C(job) handle is returned right away. Many handles can then
+      be polled at once with C(state=status), which lists stateful instances once per Elastigroup.
 options:
     api_token:
         required: true
         description:
             - (String) Spotinst API token
 
+    api_url:
+        required: false
+        default: https://api.spotinst.io
+        description:
+            - (String) Spotinst API base URL
+
+    api_rate_limit:
+        required: false
+        default: 0
+        description:
+            - (Float) Maximum number of Spotinst API requests per second and per account made by the module, 0 for
+              no limit
+
+    api_max_retries:
+        required: false
+        default: 3
+        description:
+            - (Integer) Number of times a throttled (HTTP 429) or failed Spotinst API request is retried, with
+              exponential backoff or as told by the C(Retry-After) header. Only GET requests are retried on
+              server errors and timeouts
+
     account_id:
         required: true
         description:
             - (String) Spotinst account id with format act-xxx. (Example act-12345)
 
     esg_id:
-        required: true
+        required: false
         description:
             - (String) Id of the Elastigroup to operate on with format sig-xxx. (Example sig-227a0005)
+            - Required with C(state=recycled), unless every C(stateful_instance_ids) item has its own C(esg_id)
 
     stateful_instance_id:
-        required: true
+        required: false
         description:
             - (String) Stateful instance ID with format ssi-xxx. (Example ssi-227a0005)
+            - C(stateful_instance_id) or C(stateful_instance_ids) is required with C(state=recycled)
+
+    stateful_instance_ids:
+        required: false
+        description:
+            - (List) Stateful instances to recycle, either IDs of the C(esg_id) Elastigroup or dictionaries with a
+              C(stateful_instance_id), an C(esg_id) and an optional C(region). Results are returned in C(recycled)
+            - The C(region) of an item applies to every instance of its Elastigroup, items may not give it different
+              regions
+            - With C(wait=false), every recycle is requested at once regardless of C(max_in_flight) and their C(jobs)
+              are returned
+
+    max_in_flight:
+        required: false
+        default: 1
+        description:
+            - (Integer) Maximum number of C(stateful_instance_ids) of an Elastigroup recycled at once
 
     state:
         required: false
-        choices: [ recyled ]
+        choices: [ recyled, status ]
         description:
             - C(recyled) to recycle a stateful Elastigroup.
+            - C(status) to check on the C(jobs) returned by recycles requested with C(wait=false).
+
+    wait:
+        required: false
+        default: true
+        description:
+            - (Boolean) Whether to wait for the recycle to complete. When false, the recycle is requested and a C(job)
+              handle is returned without waiting
+
+    jobs:
+        required: false
+        description:
+            - (List) Job handles returned by C(wait=false) recycles, required with C(state=status)
 
     wait_timeout:
         required: false
         default: 600
         description:
             - (Integer) Number of seconds to wait for the operation to complete, default is 10min
+
+    poll_min_interval:
+        required: false
+        default: 2
+        description:
+            - (Integer) Minimum number of seconds between two polls of the stateful instance state
+
+    poll_max_interval:
+        required: false
+        default: 20
+        description:
+            - (Integer) Maximum number of seconds between two polls, the interval grows exponentially (with jitter)
+              from C(poll_min_interval) up to this value while waiting
+
+    region:
+        required: false
+        description:
+            - (String) AWS region of the Elastigroup, C(spotinst_region) hostvar of the C(spotinst_esg) inventory.
+              Fetched from Spotinst API (then cached in C(cache_dir)) when not given
+
+    metadata_cache_ttl:
+        required: false
+        default: 3600
+        description:
+            - (Integer) Number of seconds Elastigroups metadata (name and region) stays cached on disk, shared by every
+              fork. Set to 0 to disable the cache
+
+    poll_cache_ttl:
+        required: false
+        default: 2
+        description:
+            - (Integer) Number of seconds a polled list of stateful instances stays fresh in the on disk cache. Forks
+              polling the same Elastigroup share it, one of them refreshes the list while the others wait for it.
+              Set to 0 to disable the cache
+
+    cache_dir:
+        required: false
+        default: ~/.ansible/cache/spotinst
+        description:
+            - (String) Directory of the on disk cache
+
+    metrics_sink:
+        required: false
+        description:
+            - (String) Where to export the module C(metrics) besides its result, C(statsd://host:port) for a StatsD
+              daemon (over UDP, with DogStatsD tags), a path ending with C(.prom) for a Prometheus text file (Example
+              the node exporter textfile collector directory) or any other path for a JSON file
+
+    watch_address:
+        required: false
+        description:
+            - (String) Address of a C(spotinst-esg-watch) daemon watching the account, C(unix://<path>) or
+              C(http://<host>:<port>). Stateful instances are then listed from its snapshot, without any Spotinst API
+              call, as long as it is fresh
+
+    watch_max_age:
+        required: false
+        default: 15
+        description:
+            - (Integer) Number of seconds after which the C(watch_address) snapshot is ignored and Spotinst API is
+              polled instead
 '''
 
 EXAMPLES = '''
@@ -75,8 +193,47 @@ EXAMPLES = '''
     account_id: "{{ hostvars[inventory_hostname].spotinst_accountId }}"
     api_token: "{{ lookup('env', 'SPOTINST_API_TOKEN' )}}"
     stateful_instance_id: "{{ hostvars[inventory_hostname].spotinst_id }}"
+    region: "{{ hostvars[inventory_hostname].spotinst_region }}"
   delegate_to: localhost
   register: __testout
+
+# Recycle every instance of a group in a single task, two at a time
+
+- name: Recycle Stateful instances
+  spotinst_aws_stateful:
+    state: recycled
+    esg_id: sig-1234
+    account_id: act-123
+    api_token: "{{ lookup('env', 'SPOTINST_API_TOKEN' )}}"
+    stateful_instance_ids: "{{ groups['sig-1234'] | map('extract', hostvars, 'spotinst_id') | list }}"
+    max_in_flight: 2
+  delegate_to: localhost
+  run_once: true
+  register: __recycled
+
+# Start the recycle of several non quorum critical instances and check on them together
+
+- name: Request Stateful instances recycle
+  spotinst_aws_stateful:
+    state: recycled
+    wait: false
+    esg_id: "{{ hostvars[item].spotinst_esg_id }}"
+    account_id: "{{ hostvars[item].spotinst_accountId }}"
+    api_token: "{{ lookup('env', 'SPOTINST_API_TOKEN' )}}"
+    stateful_instance_id: "{{ hostvars[item].spotinst_id }}"
+  loop: "{{ groups['sig-1234'] }}"
+  register: __requested
+
+- name: Wait for Stateful instances recycle
+  spotinst_aws_stateful:
+    state: status
+    account_id: act-123
+    api_token: "{{ lookup('env', 'SPOTINST_API_TOKEN' )}}"
+    jobs: "{{ __requested.results | map(attribute='job') | list }}"
+  register: __status
+  until: __status.finished
+  retries: 60
+  delay: 10
 '''
 
 RETURN = '''
@@ -84,27 +241,68 @@ stateful:
     description: New stateful status of the instance on which the operation was run on.
     returned: changed
     type: dict
-    sample: {"createdAt": "2019-02-04T10:10:31.000Z", "devices": [{"deviceName": "/dev/xvdx", "volumeId": "vol-1234"}, ...], "id": "ssi-1234", "instanceId": "i-1234", "launchedAt": "2019-04-03T11:54:43.000Z", "privateIp": "10.201.x.y", "state": "<STATE>"}
+    sample: {"createdAt": "2019-02-04T10:10:31.000Z", "devices": [{"deviceName": "/dev/xvdx", "volumeId": "vol-1234"}, ...],
+             "id": "ssi-1234", "instanceId": "i-1234", "launchedAt": "2019-04-03T11:54:43.000Z", "privateIp": "10.201.x.y",
+             "state": "<STATE>"}
+recycled:
+    description: Outcome of every C(stateful_instance_ids) recycle, timings are the number of seconds spent in each
+                 state.
+    returned: with stateful_instance_ids
+    type: list
+    sample: [{"esg_id": "sig-1234", "stateful_instance_id": "ssi-1234", "state": "DONE", "changed": true, "msg": null,
+              "stateful": {"id": "ssi-1234", "instanceId": "i-1234", "privateIp": "10.201.x.y", "state": "ACTIVE"},
+              "timings": {"QUEUED": 0.0, "WAITING_ACTIVE": 1.2, "RECYCLING": 312.5}}]
+job:
+    description: Handle on the requested recycle, to be given to C(state=status).
+    returned: when wait is false
+    type: dict
+    sample: {"esg_id": "sig-1234", "stateful_instance_id": "ssi-1234", "instance_id": "i-1234",
+             "launched_at": "2019-04-03T11:54:43.000Z", "requested_at": 1554292483.5}
+jobs:
+    description: Status of every polled job, successfully finished ones have the new stateful status of their
+                 instance. With C(stateful_instance_ids) and C(wait=false), handles on the requested recycles instead.
+    returned: when state is status, or with stateful_instance_ids when wait is false
+    type: list
+    sample: [{"esg_id": "sig-1234", "stateful_instance_id": "ssi-1234", "finished": true, "failed": false, "state": "ACTIVE",
+              "msg": null, "stateful": {"id": "ssi-1234", "instanceId": "i-5678", "privateIp": "10.201.x.y", "state": "ACTIVE"},
+              ...}]
+finished:
+    description: Whether every polled job is finished, failed jobs being finished too.
+    returned: when state is status
+    type: bool
+metrics:
+    description: API calls per endpoint and status, latency histograms, retries, bytes received, polls and time spent in
+                 each recycle state.
+    returned: always
+    type: dict
+    sample: {'counters': {'api_requests{endpoint="aws/ec2/group/{esg_id}/statefulInstance",method="GET",status="200"}': 12,
+                          'recycle_polls{state="RECYCLING"}': 10},
+             'histograms': {'recycle_state_seconds{state="RECYCLING"}': {'count': 1, 'sum': 312.5, 'min': 312.5,
+                                                                         'max': 312.5, 'buckets': {'600': 1}}}}
 '''
 
-import time
+import traceback
 
 from ansible.module_utils.basic import AnsibleModule
-from ansible.module_utils.basic import json
-from ansible.module_utils.urls import open_url
-from ansible.module_utils.ec2 import (boto3_conn, boto3_tag_list_to_ansible_dict, camel_dict_to_snake_dict,
-                                      ec2_argument_spec, get_aws_connection_info)
+from ansible.module_utils.ec2 import boto3_tag_list_to_ansible_dict, camel_dict_to_snake_dict, ec2_argument_spec
+from ansible.module_utils.spotinst_api import SpotinstApiError, get_module_client
+from ansible.module_utils.spotinst_aws import get_connection_factory
+from ansible.module_utils.spotinst_cache import get_module_cache
+from ansible.module_utils.spotinst_metrics import export_module_metrics
+from ansible.module_utils.spotinst_stateful import (FleetRecycle, SpotinstStatefulError, StatefulGroup, StatefulRecycle,
+                                                    poll_jobs)
+from ansible.module_utils.spotinst_watch import get_module_snapshot
 
 
 try:
     import boto3
-    from botocore.exceptions import ClientError
+    from botocore.exceptions import BotoCoreError, ClientError
     HAS_BOTO3 = True
 except ImportError:
     HAS_BOTO3 = False
 
 
-def _return_result(module, changed, failed, message):
+def _return_result(module, changed, failed, message, metrics):
     """todo."""
     result = {}
     if changed:
@@ -113,126 +311,144 @@ def _return_result(module, changed, failed, message):
     result['stateful'] = message
     result['changed'] = changed
     result['failed'] = failed
+    result['metrics'] = export_module_metrics(module, metrics)
     module.exit_json(**result)
 
 
-def _call_spotinst_api(module, endpoint, method='GET'):
-    """Interract with Spotinst API."""
-    spotinst_api = "https://api.spotinst.io"
-
-    api_token = module.params.get('api_token')
+def _get_group(module, esg_id, region=None):
+    """Get an Elastigroup to operate on."""
+    client = get_module_client(module)
+    return StatefulGroup(client, module.params.get('account_id'), esg_id,
+                         ec2_connection=get_connection_factory(module),
+                         region=region or module.params.get('region'),
+                         metadata_cache=get_module_cache(module),
+                         poll_cache=get_module_cache(module, 'poll_cache_ttl'),
+                         snapshot=get_module_snapshot(module))
 
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": "Bearer {}".format(api_token)
-    }
 
-    uri = "{}/{}".format(spotinst_api, endpoint)
-    r = None
-    try:
+def _get_recycle(module, group, ssi):
+    """Get the recycle of a stateful instance of an Elastigroup."""
+    return StatefulRecycle(group, ssi,
+                           wait_timeout=int(module.params.get('wait_timeout')),
+                           poll_min_interval=module.params.get('poll_min_interval'),
+                           poll_max_interval=module.params.get('poll_max_interval'),
+                           metrics=group.metrics)
 
-        r = open_url(uri, method=method, headers=headers, validate_certs=True)
-        result = json.loads(r.read())
 
-        if 'response' in result:
-            if result['response']['status']['code'] == 200:
-                return result
-        else:
-            _return_result(module=module, changed=False, failed=True, message="Spotinst API raised an error: {}".format(result['response']))
-    except ValueError as e:
-        if r is not None:
-            _return_result(module=module, changed=False, failed=True, message=r)
+def recycle_elastigroup(module):
+    """Perform a recyling operation on a Stateful Spotinst instance."""
+    wait = module.params.get('wait')
+    group = _get_group(module, module.params.get('esg_id'))
+    recycle = _get_recycle(module, group, module.params.get('stateful_instance_id'))
+    recycle.run(wait=wait)
+
+    if recycle.state == StatefulRecycle.FAILED:
+        _return_result(module=module, changed=False, failed=True, message=recycle.error, metrics=group.metrics)
+
+    if not wait:
+        module.exit_json(changed=True, job=recycle.to_job(), metrics=export_module_metrics(module, group.metrics))
+
+    _return_result(module=module, changed=True, failed=False, message=recycle.instance, metrics=group.metrics)
+
+
+def _get_batch(module):
+    """Get the (esg_id, region, stateful instance id) of every stateful_instance_ids item, without duplicates."""
+    batch = []
+    seen = set()
+    regions = {}
+    for item in module.params.get('stateful_instance_ids'):
+        if isinstance(item, dict):
+            esg_id = item.get('esg_id') or module.params.get('esg_id')
+            region = item.get('region')
+            ssi = item.get('stateful_instance_id')
         else:
-            _return_result(module=module, changed=False, failed=True, message='An unexpected exception occurred while calling Spotinst')
-    except Exception as e:
-        _return_result(module=module, changed=False, failed=True, message=str(e))
-
-
-def _wait_for_stateful_instance(module, wait_timeout, pending_state, final_state='ACTIVE'):
-    """TODO."""
-    ssi = module.params.get('stateful_instance_id')
-    endpoint = "aws/ec2/group/{}/statefulInstance?accountId={}".format(module.params.get('esg_id'),
-                                                                       module.params.get('account_id'))
-
-    # Build a list of states that the instance should be validated against
-    states_path = [pending_state, final_state]
-    timeout = time.time() + wait_timeout
-
-    result = None
-    while time.time() < timeout and len(states_path) > 0:
-        result = _call_spotinst_api(module, endpoint, method='GET')
-
-        instance_status = next((item for item in result['response']['items'] if item["id"] == ssi), None)
-        if instance_status is not None:
-            if instance_status['state'] == states_path[0]:
-                states_path.pop(0)
-            else:
-                time.sleep(5)
-
-    if len(states_path) > 0:
-        _return_result(module=module, changed=False, failed=True,
-                       message=("The instance ({}) could not transition from {} to {} "
-                                "for [{}] operation before the timeout ({}s)".format(ssi,
-                                                                                     pending_state,
-                                                                                     final_state,
-                                                                                     module.params.get('state'),
-                                                                                     wait_timeout)))
-    # Return True if no timeout
+            esg_id, region, ssi = module.params.get('esg_id'), None, item
+        if not esg_id or not ssi:
+            module.fail_json(msg="Every item of stateful_instance_ids must be a stateful instance id of esg_id, or a "
+                                 "dictionary with a stateful_instance_id and an esg_id")
+        if region:
+            if regions.setdefault(esg_id, region) != region:
+                module.fail_json(msg="Conflicting regions given for {}: {} and {}".format(esg_id, regions[esg_id], region))
+        if (esg_id, ssi) not in seen:
+            seen.add((esg_id, ssi))
+            batch.append((esg_id, ssi))
+    # The region given on any item applies to every instance of its Elastigroup
+    return [(esg_id, regions.get(esg_id), ssi) for esg_id, ssi in batch]
+
+
+def recycle_batch(module):
+    """Recycle many stateful instances in a single run, sharing one StatefulGroup per Elastigroup."""
+    wait = module.params.get('wait')
+    metrics = get_module_client(module).metrics
+
+    groups = {}
+    recycles = []
+    for esg_id, region, ssi in _get_batch(module):
+        if esg_id not in groups:
+            groups[esg_id] = _get_group(module, esg_id, region=region)
+        recycles.append(_get_recycle(module, groups[esg_id], ssi))
+
+    if wait:
+        # Every Elastigroup gets as many threads as it may have instances in flight
+        max_in_flight = module.params.get('max_in_flight')
+        counts = {}
+        for recycle in recycles:
+            counts[recycle.group.esg_id] = counts.get(recycle.group.esg_id, 0) + 1
+        FleetRecycle(recycles,
+                     max_concurrency=max(1, sum(min(count, max_in_flight) for count in counts.values())),
+                     max_in_flight=max_in_flight).run()
     else:
-        return instance_status
-
-
-def _get_instances_by_region(module, region, ids):
-    """Get a list of EC2 instances matching the given list of IDs."""
-    region, ec2_url, aws_connect_params = get_aws_connection_info(module, boto3=True)
-    connection = boto3_conn(module, conn_type='client', resource='ec2', region=region, endpoint=ec2_url, **aws_connect_params)
-
-    all_instances = []
-
-    try:
-        paginator = connection.get_paginator('describe_instances')
-        reservations = paginator.paginate(InstanceIds=ids).build_full_result().get('Reservations')
-        instances = []
-        for r in reservations:
-            instances.extend(r['Instances'])
-    except ClientError as e:
-        _return_result(module=module, changed=False, failed=True, message="Failed to describe instances: {}".format(e))
-
-    all_instances.extend(instances)
-
-    return sorted(all_instances, key=lambda x: x['InstanceId'])
+        for recycle in recycles:
+            recycle.run(wait=False)
 
+    result = dict(
+        recycled=[recycle.to_dict() for recycle in recycles],
+        changed=any(recycle.requested for recycle in recycles),
+        metrics=export_module_metrics(module, metrics),
+    )
+    if not wait:
+        result['jobs'] = [recycle.to_job() for recycle in recycles if recycle.requested]
 
-def recycle_elastigroup(module):
-    """Perform a recyling operation on a Stateful Spotinst instance."""
-    ssi = module.params.get('stateful_instance_id')
-    wait_timeout = int(module.params.get('wait_timeout'))
-    endpoint = "aws/ec2/group/{}/statefulInstance/{}/recycle?accountId={}".format(module.params.get('esg_id'),
-                                                                                  ssi,
-                                                                                  module.params.get('account_id'))
+    failed = [recycle for recycle in recycles if recycle.state == StatefulRecycle.FAILED]
+    if failed:
+        module.fail_json(msg="{} stateful instance(s) could not be recycled: {}".format(
+            len(failed), ', '.join(recycle.ssi for recycle in failed)), **result)
 
-    # Safety check as Stateful operations can only be performed when instance is in ACTIVE state
-    _wait_for_stateful_instance(module, wait_timeout=wait_timeout, pending_state='ACTIVE')
+    module.exit_json(**result)
 
-    _call_spotinst_api(module, endpoint=endpoint, method='PUT')
-    recycled_instance = _wait_for_stateful_instance(module, wait_timeout=wait_timeout, pending_state='RECYCLING')
 
-    # If a Stateful instance does no have privateIp persistance gather new privateIp
-    if 'privateIp' not in recycled_instance:
-        endpoint = "aws/ec2/group/{}?accountId={}".format(module.params.get('esg_id'),
-                                                          module.params.get('account_id'))
-        # Gather information about the instance's ESG group to know in which region it is running
-        esg_info = _call_spotinst_api(module, endpoint=endpoint)
+def recycle_status(module):
+    """Check on recycles requested without waiting, listing stateful instances once per Elastigroup."""
+    jobs = module.params.get('jobs')
+    for job in jobs:
+        if not isinstance(job, dict) or 'esg_id' not in job or 'stateful_instance_id' not in job:
+            module.fail_json(msg="Every item of jobs must be a job returned by a recycle with wait=false")
 
-        # Get the first instance found
-        ec2 = _get_instances_by_region(module, region=[esg_info['response']['items'][0]['region']], ids=[recycled_instance['instanceId']])[0]
+    groups = dict((job['esg_id'], _get_group(module, job['esg_id'])) for job in jobs)
+    metrics = get_module_client(module).metrics
+    try:
+        statuses = poll_jobs(groups, jobs, int(module.params.get('wait_timeout')))
+    except (SpotinstApiError, SpotinstStatefulError) as e:
+        module.fail_json(msg=str(e), metrics=export_module_metrics(module, metrics))
+    except (BotoCoreError, ClientError) as e:
+        # The new private IP of a finished job could not be looked up in EC2
+        module.fail_json(msg="Unable to look up recycled instances in EC2: {}".format(e),
+                         exception=traceback.format_exc(), metrics=export_module_metrics(module, metrics),
+                         **camel_dict_to_snake_dict(getattr(e, 'response', {})))
+
+    result = dict(
+        changed=False,
+        jobs=statuses,
+        finished=all(status['finished'] for status in statuses),
+        metrics=export_module_metrics(module, metrics),
+    )
 
-        # Append privateIp to the Spotinst instance object
-        recycled_instance.update(
-            {'privateIp': ec2['PrivateIpAddress']}
-        )
+    failed = [status['stateful_instance_id'] for status in statuses if status['failed']]
+    if failed:
+        module.fail_json(msg="{} stateful instance(s) could not be recycled: {}".format(len(failed), ', '.join(failed)),
+                         **result)
 
-    _return_result(module=module, changed=True, failed=False, message=recycled_instance)
+    module.exit_json(**result)
 
 
 def main():
@@ -240,16 +456,38 @@ def main():
     argument_spec = ec2_argument_spec()
 
     argument_spec.update(dict(
-        api_token=dict(required=True, type='str'),
+        api_token=dict(required=True, type='str', no_log=True),
+        api_url=dict(required=False, type='str', default='https://api.spotinst.io'),
+        api_rate_limit=dict(required=False, type='float', default=0),
+        api_max_retries=dict(required=False, type='int', default=3),
         account_id=dict(required=True, type='str'),
-        esg_id=dict(required=True, type='str'),
-        stateful_instance_id=dict(required=True, type='str'),
-        state=dict(required=False, choices=['recycled'], default='recycled'),
-        wait_timeout=dict(required=False, default=600)
+        esg_id=dict(required=False, type='str'),
+        stateful_instance_id=dict(required=False, type='str'),
+        stateful_instance_ids=dict(required=False, type='list'),
+        max_in_flight=dict(required=False, type='int', default=1),
+        state=dict(required=False, choices=['recycled', 'status'], default='recycled'),
+        wait=dict(required=False, type='bool', default=True),
+        jobs=dict(required=False, type='list'),
+        wait_timeout=dict(required=False, default=600),
+        poll_min_interval=dict(required=False, type='int', default=2),
+        poll_max_interval=dict(required=False, type='int', default=20),
+        metadata_cache_ttl=dict(required=False, type='int', default=3600),
+        poll_cache_ttl=dict(required=False, type='int', default=2),
+        cache_dir=dict(required=False, type='str', default='~/.ansible/cache/spotinst'),
+        metrics_sink=dict(required=False, type='str'),
+        watch_address=dict(required=False, type='str'),
+        watch_max_age=dict(required=False, type='int', default=15)
     )),
 
     module = AnsibleModule(
         argument_spec=argument_spec,
+        required_if=[
+            ('state', 'recycled', ['stateful_instance_id', 'stateful_instance_ids'], True),
+            ('state', 'status', ['jobs']),
+        ],
+        mutually_exclusive=[
+            ['stateful_instance_id', 'stateful_instance_ids'],
+        ],
     )
 
     if not HAS_BOTO3:
@@ -257,8 +495,14 @@ def main():
 
     state = module.params.get('state')
 
-    if state == 'recycled':
+    if state == 'recycled' and module.params.get('stateful_instance_ids') is not None:
+        recycle_batch(module)
+    elif state == 'recycled':
+        if not module.params.get('esg_id'):
+            module.fail_json(msg="esg_id is required to recycle stateful_instance_id")
         recycle_elastigroup(module)
+    elif state == 'status':
+        recycle_status(module)
 
 if __name__ == '__main__':
     main()
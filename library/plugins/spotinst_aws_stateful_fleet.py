@@ -0,0 +1,363 @@
+#!/usr/bin/python
+
+"""Ansible spotinst_aws_stateful_fleet module."""
+
+# This module is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This module is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+
+
+ANSIBLE_METADATA = {'metadata_version': '1.0',
+                    'status': ['preview'],
+                    'supported_by': 'community'}
+
+DOCUMENTATION = '''
+---
+module: spotinst_aws_stateful_fleet
+version_added: "2.7"
+short_description: Recycle Stateful Spotinst Elastigroups in parallel.
+description:
+    - A module to recycle the stateful instances of many Spotinst Elastigroups at once using Spotinst API.
+    - Instances of a same Elastigroup are recycled C(max_in_flight) at a time, in order, while different Elastigroups
+      are recycled in parallel up to C(max_concurrency) instances overall.
+    - Each instance goes through its own state machine (QUEUED, WAITING_ACTIVE, READY, RECYCLING, LOOKING_UP_IP,
+      CHECKING_PORTS, CHECKING_READINESS, DONE). When a recycle FAILED, the remaining instances of its Elastigroup are
+      SKIPPED.
+options:
+    api_token:
+        required: true
+        description:
+            - (String) Spotinst API token
+
+    api_url:
+        required: false
+        default: https://api.spotinst.io
+        description:
+            - (String) Spotinst API base URL
+
+    api_rate_limit:
+        required: false
+        default: 0
+        description:
+            - (Float) Maximum number of Spotinst API requests per second and per account made by the module, 0 for
+              no limit
+
+    api_max_retries:
+        required: false
+        default: 3
+        description:
+            - (Integer) Number of times a throttled (HTTP 429) or failed Spotinst API request is retried, with
+              exponential backoff or as told by the C(Retry-After) header. Only GET requests are retried on
+              server errors and timeouts
+
+    account_id:
+        required: true
+        description:
+            - (String) Spotinst account id with format act-xxx. (Example act-12345)
+
+    groups:
+        required: true
+        description:
+            - (List) Elastigroups to recycle. Each item is a dictionary with an C(esg_id), an optional list of
+              C(stateful_instance_ids) to recycle (defaults to every stateful instance of the Elastigroup) and an
+              optional C(max_in_flight) overriding the module one. An optional C(region) overrides the module one.
+
+    max_in_flight:
+        required: false
+        default: 1
+        description:
+            - (Integer) Maximum number of instances recycled at once within an Elastigroup
+
+    max_concurrency:
+        required: false
+        default: 10
+        description:
+            - (Integer) Maximum number of instances recycled at once across all Elastigroups
+
+    pipeline:
+        required: false
+        default: false
+        description:
+            - (Boolean) Prepare the next recycle of an Elastigroup while the previous one is still in progress, its
+              instance is checked ACTIVE and its region and EC2 client are resolved beforehand. It is then requested
+              as soon as the previous one is DONE (C(check_ports) and C(check_jolokia) included), after a single poll
+              confirming it is still ACTIVE. Never more than C(max_in_flight) instances of an Elastigroup are recycled
+              at once
+            - Open ports do not mean a Kafka broker is back in sync, set C(check_jolokia) so that the next broker is
+              only recycled once no partition is under-replicated
+
+    check_ports:
+        required: false
+        default: []
+        description:
+            - (List) TCP ports that must accept connections on a recycled instance before moving on to the next one
+
+    check_jolokia:
+        required: false
+        description:
+            - (Dict) JMX attribute read through Jolokia that must have an expected value on a recycled instance, once
+              its C(check_ports) are open, before moving on to the next one. Same format as the C(jolokia) option of
+              C(spotinst_readiness), with a C(port), an C(endpoint), an C(expect)ed value and an optional C(attribute)
+
+    check_timeout:
+        required: false
+        default: 300
+        description:
+            - (Integer) Number of seconds to wait for C(check_ports), then for C(check_jolokia)
+
+    wait_timeout:
+        required: false
+        default: 600
+        description:
+            - (Integer) Number of seconds to wait for each state transition of an instance
+
+    poll_min_interval:
+        required: false
+        default: 2
+        description:
+            - (Integer) Minimum number of seconds between two polls of a stateful instance state
+
+    poll_max_interval:
+        required: false
+        default: 20
+        description:
+            - (Integer) Maximum number of seconds between two polls of a stateful instance state
+
+    region:
+        required: false
+        description:
+            - (String) AWS region of the Elastigroup(s), C(spotinst_region) hostvar of the C(spotinst_esg) inventory.
+              Fetched from Spotinst API (then cached in C(cache_dir)) when not given
+
+    metadata_cache_ttl:
+        required: false
+        default: 3600
+        description:
+            - (Integer) Number of seconds Elastigroups metadata (name and region) stays cached on disk, shared by every
+              fork. Set to 0 to disable the cache
+
+    poll_cache_ttl:
+        required: false
+        default: 2
+        description:
+            - (Integer) Number of seconds a polled list of stateful instances stays fresh in the on disk cache. Forks
+              polling the same Elastigroup share it, one of them refreshes the list while the others wait for it.
+              Set to 0 to disable the cache
+
+    cache_dir:
+        required: false
+        default: ~/.ansible/cache/spotinst
+        description:
+            - (String) Directory of the on disk cache
+
+    metrics_sink:
+        required: false
+        description:
+            - (String) Where to export the module C(metrics) besides its result, C(statsd://host:port) for a StatsD
+              daemon (over UDP, with DogStatsD tags), a path ending with C(.prom) for a Prometheus text file (Example
+              the node exporter textfile collector directory) or any other path for a JSON file
+
+    watch_address:
+        required: false
+        description:
+            - (String) Address of a C(spotinst-esg-watch) daemon watching the account, C(unix://<path>) or
+              C(http://<host>:<port>). Stateful instances are then listed from its snapshot, without any Spotinst API
+              call, as long as it is fresh
+
+    watch_max_age:
+        required: false
+        default: 15
+        description:
+            - (Integer) Number of seconds after which the C(watch_address) snapshot is ignored and Spotinst API is
+              polled instead
+'''
+
+EXAMPLES = '''
+# Roll a new AMI on every Kafka cluster at once, one broker at a time per cluster
+
+- name: Recycle Kafka ESGs
+  spotinst_aws_stateful_fleet:
+    account_id: act-123
+    api_token: "{{ lookup('env', 'SPOTINST_API_TOKEN' )}}"
+    groups:
+      - esg_id: sig-1234
+      - esg_id: sig-5678
+        stateful_instance_ids: [ssi-1234, ssi-5678]
+    max_concurrency: 10
+    pipeline: true
+    check_ports: [22, 9092]
+    check_jolokia:
+      port: 8778
+      endpoint: kafka.server:type=ReplicaManager,name=UnderReplicatedPartitions
+      expect: 0
+  register: __recycled
+'''
+
+RETURN = '''
+recycled:
+    description: Outcome of every stateful instance recycle.
+    returned: always
+    type: list
+    sample: [{"esg_id": "sig-1234", "stateful_instance_id": "ssi-1234", "state": "DONE", "changed": true, "msg": null,
+              "stateful": {"id": "ssi-1234", "instanceId": "i-1234", "privateIp": "10.201.x.y", "state": "ACTIVE"},
+              "timings": {"QUEUED": 0.0, "WAITING_ACTIVE": 1.2, "RECYCLING": 312.5, "CHECKING_PORTS": 20.1,
+                          "CHECKING_READINESS": 95.7}}]
+metrics:
+    description: API calls per endpoint and status, latency histograms, retries, bytes received, polls and time spent in
+                 each recycle state.
+    returned: always
+    type: dict
+    sample: {'counters': {'api_requests{endpoint="aws/ec2/group/{esg_id}/statefulInstance",method="GET",status="200"}': 12,
+                          'recycle_polls{state="RECYCLING"}': 10},
+             'histograms': {'recycle_state_seconds{state="RECYCLING"}': {'count': 1, 'sum': 312.5, 'min': 312.5,
+                                                                         'max': 312.5, 'buckets': {'600': 1}}}}
+'''
+
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.ec2 import ec2_argument_spec
+from ansible.module_utils.spotinst_api import SpotinstApiError, get_module_client
+from ansible.module_utils.spotinst_aws import get_connection_factory
+from ansible.module_utils.spotinst_cache import get_module_cache
+from ansible.module_utils.spotinst_metrics import export_module_metrics
+from ansible.module_utils.spotinst_readiness import get_jolokia_check, wait_for_jolokia
+from ansible.module_utils.spotinst_stateful import FleetRecycle, StatefulGroup, StatefulRecycle
+from ansible.module_utils.spotinst_watch import get_module_snapshot
+
+
+try:
+    import boto3
+    HAS_BOTO3 = True
+except ImportError:
+    HAS_BOTO3 = False
+
+
+def _get_readiness(module):
+    """Get the readiness gate of recycled instances from the check_jolokia option, None without it."""
+    jolokia = module.params.get('check_jolokia')
+    if not jolokia:
+        return None
+
+    def readiness(host):
+        wait_for_jolokia(host, jolokia, module.params.get('check_timeout'))
+
+    return readiness
+
+
+def _get_recycles(module):
+    """Build a StatefulRecycle for every stateful instance to recycle."""
+    client = get_module_client(module)
+    readiness = _get_readiness(module)
+    ec2_connection = get_connection_factory(module)
+    metadata_cache = get_module_cache(module)
+    poll_cache = get_module_cache(module, 'poll_cache_ttl')
+    snapshot = get_module_snapshot(module)
+
+    recycles = []
+    for item in module.params.get('groups'):
+        group = StatefulGroup(client, module.params.get('account_id'), item['esg_id'], ec2_connection=ec2_connection,
+                              region=item.get('region') or module.params.get('region'), metadata_cache=metadata_cache,
+                              poll_cache=poll_cache, snapshot=snapshot)
+
+        ssis = item.get('stateful_instance_ids')
+        if not ssis:
+            ssis = [instance['id'] for instance in group.list_instances()]
+
+        for ssi in ssis:
+            recycles.append(StatefulRecycle(group, ssi,
+                                            wait_timeout=int(module.params.get('wait_timeout')),
+                                            poll_min_interval=module.params.get('poll_min_interval'),
+                                            poll_max_interval=module.params.get('poll_max_interval'),
+                                            check_ports=module.params.get('check_ports'),
+                                            check_timeout=module.params.get('check_timeout'),
+                                            readiness=readiness,
+                                            metrics=client.metrics))
+    return recycles
+
+
+def recycle_fleet(module):
+    """Recycle the stateful instances of every Elastigroup."""
+    try:
+        recycles = _get_recycles(module)
+    except SpotinstApiError as e:
+        module.fail_json(msg=str(e), metrics=export_module_metrics(module, get_module_client(module).metrics))
+
+    group_max_in_flight = dict((item['esg_id'], item.get('max_in_flight')) for item in module.params.get('groups'))
+    FleetRecycle(recycles,
+                 max_concurrency=module.params.get('max_concurrency'),
+                 max_in_flight=module.params.get('max_in_flight'),
+                 group_max_in_flight=group_max_in_flight,
+                 pipeline=module.params.get('pipeline')).run()
+
+    result = dict(
+        recycled=[recycle.to_dict() for recycle in recycles],
+        changed=any(recycle.requested for recycle in recycles),
+        metrics=export_module_metrics(module, get_module_client(module).metrics),
+    )
+
+    failed = [recycle for recycle in recycles if recycle.state == StatefulRecycle.FAILED]
+    if failed:
+        module.fail_json(msg="{} stateful instance(s) could not be recycled: {}".format(
+            len(failed), ', '.join(recycle.ssi for recycle in failed)), **result)
+
+    module.exit_json(**result)
+
+
+def main():
+    """Module entrypoint."""
+    argument_spec = ec2_argument_spec()
+
+    argument_spec.update(dict(
+        api_token=dict(required=True, type='str', no_log=True),
+        api_url=dict(required=False, type='str', default='https://api.spotinst.io'),
+        api_rate_limit=dict(required=False, type='float', default=0),
+        api_max_retries=dict(required=False, type='int', default=3),
+        account_id=dict(required=True, type='str'),
+        groups=dict(required=True, type='list'),
+        max_in_flight=dict(required=False, type='int', default=1),
+        max_concurrency=dict(required=False, type='int', default=10),
+        pipeline=dict(required=False, type='bool', default=False),
+        check_ports=dict(required=False, type='list', default=[]),
+        check_jolokia=dict(required=False, type='dict'),
+        check_timeout=dict(required=False, type='int', default=300),
+        wait_timeout=dict(required=False, type='int', default=600),
+        poll_min_interval=dict(required=False, type='int', default=2),
+        poll_max_interval=dict(required=False, type='int', default=20),
+        metadata_cache_ttl=dict(required=False, type='int', default=3600),
+        poll_cache_ttl=dict(required=False, type='int', default=2),
+        cache_dir=dict(required=False, type='str', default='~/.ansible/cache/spotinst'),
+        metrics_sink=dict(required=False, type='str'),
+        watch_address=dict(required=False, type='str'),
+        watch_max_age=dict(required=False, type='int', default=15)
+    ))
+
+    module = AnsibleModule(
+        argument_spec=argument_spec,
+    )
+
+    if not HAS_BOTO3:
+        module.fail_json(msg='boto3 required for this module')
+
+    for item in module.params.get('groups'):
+        if not isinstance(item, dict) or 'esg_id' not in item:
+            module.fail_json(msg="Every item of groups must be a dictionary with an esg_id")
+
+    if module.params.get('check_jolokia'):
+        try:
+            get_jolokia_check('localhost', module.params.get('check_jolokia'))
+        except ValueError as e:
+            module.fail_json(msg="check_jolokia: {}".format(e))
+
+    recycle_fleet(module)
+
+
+if __name__ == '__main__':
+    main()
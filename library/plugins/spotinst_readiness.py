@@ -0,0 +1,177 @@
+#!/usr/bin/python
+
+"""Ansible spotinst_readiness module."""
+
+# This module is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This module is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+
+
+ANSIBLE_METADATA = {'metadata_version': '1.0',
+                    'status': ['preview'],
+                    'supported_by': 'community'}
+
+DOCUMENTATION = '''
+---
+module: spotinst_readiness
+version_added: "2.7"
+short_description: Wait for a recycled instance to be ready.
+description:
+    - A module waiting for TCP ports to accept connections and a JMX attribute read through Jolokia to have an
+      expected value, on a freshly recycled stateful instance.
+    - Every condition is probed at once, each with its own exponential backoff (with jitter) from
+      C(poll_min_interval) to C(poll_max_interval). The module returns as soon as the last condition holds and reports
+      how long each of them took.
+options:
+    host:
+        required: true
+        description:
+            - (String) Host to check, usually the C(stateful.privateIp) returned by C(spotinst_aws_stateful)
+
+    ports:
+        required: false
+        default: []
+        description:
+            - (List) TCP ports that must accept connections
+
+    jolokia:
+        required: false
+        description:
+            - (Dict) JMX attribute read through Jolokia that must have an expected value, with a C(port), an
+              C(endpoint) (the MBean read, Example C(kafka.server:type=ReplicaManager,name=UnderReplicatedPartitions)),
+              an C(expect)ed value and an optional C(attribute) of the read value to compare (defaults to C(Value)).
+              An optional C(type) must be C(jolokia).
+
+    timeout:
+        required: false
+        default: 600
+        description:
+            - (Integer) Number of seconds to wait for every condition to hold
+
+    connect_timeout:
+        required: false
+        default: 5
+        description:
+            - (Integer) Number of seconds a single probe (TCP connection or Jolokia request) may take
+
+    poll_min_interval:
+        required: false
+        default: 1
+        description:
+            - (Integer) Minimum number of seconds between two probes of a condition
+
+    poll_max_interval:
+        required: false
+        default: 10
+        description:
+            - (Integer) Maximum number of seconds between two probes of a condition
+'''
+
+EXAMPLES = '''
+# Wait for a recycled Kafka broker to be back in sync
+
+- name: Wait for Kafka broker readiness
+  spotinst_readiness:
+    host: "{{ __spotinst_recycled_instance.stateful.privateIp }}"
+    ports: [22, 9092]
+    jolokia:
+      port: 8778
+      endpoint: kafka.server:type=ReplicaManager,name=UnderReplicatedPartitions
+      expect: 0
+  delegate_to: localhost
+'''
+
+RETURN = '''
+checks:
+    description: Outcome of every condition, elapsed is the number of seconds it took to hold.
+    returned: always
+    type: list
+    sample: [{"name": "port 9092", "ready": true, "attempts": 12, "elapsed": 41.2, "msg": null},
+             {"name": "jolokia kafka.server:type=ReplicaManager,name=UnderReplicatedPartitions", "ready": true,
+              "attempts": 15, "elapsed": 95.7, "msg": null, "value": 0}]
+elapsed:
+    description: Number of seconds waited.
+    returned: always
+    type: float
+'''
+
+import time
+
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.spotinst_readiness import PortCheck, get_jolokia_check, wait_until_ready
+
+
+def _get_checks(module):
+    """Build a check for every port and for the Jolokia attribute."""
+    host = module.params.get('host')
+    connect_timeout = module.params.get('connect_timeout')
+
+    checks = []
+    for port in module.params.get('ports'):
+        # The same port may be listed twice, for instance the Jolokia one
+        if int(port) not in [check.port for check in checks]:
+            checks.append(PortCheck(host, port, timeout=connect_timeout))
+
+    jolokia = module.params.get('jolokia')
+    if jolokia:
+        try:
+            checks.append(get_jolokia_check(host, jolokia, timeout=connect_timeout))
+        except ValueError as e:
+            module.fail_json(msg=str(e))
+    return checks
+
+
+def wait_for_readiness(module):
+    """Wait for every condition to hold on the host."""
+    checks = _get_checks(module)
+
+    start = time.time()
+    wait_until_ready(checks, module.params.get('timeout'),
+                     min_interval=module.params.get('poll_min_interval'),
+                     max_interval=module.params.get('poll_max_interval'))
+
+    result = dict(
+        changed=False,
+        checks=[check.to_dict() for check in checks],
+        elapsed=round(time.time() - start, 3),
+    )
+
+    pending = [check for check in checks if not check.ready]
+    if pending:
+        module.fail_json(msg="{} is still not ready after {}s: {}".format(
+            module.params.get('host'), module.params.get('timeout'), '; '.join(check.msg for check in pending)), **result)
+
+    module.exit_json(**result)
+
+
+def main():
+    """Module entrypoint."""
+    argument_spec = dict(
+        host=dict(required=True, type='str'),
+        ports=dict(required=False, type='list', default=[]),
+        jolokia=dict(required=False, type='dict'),
+        timeout=dict(required=False, type='int', default=600),
+        connect_timeout=dict(required=False, type='int', default=5),
+        poll_min_interval=dict(required=False, type='int', default=1),
+        poll_max_interval=dict(required=False, type='int', default=10)
+    )
+
+    module = AnsibleModule(
+        argument_spec=argument_spec,
+        supports_check_mode=True,
+    )
+
+    wait_for_readiness(module)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,575 @@
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+"""Spotinst API client shared by the spotinst modules and inventory plugin."""
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import codecs
+import gzip
+import io
+import json
+import random
+import re
+import socket
+import ssl
+import threading
+import time
+import zlib
+
+from email.utils import mktime_tz, parsedate_tz
+
+from ansible.module_utils._text import to_bytes, to_text
+from ansible.module_utils.six.moves import http_client
+from ansible.module_utils.six.moves.urllib.parse import parse_qs, urlsplit
+from ansible.module_utils.six.moves.urllib.request import getproxies, proxy_bypass
+from ansible.module_utils.spotinst_metrics import Metrics, endpoint_label
+
+
+SPOTINST_API = "https://api.spotinst.io"
+
+# Errors raised when a kept-alive connection was closed by the server while idle in the pool
+STALE_CONNECTION_ERRORS = (http_client.BadStatusLine, http_client.CannotSendRequest, socket.error)
+
+# Raised (python 3 only) when the server closed the connection without sending any byte of response
+RemoteDisconnected = getattr(http_client, 'RemoteDisconnected', None)
+
+# Server errors worth retrying for requests that can safely be sent again
+RETRY_STATUSES = (500, 502, 503, 504)
+
+
+def is_closed_before_response(e):
+    """Tell whether a request failed because the server closed the connection before sending any byte of response."""
+    if RemoteDisconnected is not None and isinstance(e, RemoteDisconnected):
+        return True
+    # python 2 raises BadStatusLine with an empty line instead, which it stores as its repr
+    return type(e) is http_client.BadStatusLine and e.line in ('', repr(''))
+
+
+class SpotinstApiError(Exception):
+    """Raised when Spotinst API answers with an error or cannot be reached."""
+
+    def __init__(self, message, status=None, body=None):
+        super(SpotinstApiError, self).__init__(message)
+        self.status = status
+        self.body = body
+
+
+_WHITESPACE = re.compile(r'\s*')
+_DELIMITERS = frozenset(u' \t\r\n,:]}')
+
+
+class JsonItemsReader(object):
+    """Incremental parser of the items of a Spotinst API response.
+
+    Spotinst API answers with {"request": {...}, "response": {"status": {...}, "items": [...], "count": N}}. Items
+    are decoded one at a time while the response is read by chunks, so that the whole document is never held in
+    memory, however many items it has.
+    """
+
+    def __init__(self, read, chunk_size=65536):
+        """
+        :param read: A callable(size) returning the next bytes of the document, empty at its end
+        :param chunk_size: The number of bytes read at once
+        """
+        self._read = read
+        self._chunk_size = chunk_size
+        self._json_decoder = json.JSONDecoder()
+        self._text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self._buffer = u''
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self):
+        """Read the next chunk, dropping what was already parsed, False at the end of the document."""
+        if self._eof:
+            return False
+        chunk = self._read(self._chunk_size)
+        self._eof = not chunk
+        self._buffer = self._buffer[self._pos:] + self._text_decoder.decode(chunk, final=self._eof)
+        self._pos = 0
+        return True
+
+    def _skip_whitespace(self):
+        while True:
+            self._pos = _WHITESPACE.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer) or not self._fill():
+                return
+
+    def _next_char(self, expected):
+        self._skip_whitespace()
+        if self._pos >= len(self._buffer):
+            raise ValueError("Unexpected end of JSON document")
+        char = self._buffer[self._pos]
+        if char not in expected:
+            raise ValueError("Expected one of '{}' but got '{}'".format(expected, char))
+        self._pos += 1
+        return char
+
+    def _peek(self, char):
+        """Consume char if it is the next non whitespace character."""
+        self._skip_whitespace()
+        if self._buffer[self._pos:self._pos + 1] == char:
+            self._pos += 1
+            return True
+        return False
+
+    def _value(self):
+        self._skip_whitespace()
+        while True:
+            try:
+                value, end = self._json_decoder.raw_decode(self._buffer, self._pos)
+                # A value cut by the end of the buffer (a number such as 1.5e3 read as 1.) goes on in the next chunk,
+                # a complete value is always followed by a delimiter
+                if self._eof or self._buffer[end:end + 1] in _DELIMITERS:
+                    self._pos = end
+                    return value
+            except ValueError:
+                if self._eof:
+                    raise
+            self._fill()
+
+    def _array(self):
+        self._next_char('[')
+        if self._peek(']'):
+            return
+        while True:
+            yield self._value()
+            if self._next_char(',]') == ']':
+                return
+
+    def _object(self, path):
+        self._next_char('{')
+        if self._peek('}'):
+            return
+        while True:
+            key = self._value()
+            self._next_char(':')
+            if key == path[0]:
+                items = self._array() if len(path) == 1 else self._object(path[1:])
+                for item in items:
+                    yield item
+                # Whatever follows the items is not needed
+                return
+            self._value()
+            if self._next_char(',}') == '}':
+                return
+
+    def items(self, path=('response', 'items')):
+        """Yield the items of the array found at path, nothing when there is none."""
+        return self._object(path)
+
+
+class TokenBucket(object):
+    """Rate limiter allowing rate calls per second on average, in bursts of up to burst calls."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst or max(1, rate))
+        self.tokens = self.capacity
+        self.updated = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token, sleeping until it is available. Callers are served in order."""
+        with self._lock:
+            now = time.time()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Tokens may go below zero, each caller then waits for the ones reserved before its own
+            self.tokens -= 1
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+class _InFlight(object):
+    """A request whose response is shared with the identical requests made meanwhile."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+def _retry_after(response):
+    """Number of seconds to wait according to the Retry-After header of a response, None when missing."""
+    value = response.getheader('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        date = parsedate_tz(value)
+        return max(0.0, mktime_tz(date) - time.time()) if date else None
+
+
+def _gunzip(read):
+    """Wrap a read callable to decompress a gzip stream on the fly."""
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def gunzip(size):
+        while True:
+            # JSON compresses well, output is bounded to size and the input left over is decompressed on next calls
+            chunk = decompressor.unconsumed_tail or read(size)
+            if not chunk:
+                return decompressor.flush()
+            data = decompressor.decompress(chunk, size)
+            # The gzip header alone decompresses to nothing, keep reading to not be mistaken for the end
+            if data:
+                return data
+
+    return gunzip
+
+
+class SpotinstClient(object):
+    """Spotinst API client reusing keep-alive connections.
+
+    Every request used to go through open_url, paying a new TCP and TLS handshake to Spotinst. Connections
+    are instead kept in a small pool and reused by subsequent requests, from any thread.
+
+    Requests are also scheduled to play well with Spotinst rate limits: they go through a token bucket per account,
+    throttled or failed ones are retried with backoff, and identical GETs in flight at the same time share a single
+    response.
+
+    Calls, latencies, retries and bytes received are recorded per endpoint in metrics.
+    """
+
+    def __init__(self, api_token, api_url=SPOTINST_API, validate_certs=True, timeout=30, pool_size=10,
+                 rate_limit=0, max_retries=3, backoff=1, max_backoff=30, metrics=None):
+        """
+        :param api_token: The Spotinst API token
+        :param api_url: The Spotinst API base URL
+        :param validate_certs: Whether to validate the API TLS certificate
+        :param timeout: The socket timeout in seconds
+        :param pool_size: The maximum number of idle connections kept open
+        :param rate_limit: The maximum number of requests per second and per account, 0 for no limit
+        :param max_retries: The number of times a throttled or failed request is retried
+        :param backoff: The number of seconds to wait before the first retry, doubled on every retry
+        :param max_backoff: The maximum number of seconds to wait between two retries, unless told by Retry-After
+        :param metrics: The Metrics recording API calls, a new one by default
+        """
+        url = urlsplit(api_url)
+        self.scheme = url.scheme
+        self.host = url.hostname
+        self.port = url.port
+        self.base_path = url.path.rstrip('/')
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.rate_limit = rate_limit
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.metrics = metrics if metrics is not None else Metrics()
+
+        self.headers = {
+            "Content-Type": "application/json",
+            "Accept-Encoding": "gzip",
+            "Authorization": "Bearer {}".format(api_token)
+        }
+
+        self._ssl_context = None
+        if self.scheme == 'https':
+            self._ssl_context = ssl.create_default_context()
+            if not validate_certs:
+                self._ssl_context.check_hostname = False
+                self._ssl_context.verify_mode = ssl.CERT_NONE
+
+        self._proxy = None
+        if not proxy_bypass(self.host):
+            self._proxy = getproxies().get(self.scheme)
+
+        self._lock = threading.Lock()
+        self._pool = []
+        self._buckets = {}
+        self._in_flight = {}
+        # Number of connections opened so far, each of them costs a TCP (and TLS) handshake
+        self.connections_opened = 0
+        # Number of requests sent again after a throttling or a failure
+        self.retries = 0
+        # Number of requests answered with the response of an identical request in flight
+        self.coalesced = 0
+
+    def _new_connection(self):
+        host, port = self.host, self.port
+        if self._proxy:
+            proxy = urlsplit(self._proxy)
+            host, port = proxy.hostname, proxy.port
+
+        if self.scheme == 'https':
+            connection = http_client.HTTPSConnection(host, port, timeout=self.timeout, context=self._ssl_context)
+        else:
+            connection = http_client.HTTPConnection(host, port, timeout=self.timeout)
+
+        if self._proxy:
+            connection.set_tunnel(self.host, self.port)
+
+        with self._lock:
+            self.connections_opened += 1
+        self.metrics.incr('api_connections_opened')
+        return connection
+
+    def _acquire(self):
+        """Get an idle connection from the pool, the boolean tells whether it was reused."""
+        with self._lock:
+            if self._pool:
+                return self._pool.pop(), True
+        return self._new_connection(), False
+
+    def _release(self, connection):
+        with self._lock:
+            if len(self._pool) < self.pool_size:
+                self._pool.append(connection)
+                return
+        connection.close()
+
+    def _open(self, endpoint, method, data):
+        """Send a request and return the connection along with its response, whose body is still to be read."""
+        path = "{}/{}".format(self.base_path, endpoint.lstrip('/'))
+        # Bytes bodies are sent along with the headers in a single segment
+        body = to_bytes(json.dumps(data)) if data is not None else None
+
+        connection, reused = self._acquire()
+        sent = False
+        try:
+            try:
+                connection.request(method, path, body=body, headers=self.headers)
+                sent = True
+                response = connection.getresponse()
+            except STALE_CONNECTION_ERRORS as e:
+                if not reused or isinstance(e, socket.timeout):
+                    raise
+                # Once sent, a request other than a GET may have been processed before the connection broke (a recycle
+                # must not run twice), unless the server closed the idle connection without answering it at all
+                if sent and method != 'GET' and not is_closed_before_response(e):
+                    raise
+                connection.close()
+                connection = self._new_connection()
+                connection.request(method, path, body=body, headers=self.headers)
+                response = connection.getresponse()
+        except (http_client.HTTPException, socket.error) as e:
+            connection.close()
+            raise SpotinstApiError("Unable to reach Spotinst API ({} {}): {}".format(method, endpoint, e))
+        return connection, response
+
+    def _get_bucket(self, endpoint):
+        """Get the token bucket of the account an endpoint targets, None without rate limit."""
+        if not self.rate_limit:
+            return None
+        account_id = parse_qs(urlsplit(endpoint).query).get('accountId', [None])[0]
+        with self._lock:
+            if account_id not in self._buckets:
+                self._buckets[account_id] = TokenBucket(self.rate_limit)
+            return self._buckets[account_id]
+
+    def _call(self, endpoint, method, data):
+        """Send a request once the rate limit allows it, retrying it when throttled or failed.
+
+        Throttled requests (HTTP 429) were not processed by Spotinst and are always retried. Server errors and
+        network failures are only retried for GET requests, an operation such as a recycle must not run twice.
+        """
+        bucket = self._get_bucket(endpoint)
+        label = endpoint_label(endpoint)
+        attempt = 0
+        while True:
+            if bucket is not None:
+                with self.metrics.timer('api_rate_limit_wait_seconds', endpoint=label):
+                    bucket.acquire()
+
+            delay = None
+            start = time.time()
+            try:
+                connection, response = self._open(endpoint, method, data)
+            except SpotinstApiError:
+                self.metrics.incr('api_requests', method=method, endpoint=label, status='error')
+                if method != 'GET' or attempt >= self.max_retries:
+                    raise
+            else:
+                # Time to the response headers, the body is read by the caller
+                self.metrics.observe('api_request_seconds', time.time() - start, method=method, endpoint=label)
+                self.metrics.incr('api_requests', method=method, endpoint=label, status=response.status)
+                retry = response.status == 429 or (method == 'GET' and response.status in RETRY_STATUSES)
+                if not retry or attempt >= self.max_retries:
+                    return connection, response
+                delay = _retry_after(response)
+                self._discard(connection, response)
+
+            attempt += 1
+            if delay is None:
+                # Exponential backoff with jitter so that throttled clients do not retry in lockstep
+                delay = random.uniform(0.5, 1) * min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+            with self._lock:
+                self.retries += 1
+            self.metrics.incr('api_retries', method=method, endpoint=label)
+            time.sleep(delay)
+
+    def _discard(self, connection, response):
+        """Read and drop the body of a response for its connection to be reused."""
+        try:
+            response.read()
+        except (http_client.HTTPException, socket.error):
+            connection.close()
+        else:
+            self._done(connection, response)
+
+    def _coalesce(self, key, func):
+        """Call func, unless an identical call is already in flight in another thread: its result is then shared."""
+        with self._lock:
+            call = self._in_flight.get(key)
+            leader = call is None
+            if leader:
+                call = self._in_flight[key] = _InFlight()
+            else:
+                self.coalesced += 1
+                self.metrics.incr('api_coalesced', endpoint=endpoint_label(key))
+
+        if leader:
+            try:
+                call.result = func()
+            except Exception as e:
+                call.error = e
+            finally:
+                with self._lock:
+                    del self._in_flight[key]
+                call.done.set()
+        else:
+            call.done.wait()
+
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def _fetch(self, endpoint, method, data):
+        connection, response = self._call(endpoint, method, data)
+        return response.status, self._read(connection, response, method, endpoint)
+
+    def _read(self, connection, response, method, endpoint):
+        """Read the whole body of a response and give the connection back to the pool."""
+        try:
+            content = response.read()
+        except (http_client.HTTPException, socket.error) as e:
+            connection.close()
+            raise SpotinstApiError("Unable to reach Spotinst API ({} {}): {}".format(method, endpoint, e))
+
+        self._done(connection, response)
+        self.metrics.incr('api_bytes_received', len(content), endpoint=endpoint_label(endpoint))
+
+        if response.getheader('Content-Encoding', '').lower() == 'gzip':
+            content = gzip.GzipFile(fileobj=io.BytesIO(content)).read()
+
+        if response.status >= 400:
+            raise SpotinstApiError("Spotinst API returned HTTP {} for {} {}: {}".format(response.status, method, endpoint, to_text(content)),
+                                   status=response.status, body=content)
+        return content
+
+    def _done(self, connection, response):
+        if response.will_close:
+            connection.close()
+        else:
+            self._release(connection)
+
+    def request(self, endpoint, method='GET', data=None):
+        """Call Spotinst API and return the decoded JSON response.
+
+        :param endpoint: The API endpoint to call (Example aws/ec2/group?accountId=act-123)
+        :param method: The HTTP method
+        :param data: An optional object sent as JSON body
+        """
+        if method == 'GET':
+            # Raw content is shared, each caller decodes its own copy of the response
+            status, content = self._coalesce(endpoint, lambda: self._fetch(endpoint, method, data))
+        else:
+            status, content = self._fetch(endpoint, method, data)
+
+        try:
+            return json.loads(to_text(content))
+        except ValueError:
+            raise SpotinstApiError("Spotinst API returned an invalid JSON response for {} {}: {}".format(method, endpoint, to_text(content)),
+                                   status=status, body=content)
+
+    def iter_items(self, endpoint, chunk_size=65536):
+        """Call a Spotinst API list endpoint and yield the response items as they are parsed.
+
+        Spotinst list endpoints return the whole collection at once, which can weigh megabytes. The response is
+        read and parsed by chunks instead, so that memory does not grow with the number of items and the first items
+        can be processed while the others are still downloading. The connection is only given back to the pool once
+        every item was consumed.
+
+        :param endpoint: The API endpoint to call (Example aws/ec2/group?accountId=act-123)
+        :param chunk_size: The number of bytes read at once
+        """
+        connection, response = self._call(endpoint, 'GET', None)
+        if response.status >= 400:
+            self._read(connection, response, 'GET', endpoint)
+
+        label = endpoint_label(endpoint)
+
+        def read_raw(size):
+            chunk = response.read(size)
+            self.metrics.incr('api_bytes_received', len(chunk), endpoint=label)
+            return chunk
+
+        read = read_raw
+        if response.getheader('Content-Encoding', '').lower() == 'gzip':
+            read = _gunzip(read_raw)
+
+        completed = False
+        try:
+            try:
+                for item in JsonItemsReader(read, chunk_size=chunk_size).items():
+                    yield item
+                # Drain what follows the items for the connection to be reused
+                while read_raw(chunk_size):
+                    pass
+                completed = True
+            except (http_client.HTTPException, socket.error, zlib.error) as e:
+                raise SpotinstApiError("Unable to reach Spotinst API (GET {}): {}".format(endpoint, e))
+            except ValueError as e:
+                raise SpotinstApiError("Spotinst API returned an invalid JSON response for GET {}: {}".format(endpoint, e),
+                                       status=response.status)
+        finally:
+            if completed:
+                self._done(connection, response)
+            else:
+                # Items were left unread or the response is broken, the connection cannot be reused
+                connection.close()
+
+    def get(self, endpoint):
+        return self.request(endpoint, method='GET')
+
+    def put(self, endpoint, data=None):
+        return self.request(endpoint, method='PUT', data=data)
+
+    def close(self):
+        """Close every idle connection."""
+        with self._lock:
+            pool, self._pool = self._pool, []
+        for connection in pool:
+            connection.close()
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_spotinst_client(api_token, api_url=SPOTINST_API, metrics=None, **kwargs):
+    """Get a process level shared Spotinst API client, see SpotinstClient for parameters.
+
+    metrics is not part of the client identity: the shared client records its calls in the Metrics given last, so that
+    every caller of a same token and URL shares its connection pool.
+    """
+    key = (api_token, api_url, tuple(sorted(kwargs.items())))
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = SpotinstClient(api_token, api_url=api_url, metrics=metrics, **kwargs)
+        elif metrics is not None:
+            _clients[key].metrics = metrics
+        return _clients[key]
+
+
+def get_module_client(module):
+    """Get the shared Spotinst API client configured by the api_* options of a module."""
+    return get_spotinst_client(module.params.get('api_token'),
+                               api_url=module.params.get('api_url'),
+                               rate_limit=module.params.get('api_rate_limit'),
+                               max_retries=module.params.get('api_max_retries'))
@@ -0,0 +1,121 @@
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+"""AWS helpers shared by the spotinst modules and inventory plugin."""
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import hashlib
+import threading
+
+# boto3, botocore and ansible.module_utils.ec2 (which imports boto3 too) are only imported once a client is needed:
+# they take a few hundred milliseconds to load, which a cached inventory or a Spotinst only call never needs.
+
+
+# Error codes returned by AWS once temporary credentials (STS, SSO, instance profile...) have expired
+EXPIRED_CREDENTIALS_ERROR_CODES = ('ExpiredToken', 'ExpiredTokenException', 'RequestExpired')
+
+
+def _credentials_hash(params):
+    """Hash client parameters so that secrets are never kept as cache keys."""
+    digest = hashlib.sha256()
+    for key in sorted(params):
+        digest.update("{}={};".format(key, params[key]).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class ClientCache(object):
+    """Process level cache of boto3 sessions and clients.
+
+    Creating a client loads the endpoint and service models from disk, which costs tens of milliseconds and
+    some memory every time. Clients are thread safe and are reused for any call made with the same profile,
+    region and credentials. Sessions are not thread safe, so clients are always built under a lock.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self._clients = {}
+
+    def _get_session(self, profile):
+        if profile not in self._sessions:
+            import boto3
+            self._sessions[profile] = boto3.session.Session(profile_name=profile)
+        return self._sessions[profile]
+
+    def get_client(self, service, region=None, profile=None, endpoint=None, **params):
+        """Get a cached boto3 client, creating it on first use.
+
+        :param service: The AWS service name (Example ec2)
+        :param region: The AWS region the client targets
+        :param profile: The boto profile to use, None for the default credential chain
+        :param endpoint: An optional endpoint URL
+        :param params: Any other client parameter such as credentials, verify or config
+        """
+        key = (service, profile, region, endpoint, _credentials_hash(params))
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                client = self._get_session(profile).client(service, region_name=region, endpoint_url=endpoint, **params)
+                self._clients[key] = client
+        return client
+
+    def invalidate(self, profile=None):
+        """Drop the cached session and clients of a profile, forcing credentials to be resolved again.
+
+        :param profile: The boto profile whose clients are dropped, None for the default credential chain
+        """
+        with self._lock:
+            self._sessions.pop(profile, None)
+            for key in [k for k in self._clients if k[1] == profile]:
+                del self._clients[key]
+
+    def clear(self):
+        """Drop every cached session and client."""
+        with self._lock:
+            self._sessions.clear()
+            self._clients.clear()
+
+
+client_cache = ClientCache()
+
+
+def get_client(service, region=None, profile=None, endpoint=None, **params):
+    """Get a boto3 client from the process level cache, see ClientCache.get_client."""
+    return client_cache.get_client(service, region=region, profile=profile, endpoint=endpoint, **params)
+
+
+def invalidate_clients(profile=None):
+    """Drop the cached clients of a profile, see ClientCache.invalidate."""
+    client_cache.invalidate(profile=profile)
+
+
+def is_expired_credentials_error(e):
+    """Tell whether a boto exception was raised because the client credentials have expired."""
+    try:
+        from botocore.exceptions import ClientError
+    except ImportError:
+        return False
+    if not isinstance(e, ClientError):
+        return False
+    return e.response.get('Error', {}).get('Code') in EXPIRED_CREDENTIALS_ERROR_CODES
+
+
+def get_connection_factory(module, service='ec2'):
+    """Resolve the AWS connection parameters of a module once.
+
+    :param module: An AnsibleModule using ec2_argument_spec
+    :param service: The AWS service name
+    :return A callable(region=None, refresh=False) returning a cached client, refresh drops the cached clients first
+    """
+    from ansible.module_utils.ec2 import get_aws_connection_info
+
+    default_region, endpoint, params = get_aws_connection_info(module, boto3=True)
+    profile = params.pop('profile_name', None)
+
+    def connection(region=None, refresh=False):
+        if refresh:
+            invalidate_clients(profile=profile)
+        return get_client(service, region=region or default_region, profile=profile, endpoint=endpoint, **params)
+
+    return connection
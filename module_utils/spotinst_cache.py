@@ -0,0 +1,114 @@
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+"""On-disk cache shared by the forks running the spotinst modules."""
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import fcntl
+import json
+import os
+import re
+import tempfile
+import time
+
+from contextlib import contextmanager
+
+from ansible.module_utils._text import to_bytes, to_text
+
+
+DEFAULT_CACHE_DIR = '~/.ansible/cache/spotinst'
+
+
+class FileCache(object):
+    """A directory of JSON files expiring after a TTL.
+
+    Every fork runs the module in its own process, so values are kept on disk to be shared between them. Files are
+    written to a temporary file then renamed, a reader sees either the previous or the new value but never a partial
+    one. Any unreadable entry is treated as missing. get_or_set also locks the key so that a single process computes
+    a missing value while the others wait for it.
+    """
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR, ttl=3600):
+        """
+        :param directory: The directory holding the cache files, created on first write
+        :param ttl: Number of seconds an entry stays valid
+        """
+        self.directory = os.path.expanduser(directory)
+        self.ttl = ttl
+
+    def _path(self, key):
+        return os.path.join(self.directory, re.sub(r'[^\w.-]', '_', key) + '.json')
+
+    def get(self, key):
+        """Get a cached value, None when missing or expired."""
+        path = self._path(key)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                return None
+            with open(path, 'rb') as f:
+                return json.loads(to_text(f.read()))
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _makedirs(self):
+        try:
+            os.makedirs(self.directory)
+        except OSError:
+            # Another fork may have just created it
+            if not os.path.isdir(self.directory):
+                raise
+
+    def set(self, key, value):
+        """Cache a JSON serializable value, failing to write the cache is not an error."""
+        try:
+            self._makedirs()
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(to_bytes(json.dumps(value)))
+                os.rename(tmp_path, self._path(key))
+            except Exception:
+                os.remove(tmp_path)
+                raise
+        except (IOError, OSError):
+            pass
+
+    @contextmanager
+    def _locked(self, key):
+        """Hold an exclusive lock on a key, shared by processes and threads."""
+        try:
+            self._makedirs()
+            f = open(self._path(key) + '.lock', 'a')
+        except (IOError, OSError):
+            # Without a usable cache directory every caller computes its own value
+            yield
+            return
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+        finally:
+            # Closing the file releases the lock
+            f.close()
+
+    def get_or_set(self, key, func):
+        """Get a cached value, or cache the one returned by func while other callers wanting it wait for it."""
+        value = self.get(key)
+        if value is not None:
+            return value
+
+        with self._locked(key):
+            # The value may have been computed by another caller while waiting for the lock
+            value = self.get(key)
+            if value is None:
+                value = func()
+                self.set(key, value)
+        return value
+
+
+def get_module_cache(module, ttl_param='metadata_cache_ttl'):
+    """Get the FileCache configured by the cache_dir and ttl_param options of a module, None when the TTL is 0."""
+    ttl = module.params.get(ttl_param)
+    if not ttl:
+        return None
+    return FileCache(module.params.get('cache_dir') or DEFAULT_CACHE_DIR, ttl=ttl)
@@ -0,0 +1,257 @@
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+"""Counters and timers of the spotinst modules and inventory plugin, with StatsD and Prometheus exports."""
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import json
+import os
+import re
+import socket
+import tempfile
+import threading
+import time
+
+from contextlib import contextmanager
+
+from ansible.module_utils._text import to_bytes
+from ansible.module_utils.six.moves.urllib.parse import urlsplit
+
+
+# Upper bounds (in seconds) of the latency histograms buckets, from a fast API call to a whole recycle
+DEFAULT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+# Largest payload sent in a single StatsD datagram, below the usual network MTU
+STATSD_MAX_DATAGRAM = 1400
+
+# os.rename already replaces an existing file on python 2 POSIX systems
+_replace = getattr(os, 'replace', os.rename)
+
+_IDS = (
+    (re.compile(r'sig-[0-9a-z]+'), '{esg_id}'),
+    (re.compile(r'ssi-[0-9a-z]+'), '{stateful_instance_id}'),
+)
+
+
+def endpoint_label(endpoint):
+    """Reduce a Spotinst API endpoint to its route, so that metrics do not get a label per ESG or instance.
+
+    (Example aws/ec2/group/sig-123/statefulInstance?accountId=act-123 -> aws/ec2/group/{esg_id}/statefulInstance)
+    """
+    route = endpoint.split('?')[0].strip('/')
+    for regex, placeholder in _IDS:
+        route = regex.sub(placeholder, route)
+    return route
+
+
+def _key(name, labels):
+    # Label values are compared when sorting metrics, an HTTP status may be an int or 'error'
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format(key):
+    name, labels = key
+    if not labels:
+        return name
+    return "{}{{{}}}".format(name, ','.join('{}="{}"'.format(k, v) for k, v in labels))
+
+
+class Histogram(object):
+    """Count, sum, min, max and bucketed distribution of observed values."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def cumulative(self):
+        """Yield (upper bound, number of values lower or equal to it), the last bound being +Inf."""
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            yield bound, total
+        yield '+Inf', self.count
+
+    def to_dict(self):
+        """Get the histogram summary, buckets only list the number of values of the non empty ones by upper bound."""
+        return {
+            'count': self.count,
+            'sum': round(self.sum, 6),
+            'min': round(self.min, 6) if self.min is not None else None,
+            'max': round(self.max, 6) if self.max is not None else None,
+            'buckets': dict((str(bound), count) for bound, count in zip(self.buckets, self.counts) if count),
+        }
+
+
+class Metrics(object):
+    """Thread safe registry of counters and histograms, identified by a name and labels.
+
+    Metrics are cheap enough to be always recorded: a recycle makes at most a few hundred API calls. They are returned
+    in module results, and can be exported to a StatsD daemon or to a Prometheus text file (as read by the node
+    exporter textfile collector).
+    """
+
+    def __init__(self, prefix='spotinst', buckets=DEFAULT_BUCKETS):
+        """
+        :param prefix: Prefix of the exported metric names
+        :param buckets: Upper bounds of the histograms buckets
+        """
+        self.prefix = prefix
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+
+    def incr(self, name, value=1, **labels):
+        """Add value to a counter."""
+        key = _key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """Record a value, usually a duration in seconds, in a histogram."""
+        key = _key(name, labels)
+        with self._lock:
+            if key not in self._histograms:
+                self._histograms[key] = Histogram(self.buckets)
+            self._histograms[key].observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Record the number of seconds spent in a block, whether it raised or not."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def get(self, name, **labels):
+        """Get the value of a counter, 0 when never incremented."""
+        with self._lock:
+            return self._counters.get(_key(name, labels), 0)
+
+    def to_dict(self):
+        """Get every metric, keyed by name{label="value",...}."""
+        with self._lock:
+            return {
+                'counters': dict((_format(k), v) for k, v in self._counters.items()),
+                'histograms': dict((_format(k), h.to_dict()) for k, h in self._histograms.items()),
+            }
+
+    def to_prometheus(self):
+        """Format every metric in Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            for name in sorted(set(k[0] for k in self._counters)):
+                full_name = "{}_{}_total".format(self.prefix, name)
+                lines.append("# TYPE {} counter".format(full_name))
+                for key in sorted(k for k in self._counters if k[0] == name):
+                    lines.append("{} {}".format(_format((full_name, key[1])), self._counters[key]))
+
+            for name in sorted(set(k[0] for k in self._histograms)):
+                full_name = "{}_{}".format(self.prefix, name)
+                lines.append("# TYPE {} histogram".format(full_name))
+                for key in sorted(k for k in self._histograms if k[0] == name):
+                    histogram = self._histograms[key]
+                    for bound, count in histogram.cumulative():
+                        lines.append("{} {}".format(_format((full_name + '_bucket', key[1] + (('le', bound),))), count))
+                    lines.append("{} {}".format(_format((full_name + '_sum', key[1])), histogram.sum))
+                    lines.append("{} {}".format(_format((full_name + '_count', key[1])), histogram.count))
+        return '\n'.join(lines) + '\n'
+
+    def to_statsd(self):
+        """Format every metric as StatsD lines, with labels as DogStatsD tags.
+
+        Histograms are already aggregated: their count is sent as a counter, their sum and max as gauges in
+        milliseconds.
+        """
+        def line(key, suffix, value, metric_type):
+            tags = '|#' + ','.join('{}:{}'.format(k, v) for k, v in key[1]) if key[1] else ''
+            return "{}.{}{}:{}|{}{}".format(self.prefix, key[0], suffix, value, metric_type, tags)
+
+        lines = []
+        with self._lock:
+            for key, value in sorted(self._counters.items()):
+                lines.append(line(key, '', value, 'c'))
+            for key, histogram in sorted(self._histograms.items()):
+                lines.append(line(key, '.count', histogram.count, 'c'))
+                lines.append(line(key, '.sum', int(histogram.sum * 1000), 'g'))
+                lines.append(line(key, '.max', int((histogram.max or 0) * 1000), 'g'))
+        return lines
+
+    def export(self, sink):
+        """Export every metric to a sink.
+
+        :param sink: statsd://host:port to send them to a StatsD daemon over UDP, or a file path: a .prom file gets
+                     Prometheus text format, any other file JSON
+        """
+        url = urlsplit(sink)
+        if url.scheme == 'statsd':
+            return self._send_statsd(url.hostname or 'localhost', url.port or 8125)
+
+        path = os.path.expanduser(sink)
+        if path.endswith('.prom'):
+            content = self.to_prometheus()
+        else:
+            content = json.dumps(self.to_dict(), indent=2, sort_keys=True)
+        _write_atomic(path, content)
+
+    def _send_statsd(self, host, port):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            datagram = []
+            for line in self.to_statsd():
+                if datagram and len('\n'.join(datagram + [line])) > STATSD_MAX_DATAGRAM:
+                    sock.sendto(to_bytes('\n'.join(datagram)), (host, port))
+                    datagram = []
+                datagram.append(line)
+            if datagram:
+                sock.sendto(to_bytes('\n'.join(datagram)), (host, port))
+        finally:
+            sock.close()
+
+
+def _write_atomic(path, content):
+    """Write a file through a rename, so that a collector never reads it half written.
+
+    The file is made readable by everyone, as the node_exporter textfile collector usually runs as another user.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(to_bytes(content))
+        # mkstemp creates the file with mode 0600, which the rename keeps
+        os.chmod(tmp_path, 0o644)
+        _replace(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+def export_module_metrics(module, metrics):
+    """Export metrics to the metrics_sink option of a module, if any, and return them for the module result.
+
+    A sink that cannot be written to only raises a warning, metrics must not fail a recycle.
+    """
+    sink = module.params.get('metrics_sink')
+    if sink:
+        try:
+            metrics.export(sink)
+        except (IOError, OSError, socket.error) as e:
+            module.warn("Unable to export metrics to {}: {}".format(sink, e))
+    return metrics.to_dict()
@@ -0,0 +1,177 @@
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+"""Readiness checks of a recycled instance, probed concurrently."""
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import json
+import socket
+import threading
+import time
+
+from ansible.module_utils._text import to_text
+from ansible.module_utils.six.moves import http_client
+from ansible.module_utils.six.moves.urllib import error as urllib_error
+from ansible.module_utils.spotinst_stateful import SpotinstStatefulError, is_port_open, poll_intervals
+from ansible.module_utils.urls import open_url
+
+
+class ReadinessCheck(object):
+    """A condition probed until it holds, recording how long it took and how many probes it needed."""
+
+    def __init__(self, name):
+        self.name = name
+        self.ready = False
+        self.attempts = 0
+        # Number of seconds from the start of the wait until the check held, None while it does not
+        self.elapsed = None
+        # Why the last probe failed
+        self.msg = None
+
+    def probe(self):
+        """Probe the condition once, return whether it holds and set msg otherwise."""
+        raise NotImplementedError()
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'ready': self.ready,
+            'attempts': self.attempts,
+            'elapsed': self.elapsed,
+            'msg': self.msg,
+        }
+
+
+class PortCheck(ReadinessCheck):
+    """A TCP port accepting connections."""
+
+    def __init__(self, host, port, timeout=5):
+        super(PortCheck, self).__init__("port {}".format(port))
+        self.host = host
+        self.port = int(port)
+        self.timeout = timeout
+
+    def probe(self):
+        if is_port_open(self.host, self.port, timeout=self.timeout):
+            self.msg = None
+            return True
+        self.msg = "{}:{} is not reachable".format(self.host, self.port)
+        return False
+
+
+class JolokiaCheck(ReadinessCheck):
+    """A JMX attribute read through Jolokia having an expected value (Example 0 UnderReplicatedPartitions)."""
+
+    def __init__(self, host, port, endpoint, expect, attribute='Value', timeout=5):
+        """
+        :param host: The host running the Jolokia agent
+        :param port: The Jolokia agent port
+        :param endpoint: The MBean read, optionally followed by /<attribute>
+                         (Example kafka.server:type=ReplicaManager,name=UnderReplicatedPartitions)
+        :param expect: The expected value, compared as text when types differ
+        :param attribute: The key of the read value to compare when it is a dictionary, None to compare it whole
+        :param timeout: The HTTP request timeout in seconds
+        """
+        super(JolokiaCheck, self).__init__("jolokia {}".format(endpoint))
+        self.url = "http://{}:{}/jolokia/read/{}".format(host, port, endpoint)
+        self.expect = expect
+        self.attribute = attribute
+        self.timeout = timeout
+        # Last value read
+        self.value = None
+
+    def probe(self):
+        try:
+            response = open_url(self.url, timeout=self.timeout)
+            data = json.loads(to_text(response.read()))
+        except (urllib_error.URLError, http_client.HTTPException, socket.error, ValueError) as e:
+            self.msg = "Unable to read {}: {}".format(self.url, e)
+            return False
+
+        value = data.get('value') if isinstance(data, dict) else None
+
+        if self.attribute and isinstance(value, dict):
+            value = value.get(self.attribute)
+        self.value = value
+
+        # YAML may give the expected value as a string
+        if value == self.expect or to_text(value) == to_text(self.expect):
+            self.msg = None
+            return True
+        self.msg = "{} is {}, expecting {}".format(self.name, value, self.expect)
+        return False
+
+    def to_dict(self):
+        result = super(JolokiaCheck, self).to_dict()
+        result['value'] = self.value
+        return result
+
+
+def get_jolokia_check(host, jolokia, timeout=5):
+    """Build the JolokiaCheck described by the jolokia option of a module.
+
+    :param host: The host running the Jolokia agent
+    :param jolokia: A dictionary with a port, an endpoint, an expected value, an optional attribute and an optional
+                    type which must be jolokia
+    :param timeout: The HTTP request timeout in seconds
+    :raise ValueError: When the dictionary is not a valid jolokia check
+    """
+    if jolokia.get('type', 'jolokia') != 'jolokia':
+        raise ValueError("Unsupported jolokia check type: {}".format(jolokia['type']))
+    missing = [key for key in ('port', 'endpoint', 'expect') if key not in jolokia]
+    if missing:
+        raise ValueError("jolokia is missing {}".format(', '.join(missing)))
+    return JolokiaCheck(host, jolokia['port'], jolokia['endpoint'], jolokia['expect'],
+                        attribute=jolokia.get('attribute', 'Value'), timeout=timeout)
+
+
+def wait_until_ready(checks, timeout, min_interval=1, max_interval=10):
+    """Probe every check concurrently until they all hold or timeout seconds have passed.
+
+    Each check runs in its own thread and backs off on its own from min_interval to max_interval seconds between
+    probes, so that a slow condition does not delay the others and the wait ends as soon as the last one holds.
+
+    :param checks: A list of ReadinessCheck
+    :param timeout: Number of seconds to wait for all of them
+    :return The list of checks, those that did not hold in time are left not ready
+    """
+    start = time.time()
+    deadline = start + timeout
+
+    def run(check):
+        intervals = poll_intervals(min_interval, max_interval)
+        while True:
+            check.attempts += 1
+            if check.probe():
+                check.ready = True
+                check.elapsed = round(time.time() - start, 3)
+                return
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return
+            time.sleep(min(next(intervals), remaining))
+
+    threads = []
+    for check in checks:
+        thread = threading.Thread(target=run, args=(check,))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    for thread in threads:
+        thread.join()
+
+    return checks
+
+
+def wait_for_jolokia(host, jolokia, timeout, min_interval=1, max_interval=10):
+    """Wait until the Jolokia check described by jolokia (see get_jolokia_check) holds on host.
+
+    :raise SpotinstStatefulError: When it does not hold within timeout seconds
+    """
+    check = get_jolokia_check(host, jolokia)
+    wait_until_ready([check], timeout, min_interval=min_interval, max_interval=max_interval)
+    if not check.ready:
+        raise SpotinstStatefulError("{} is still not ready after {}s: {}".format(host, timeout, check.msg))
@@ -0,0 +1,532 @@
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+"""Stateful Elastigroup operations shared by the spotinst modules."""
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import random
+import socket
+import threading
+import time
+
+from collections import deque
+
+from ansible.module_utils.spotinst_api import SpotinstApiError
+from ansible.module_utils.spotinst_aws import is_expired_credentials_error
+from ansible.module_utils.spotinst_metrics import Metrics
+
+try:
+    from botocore.exceptions import ClientError
+except ImportError:
+    pass  # caught by HAS_BOTO3 in the modules
+
+
+class SpotinstStatefulError(Exception):
+    """Raised when a stateful operation fails or does not complete in time."""
+
+
+def poll_intervals(min_interval, max_interval):
+    """Yield poll intervals growing exponentially from min_interval to max_interval, with jitter."""
+    min_interval = float(min_interval)
+    max_interval = max(min_interval, float(max_interval))
+
+    ceiling = min_interval
+    while True:
+        # Jitter spreads the polls of concurrent recycles instead of hitting the API in lockstep
+        yield random.uniform(min_interval, ceiling)
+        ceiling = min(ceiling * 2, max_interval)
+
+
+def is_new_instance(instance, previous):
+    """Tell whether a stateful instance now runs on another EC2 instance than before."""
+    same_instance = instance.get('instanceId') == previous.get('instanceId')
+    return not same_instance or instance.get('launchedAt') != previous.get('launchedAt')
+
+
+def is_port_open(host, port, timeout=5):
+    """Tell whether a TCP connection can be established to host:port."""
+    try:
+        socket.create_connection((host, int(port)), timeout=timeout).close()
+        return True
+    except (socket.error, socket.timeout):
+        return False
+
+
+def wait_for_ports(host, ports, timeout, min_interval=1, max_interval=10):
+    """Wait until every TCP port of host accepts connections, raise SpotinstStatefulError on timeout."""
+    deadline = time.time() + timeout
+    intervals = poll_intervals(min_interval, max_interval)
+
+    pending = list(ports)
+    while True:
+        pending = [port for port in pending if not is_port_open(host, port)]
+        if not pending:
+            return
+
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise SpotinstStatefulError("Ports {} of {} are still not reachable after {}s".format(pending, host, timeout))
+        time.sleep(min(next(intervals), remaining))
+
+
+class StatefulGroup(object):
+    """Stateful instances of an Elastigroup."""
+
+    def __init__(self, client, account_id, esg_id, ec2_connection=None, region=None, metadata_cache=None, poll_cache=None,
+                 metrics=None, snapshot=None):
+        """
+        :param client: A SpotinstClient
+        :param account_id: Spotinst account id with format act-xxx
+        :param esg_id: Id of the Elastigroup with format sig-xxx
+        :param ec2_connection: A callable(region, refresh=False) returning an EC2 client, refresh drops cached clients
+        :param region: The ESG region if already known, fetched from Spotinst API otherwise
+        :param metadata_cache: An optional FileCache of ESG metadata, avoiding to fetch the ESG from every fork
+        :param poll_cache: An optional FileCache of stateful instances lists with a short TTL, shared by every fork
+                           polling the ESG
+        :param metrics: The Metrics recording EC2 lookups, the client ones by default
+        :param snapshot: An optional SnapshotClient of a spotinst-esg-watch daemon, stateful instances are listed from
+                         its snapshot while it is fresh instead of Spotinst API
+        """
+        self.client = client
+        self.account_id = account_id
+        self.esg_id = esg_id
+        self.ec2_connection = ec2_connection
+        self.metadata_cache = metadata_cache
+        self.poll_cache = poll_cache
+        self.snapshot = snapshot
+        self.metrics = metrics if metrics is not None else client.metrics
+        self._region = region
+        self._lock = threading.Lock()
+
+    def _request(self, path='', method='GET'):
+        endpoint = "aws/ec2/group/{}{}?accountId={}".format(self.esg_id, path, self.account_id)
+        result = self.client.request(endpoint, method=method)
+
+        if 'response' not in result or result['response']['status']['code'] != 200:
+            raise SpotinstApiError("Spotinst API raised an error: {}".format(result))
+        return result
+
+    def _list_instances(self):
+        # https://api.spotinst.com/spotinst-api/elastigroup/amazon-web-services/stateful-api/list-stateful-instances
+        return self._request('/statefulInstance')['response']['items']
+
+    def list_instances(self):
+        """List the stateful instances of the ESG.
+
+        With a poll cache, a single fork fetches the list while the others waiting on the same ESG read it from the
+        cache, so that polling costs one request per ESG rather than one per recycled instance. With a snapshot, no
+        request is made at all while it is fresh.
+        """
+        if self.snapshot is not None:
+            items = self.snapshot.list_instances(self.account_id, self.esg_id)
+            self.metrics.incr('watch_snapshot_reads', result='miss' if items is None else 'hit')
+            if items is not None:
+                return items
+
+        if self.poll_cache is None:
+            return self._list_instances()
+        key = "{}_{}_statefulInstance".format(self.account_id, self.esg_id)
+        return self.poll_cache.get_or_set(key, self._list_instances)
+
+    def get_instance(self, ssi):
+        """Get a stateful instance, None if it is not part of the ESG (yet).
+
+        Spotinst API does not expose a single stateful instance read, the ESG stateful instances list is used instead.
+        """
+        return next((item for item in self.list_instances() if item["id"] == ssi), None)
+
+    def recycle_instance(self, ssi):
+        """Request the recycling of a stateful instance."""
+        self._request('/statefulInstance/{}/recycle'.format(ssi), method='PUT')
+
+    def get_metadata(self):
+        """Get the ESG id, name and region, from the metadata cache when possible."""
+        key = "{}_{}".format(self.account_id, self.esg_id)
+        metadata = self.metadata_cache.get(key) if self.metadata_cache else None
+        if metadata is None:
+            esg = self._request()['response']['items'][0]
+            metadata = {'id': esg['id'], 'name': esg['name'], 'region': esg['region']}
+            if self.metadata_cache:
+                self.metadata_cache.set(key, metadata)
+        return metadata
+
+    @property
+    def region(self):
+        with self._lock:
+            if self._region is None:
+                # Gather information about the ESG to know in which region it is running
+                self._region = self.get_metadata()['region']
+        return self._region
+
+    def _describe_instances(self, ids, refresh=False):
+        paginator = self.ec2_connection(self.region, refresh=refresh).get_paginator('describe_instances')
+        with self.metrics.timer('ec2_describe_instances_seconds', region=self.region):
+            reservations = paginator.paginate(InstanceIds=ids).build_full_result().get('Reservations')
+        instances = []
+        for r in reservations:
+            instances.extend(r['Instances'])
+        return instances
+
+    def describe_instances(self, ids):
+        """Get a list of EC2 instances of the ESG region matching the given list of IDs."""
+        try:
+            return self._describe_instances(ids)
+        except ClientError as e:
+            if not is_expired_credentials_error(e):
+                raise
+            # Credentials expired since the client was cached, retry once with a fresh one
+            return self._describe_instances(ids, refresh=True)
+
+    def warm_up(self):
+        """Resolve the ESG region and build its EC2 client ahead of a private IP lookup."""
+        if self.ec2_connection is not None:
+            self.ec2_connection(self.region)
+
+    def get_private_ip(self, instance_id):
+        """Get the private IP of an EC2 instance of the ESG."""
+        ec2s = self.describe_instances([instance_id])
+        if not ec2s or 'PrivateIpAddress' not in ec2s[0]:
+            raise SpotinstStatefulError("EC2 instance {} of ESG {} has no private IP".format(instance_id, self.esg_id))
+        return ec2s[0]['PrivateIpAddress']
+
+
+class StatefulRecycle(object):
+    """Recycle a single stateful instance, tracking its progress as a state machine.
+
+    QUEUED -> WAITING_ACTIVE -> READY -> RECYCLING -> LOOKING_UP_IP -> CHECKING_PORTS -> CHECKING_READINESS -> DONE
+    Any state may lead to FAILED, queued recycles may also be SKIPPED by an orchestrator.
+    """
+
+    QUEUED = 'QUEUED'
+    WAITING_ACTIVE = 'WAITING_ACTIVE'
+    READY = 'READY'
+    RECYCLING = 'RECYCLING'
+    LOOKING_UP_IP = 'LOOKING_UP_IP'
+    CHECKING_PORTS = 'CHECKING_PORTS'
+    CHECKING_READINESS = 'CHECKING_READINESS'
+    DONE = 'DONE'
+    FAILED = 'FAILED'
+    SKIPPED = 'SKIPPED'
+
+    def __init__(self, group, ssi, wait_timeout=600, poll_min_interval=2, poll_max_interval=20,
+                 check_ports=None, check_timeout=300, readiness=None, metrics=None):
+        """
+        :param group: The StatefulGroup the instance belongs to
+        :param ssi: Stateful instance ID with format ssi-xxx
+        :param wait_timeout: Number of seconds to wait for each state transition
+        :param poll_min_interval: Minimum number of seconds between two polls of the instance state
+        :param poll_max_interval: Maximum number of seconds between two polls of the instance state
+        :param check_ports: TCP ports that must accept connections on the recycled instance before it is DONE
+        :param check_timeout: Number of seconds to wait for check_ports
+        :param readiness: An optional callable(private IP) waiting for the recycled instance to be ready once its ports
+                          are open (Example Kafka partitions back in sync), raising SpotinstStatefulError otherwise
+        :param metrics: The Metrics recording the time spent in each state and the number of polls
+        """
+        self.group = group
+        self.ssi = ssi
+        self.wait_timeout = wait_timeout
+        self.poll_min_interval = poll_min_interval
+        self.poll_max_interval = poll_max_interval
+        self.check_ports = check_ports or []
+        self.check_timeout = check_timeout
+        self.readiness = readiness
+        self.metrics = metrics if metrics is not None else Metrics()
+
+        self.state = self.QUEUED
+        self.instance = None
+        self.error = None
+        # Whether the recycle was requested to Spotinst, i.e. whether something changed
+        self.requested = False
+        self.requested_at = None
+        # The instance as seen right before requesting the recycle
+        self.previous = None
+        # Number of seconds spent in each state
+        self.timings = {}
+        self._state_started_at = time.time()
+        self._lock = threading.Lock()
+        self._prepare_lock = threading.Lock()
+
+    def _transition(self, state):
+        with self._lock:
+            # A recycle skipped while being prepared stays SKIPPED
+            if self.state == self.SKIPPED:
+                return
+            now = time.time()
+            self.timings[self.state] = round(self.timings.get(self.state, 0) + now - self._state_started_at, 3)
+            self.metrics.observe('recycle_state_seconds', now - self._state_started_at, state=self.state)
+            self.state = state
+            self._state_started_at = now
+        if state in (self.DONE, self.FAILED, self.SKIPPED):
+            self.metrics.incr('recycles', state=state)
+
+    def wait_for(self, pending_state, final_state='ACTIVE', previous=None):
+        """Wait for the instance to go through pending_state and reach final_state.
+
+        Polls back off exponentially. A fast transition may happen entirely between two polls (for instance
+        ACTIVE -> RECYCLING -> ACTIVE): when previous (the instance as seen before the operation) is given, reaching
+        final_state on a new EC2 instance also counts as having gone through pending_state.
+        """
+        timeout = time.time() + self.wait_timeout
+        intervals = poll_intervals(self.poll_min_interval, self.poll_max_interval)
+
+        seen_pending = pending_state == final_state
+        while True:
+            if self.state == self.SKIPPED:
+                raise SpotinstStatefulError("The recycle of {} was skipped".format(self.ssi))
+            self.metrics.incr('recycle_polls', state=self.state)
+            instance_status = self.group.get_instance(self.ssi)
+            if instance_status is not None:
+                if instance_status['state'] == final_state:
+                    if seen_pending or (previous is not None and is_new_instance(instance_status, previous)):
+                        return instance_status
+                if instance_status['state'] == pending_state:
+                    seen_pending = True
+
+            remaining = timeout - time.time()
+            if remaining <= 0:
+                break
+            time.sleep(min(next(intervals), remaining))
+
+        raise SpotinstStatefulError("The instance ({}) could not transition from {} to {} "
+                                    "for [recycled] operation before the timeout ({}s)".format(self.ssi,
+                                                                                               pending_state,
+                                                                                               final_state,
+                                                                                               self.wait_timeout))
+
+    def prepare(self):
+        """Wait for a queued instance to be ACTIVE, leaving the recycle READY to be requested.
+
+        An orchestrator may prepare a recycle ahead of its turn, while the previous one of the group is still in
+        progress. It is best effort: when it fails, run waits for the instance to be ACTIVE again.
+        """
+        with self._prepare_lock:
+            if self.state != self.QUEUED:
+                return
+            self._transition(self.WAITING_ACTIVE)
+            self.previous = self.wait_for('ACTIVE')
+            self._transition(self.READY)
+
+    def _is_still_active(self):
+        """Tell whether an instance prepared beforehand is still ACTIVE on the same EC2 instance, with a single poll."""
+        instance = self.group.get_instance(self.ssi)
+        return instance is not None and instance['state'] == 'ACTIVE' and not is_new_instance(instance, self.previous)
+
+    def run(self, wait=True):
+        """Recycle the instance, errors are recorded in error and leave the recycle FAILED.
+
+        :param wait: When False, return as soon as the recycle is requested, leaving it RECYCLING. Its progress can
+                     then be checked with poll_jobs using to_job.
+        """
+        try:
+            # Wait for a preparation in progress to complete
+            with self._prepare_lock:
+                ready = self.state == self.READY
+
+            if not ready or not self._is_still_active():
+                # Safety check as Stateful operations can only be performed when instance is in ACTIVE state
+                self._transition(self.WAITING_ACTIVE)
+                self.previous = self.wait_for('ACTIVE')
+
+            self._transition(self.RECYCLING)
+            self.group.recycle_instance(self.ssi)
+            self.requested = True
+            self.requested_at = time.time()
+            if not wait:
+                return self
+
+            instance = self.wait_for('RECYCLING', previous=self.previous)
+
+            # If a Stateful instance does no have privateIp persistance gather new privateIp
+            if 'privateIp' not in instance:
+                self._transition(self.LOOKING_UP_IP)
+                instance['privateIp'] = self.group.get_private_ip(instance['instanceId'])
+
+            if self.check_ports:
+                self._transition(self.CHECKING_PORTS)
+                wait_for_ports(instance['privateIp'], self.check_ports, self.check_timeout)
+
+            if self.readiness is not None:
+                self._transition(self.CHECKING_READINESS)
+                self.readiness(instance['privateIp'])
+
+            self.instance = instance
+            self._transition(self.DONE)
+        except Exception as e:
+            self.error = str(e)
+            self._transition(self.FAILED)
+
+        return self
+
+    def skip(self, reason):
+        self.error = reason
+        self._transition(self.SKIPPED)
+
+    def to_dict(self):
+        return {
+            'esg_id': self.group.esg_id,
+            'stateful_instance_id': self.ssi,
+            'state': self.state,
+            'changed': self.requested,
+            'stateful': self.instance,
+            'msg': self.error,
+            'timings': self.timings,
+        }
+
+    def to_job(self):
+        """Get a handle on a recycle requested without waiting, see poll_jobs."""
+        return {
+            'esg_id': self.group.esg_id,
+            'stateful_instance_id': self.ssi,
+            'instance_id': self.previous.get('instanceId'),
+            'launched_at': self.previous.get('launchedAt'),
+            'requested_at': self.requested_at,
+        }
+
+
+def poll_jobs(groups, jobs, wait_timeout):
+    """Get the status of recycles requested without waiting.
+
+    Stateful instances are listed once per ESG, whatever the number of jobs polled in it. A job is finished once its
+    instance is ACTIVE again on a new EC2 instance, or once it failed: when that did not happen wait_timeout seconds
+    after it was requested, or its new private IP could not be found. Failed jobs are finished too so that polls
+    retried until every job is finished stop.
+
+    :param groups: A dictionary of ESG id -> StatefulGroup, for every ESG of the jobs
+    :param jobs: A list of handles returned by StatefulRecycle.to_job
+    :param wait_timeout: Number of seconds a recycle has to complete
+    :return A list with the status of each job, the handle updated with finished, failed, state, stateful and msg
+    """
+    instances = {}
+    for esg_id, group in groups.items():
+        instances[esg_id] = dict((item['id'], item) for item in group.list_instances())
+
+    now = time.time()
+    statuses = []
+    for job in jobs:
+        status = dict(job, finished=False, failed=False, state=None, stateful=None, msg=None)
+        previous = {'instanceId': job.get('instance_id'), 'launchedAt': job.get('launched_at')}
+
+        instance = instances[job['esg_id']].get(job['stateful_instance_id'])
+        if instance is not None:
+            status['state'] = instance['state']
+            if instance['state'] == 'ACTIVE' and is_new_instance(instance, previous):
+                try:
+                    if 'privateIp' not in instance:
+                        instance['privateIp'] = groups[job['esg_id']].get_private_ip(instance['instanceId'])
+                    status.update(finished=True, stateful=instance)
+                except SpotinstStatefulError as e:
+                    status.update(finished=True, failed=True, msg=str(e))
+
+        if not status['finished'] and now - job['requested_at'] > wait_timeout:
+            status.update(finished=True, failed=True, msg="The instance ({}) did not complete its [recycled] operation "
+                                                          "before the timeout ({}s)".format(job['stateful_instance_id'],
+                                                                                            wait_timeout))
+        statuses.append(status)
+
+    return statuses
+
+
+class FleetRecycle(object):
+    """Recycle stateful instances of many ESGs at once.
+
+    Instances of a group are recycled at most max_in_flight at a time, in order, while different groups progress in
+    parallel up to max_concurrency recycles overall. A failure only stops the remaining recycles of its own group.
+
+    When pipelined, the next recycle of a group waiting for its turn is prepared meanwhile: its instance is checked
+    ACTIVE and the EC2 client used to look up its new IP is warmed up. It is then requested as soon as the previous
+    one is DONE (including its port and readiness checks), after a single poll confirming the instance is still ACTIVE.
+    """
+
+    def __init__(self, recycles, max_concurrency=10, max_in_flight=1, group_max_in_flight=None, pipeline=False):
+        """
+        :param recycles: A list of StatefulRecycle
+        :param max_concurrency: Maximum number of instances recycled at once across all groups
+        :param max_in_flight: Maximum number of instances recycled at once within a group
+        :param group_max_in_flight: A dictionary of ESG id -> max_in_flight overriding the default for some groups
+        :param pipeline: Whether to prepare the next recycle of a group while the previous ones are in flight
+        """
+        self.recycles = recycles
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_in_flight = max(1, max_in_flight)
+        self.group_max_in_flight = group_max_in_flight or {}
+        self.pipeline = pipeline
+
+        self._condition = threading.Condition()
+        self._in_flight = {}
+        self._total_in_flight = 0
+        self._failed_groups = set()
+        self._preparing = set()
+
+    def _limit(self, esg_id):
+        return max(1, self.group_max_in_flight.get(esg_id) or self.max_in_flight)
+
+    def _run_recycle(self, recycle):
+        recycle.run()
+        with self._condition:
+            self._in_flight[recycle.group.esg_id] -= 1
+            self._total_in_flight -= 1
+            if recycle.state == StatefulRecycle.FAILED:
+                self._failed_groups.add(recycle.group.esg_id)
+            self._condition.notify()
+
+    def _start(self, recycle):
+        self._in_flight[recycle.group.esg_id] = self._in_flight.get(recycle.group.esg_id, 0) + 1
+        self._total_in_flight += 1
+
+        thread = threading.Thread(target=self._run_recycle, args=(recycle,))
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _prepare_recycle(self, recycle):
+        try:
+            recycle.prepare()
+            recycle.group.warm_up()
+        except Exception:
+            # Errors surface again when the recycle gets its turn
+            pass
+
+    def _prepare(self, recycle):
+        self._preparing.add(recycle)
+
+        thread = threading.Thread(target=self._prepare_recycle, args=(recycle,))
+        thread.daemon = True
+        thread.start()
+
+    def run(self):
+        """Recycle every instance and return the list of StatefulRecycle once they are all DONE, FAILED or SKIPPED."""
+        queues = {}
+        order = []
+        for recycle in self.recycles:
+            if recycle.group.esg_id not in queues:
+                queues[recycle.group.esg_id] = deque()
+                order.append(recycle.group.esg_id)
+            queues[recycle.group.esg_id].append(recycle)
+
+        threads = []
+        with self._condition:
+            while order or self._total_in_flight:
+                started = False
+                # Round robin over groups so that all of them progress together
+                for esg_id in list(order):
+                    queue = queues[esg_id]
+                    if esg_id in self._failed_groups:
+                        while queue:
+                            queue.popleft().skip("A previous recycle of ESG {} failed".format(esg_id))
+                    if not queue:
+                        order.remove(esg_id)
+                        continue
+                    if self._total_in_flight < self.max_concurrency and self._in_flight.get(esg_id, 0) < self._limit(esg_id):
+                        threads.append(self._start(queue.popleft()))
+                        started = True
+                    elif self.pipeline and self._in_flight.get(esg_id, 0) and queue[0] not in self._preparing:
+                        self._prepare(queue[0])
+
+                if not started and (order or self._total_in_flight):
+                    self._condition.wait()
+
+        for thread in threads:
+            thread.join()
+
+        return self.recycles
@@ -0,0 +1,290 @@
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+"""Snapshot of the ESGs of an account kept by the spotinst-esg-watch daemon, and the client reading it."""
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import json
+import os
+import socket
+import threading
+import time
+
+from ansible.module_utils._text import to_bytes, to_text
+from ansible.module_utils.six.moves import BaseHTTPServer, http_client, socketserver
+from ansible.module_utils.six.moves.urllib.parse import urlsplit
+
+
+DEFAULT_ADDRESS = 'unix://~/.ansible/spotinst-esg-watch.sock'
+
+# Number of seconds after which a snapshot is no longer trusted, when the daemon is stuck or can not reach the API
+DEFAULT_MAX_AGE = 15
+
+
+def parse_address(address):
+    """Parse a watch address.
+
+    :param address: unix://<path> for a unix socket (Example unix:///run/spotinst-esg-watch.sock) or http://host:port
+    :return ('unix', path) or ('http', (host, port))
+    """
+    if address.startswith('unix://'):
+        return 'unix', os.path.expanduser(address[len('unix://'):])
+
+    url = urlsplit(address)
+    if url.scheme == 'http' and url.port:
+        return 'http', (url.hostname or '127.0.0.1', url.port)
+    raise ValueError("Unsupported watch address {}, expecting unix://<path> or http://<host>:<port>".format(address))
+
+
+class Snapshot(object):
+    """The latest inventory of an account and the stateful instances of its ESGs.
+
+    Responses are serialized once per update rather than once per read, so that reading the inventory of a large
+    account costs the same as reading a single ESG.
+    """
+
+    def __init__(self, account_id, metrics=None):
+        """
+        :param account_id: Spotinst account id with format act-xxx
+        :param metrics: The Metrics of the process updating the snapshot, served as /metrics
+        """
+        self.account_id = account_id
+        self.metrics = metrics
+        self.updated_at = None
+        self.polls = 0
+        self.errors = 0
+        self.last_error = None
+        self._lock = threading.Lock()
+        self._bodies = {}
+
+    def update(self, inventory, stateful_instances):
+        """Replace the snapshot.
+
+        :param inventory: An inventory as returned by the spotinst_esg inventory plugin _query
+        :param stateful_instances: A dictionary of ESG id -> stateful instances as listed by Spotinst API
+        """
+        now = time.time()
+        bodies = {
+            '/inventory': json.dumps({'account_id': self.account_id, 'updated_at': now,
+                                      'esgs': inventory['esgs'], 'hosts': inventory['hosts']}),
+        }
+        for esg_id, items in stateful_instances.items():
+            bodies['/esg/{}/statefulInstance'.format(esg_id)] = json.dumps({'account_id': self.account_id,
+                                                                           'updated_at': now, 'items': items})
+        with self._lock:
+            self._bodies = bodies
+            self.updated_at = now
+            self.polls += 1
+            self.last_error = None
+
+    def fail(self, error):
+        """Record a failed update, the previous snapshot is served until clients find it too old."""
+        with self._lock:
+            self.errors += 1
+            self.last_error = error
+
+    def health(self):
+        with self._lock:
+            return {'account_id': self.account_id, 'updated_at': self.updated_at, 'polls': self.polls,
+                    'errors': self.errors, 'last_error': self.last_error}
+
+    def render(self, path):
+        """Get the response to a GET request.
+
+        :param path: /inventory, /esg/<esg_id>/statefulInstance, /health or /metrics
+        :return A (HTTP status, content type, body) tuple
+        """
+        path = path.split('?')[0].rstrip('/')
+        if path == '/health':
+            return 200, 'application/json', json.dumps(self.health())
+        if path == '/metrics' and self.metrics is not None:
+            return 200, 'text/plain; version=0.0.4', self.metrics.to_prometheus()
+
+        with self._lock:
+            body = self._bodies.get(path)
+        if body is None:
+            return 404, 'application/json', json.dumps({'error': "{} is not part of the snapshot".format(path)})
+        return 200, 'application/json', body
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Keep connections open, a module polls the same daemon many times
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        status, content_type, body = self.server.snapshot.render(self.path)
+        body = to_bytes(body)
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _HTTPServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(snapshot, address=DEFAULT_ADDRESS):
+    """Serve a snapshot over HTTP from a background thread.
+
+    :param snapshot: The Snapshot to serve
+    :param address: See parse_address, a unix socket is only accessible to the current user
+    :return The server, call shutdown() and server_close() to stop it
+    """
+    kind, bind = parse_address(address)
+    if kind == 'unix':
+        if os.path.exists(bind):
+            # Left over by a daemon that did not stop cleanly
+            os.remove(bind)
+        server = _UnixHTTPServer(bind, _Handler)
+        os.chmod(bind, 0o600)
+    else:
+        server = _HTTPServer(bind, _Handler)
+    server.snapshot = snapshot
+
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+class Watcher(object):
+    """Keep a snapshot up to date, polling incrementally from the previous inventory."""
+
+    def __init__(self, snapshot, query):
+        """
+        :param snapshot: The Snapshot to update
+        :param query: A callable(previous inventory or None) returning an (inventory, stateful instances) tuple, see
+                      Snapshot.update
+        """
+        self.snapshot = snapshot
+        self.query = query
+        self.inventory = None
+
+    def poll(self):
+        """Update the snapshot once, return whether it succeeded."""
+        start = time.time()
+        try:
+            self.inventory, stateful_instances = self.query(self.inventory)
+        except Exception as e:
+            self.snapshot.fail(str(e))
+            status = 'error'
+        else:
+            self.snapshot.update(self.inventory, stateful_instances)
+            status = 'ok'
+
+        if self.snapshot.metrics is not None:
+            self.snapshot.metrics.incr('watch_polls', status=status)
+            self.snapshot.metrics.observe('watch_poll_seconds', time.time() - start)
+        return status == 'ok'
+
+
+class _UnixHTTPConnection(http_client.HTTPConnection):
+
+    def __init__(self, socket_path, timeout):
+        # HTTPConnection is an old style class on python 2
+        http_client.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+
+class SnapshotClient(object):
+    """Read the snapshot served by spotinst-esg-watch.
+
+    Reads return None whenever the daemon can not be reached, does not know the requested ESG, watches another account
+    or has not updated its snapshot for max_age seconds: callers then fall back to Spotinst API.
+    """
+
+    def __init__(self, address=DEFAULT_ADDRESS, max_age=DEFAULT_MAX_AGE, timeout=1):
+        """
+        :param address: See parse_address
+        :param max_age: Number of seconds after which a snapshot is ignored
+        :param timeout: Number of seconds a read may take
+        """
+        self.kind, self.bind = parse_address(address)
+        self.max_age = max_age
+        self.timeout = timeout
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self.kind == 'unix':
+            return _UnixHTTPConnection(self.bind, self.timeout)
+        return http_client.HTTPConnection(self.bind[0], self.bind[1], timeout=self.timeout)
+
+    def _request(self, path):
+        if self._connection is None:
+            self._connection = self._connect()
+        self._connection.request('GET', path)
+        response = self._connection.getresponse()
+        body = response.read()
+        return response.status, body
+
+    def get(self, path, account_id):
+        """Get a fresh snapshot response of account_id, None if there is none."""
+        with self._lock:
+            try:
+                try:
+                    status, body = self._request(path)
+                except (socket.error, http_client.HTTPException):
+                    # The daemon may have closed an idle connection, or restarted
+                    self._close()
+                    status, body = self._request(path)
+            except (socket.error, http_client.HTTPException):
+                self._close()
+                return None
+
+        if status != 200:
+            return None
+        try:
+            data = json.loads(to_text(body))
+        except ValueError:
+            return None
+        if data.get('account_id') != account_id or time.time() - data.get('updated_at', 0) > self.max_age:
+            return None
+        return data
+
+    def _close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def get_inventory(self, account_id):
+        """Get the inventory of an account, in the spotinst_esg inventory plugin _query format."""
+        data = self.get('/inventory', account_id)
+        if data is None:
+            return None
+        return {'esgs': data['esgs'], 'hosts': data['hosts']}
+
+    def list_instances(self, account_id, esg_id):
+        """List the stateful instances of an ESG, as Spotinst API does."""
+        data = self.get('/esg/{}/statefulInstance'.format(esg_id), account_id)
+        if data is None:
+            return None
+        return data['items']
+
+
+def get_module_snapshot(module):
+    """Get the SnapshotClient configured by the watch_address and watch_max_age options of a module, None if unset."""
+    address = module.params.get('watch_address')
+    if not address:
+        return None
+    try:
+        return SnapshotClient(address, max_age=module.params.get('watch_max_age'))
+    except ValueError as e:
+        module.fail_json(msg="Invalid watch_address: {}".format(e))
@@ -0,0 +1,316 @@
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+"""Offline benchmark of the spotinst_esg inventory and stateful recycle hot paths.
+
+Spotinst API is served by a fake HTTP server running in a child process, so that its allocations do not count in
+the measured peak memory, and EC2 by a stubbed client. Both are sized to N groups of M stateful instances and answer
+with an injected latency. Each scenario reports its wall time, Spotinst and EC2 API calls and peak memory.
+
+    $ python tests/benchmarks/benchmark.py --groups 500 --instances 10 --latency 0.02
+"""
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import argparse
+import gc
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(HERE, '..', '..')
+
+import ansible.module_utils
+
+# Expose the custom module_utils the same way ansible does through ansible.cfg
+ansible.module_utils.__path__.append(os.path.join(ROOT, 'module_utils'))
+sys.path.insert(0, os.path.join(HERE, '..'))
+
+from ansible.inventory.data import InventoryData
+from ansible.module_utils.spotinst_api import SpotinstClient
+from ansible.module_utils.spotinst_stateful import FleetRecycle, StatefulGroup, StatefulRecycle
+
+from source_loader import load_source
+from spotinst_stub import SpotinstStub, spotinst_response
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+spotinst_esg = load_source('spotinst_esg', os.path.join(ROOT, 'library', 'plugins', 'inventory', 'spotinst_esg.py'))
+
+ACCOUNT_ID = 'act-bench'
+REGIONS = ['us-east-1', 'eu-west-1']
+
+
+def esg_id(group):
+    return 'sig-{}'.format(group)
+
+
+def ssi_id(group, instance):
+    return 'ssi-{}-{}'.format(group, instance)
+
+
+class FakeSpotinst(SpotinstStub):
+    """Spotinst API stub serving groups of stateful instances, and recycling them.
+
+    A recycled instance is RECYCLING for the first half of recycle_time then ACTIVE again on a new EC2 instance,
+    without privateIp so that the recycle has to look it up from EC2.
+    """
+
+    def __init__(self, groups, instances, latency=0, recycle_time=0.5):
+        SpotinstStub.__init__(self, latency=latency)
+        self.recycle_time = recycle_time
+        self.recycled = {}
+
+        esgs = [{'id': esg_id(g), 'name': 'esg-{}'.format(g), 'region': REGIONS[g % len(REGIONS)],
+                 'updatedAt': '2019-04-03T08:36:44.000Z', 'compute': {'launchSpecification': {'tags': []}}}
+                for g in range(groups)]
+        self.add_route('aws/ec2/group', spotinst_response(esgs))
+
+        for g, esg in enumerate(esgs):
+            ssis = [{'id': ssi_id(g, i), 'instanceId': 'i-{}-{}'.format(g, i), 'state': 'ACTIVE',
+                     'launchedAt': '2019-04-03T08:36:44.000Z',
+                     'devices': [{'deviceName': '/dev/xvd{}'.format(d), 'volumeId': 'vol-{}-{}-{}'.format(g, i, d)}
+                                 for d in 'wxyz']}
+                    for i in range(instances)]
+            self.add_route('aws/ec2/group/{}'.format(esg['id']), spotinst_response([esg]))
+            self.add_route('aws/ec2/group/{}/statefulInstance'.format(esg['id']), self._list_route(ssis))
+            for ssi in ssis:
+                self.add_route('aws/ec2/group/{}/statefulInstance/{}/recycle'.format(esg['id'], ssi['id']),
+                               self._recycle_route(ssi['id']), method='PUT')
+
+        self.add_route('__stats', lambda handler, body: (200, self.stats()))
+
+    def _list_route(self, ssis):
+        def route(handler, body):
+            now = time.time()
+            items = []
+            for ssi in ssis:
+                recycled_at = self.recycled.get(ssi['id'])
+                if recycled_at is None:
+                    items.append(ssi)
+                elif now - recycled_at < self.recycle_time / 2:
+                    items.append(dict(ssi, state='RECYCLING'))
+                else:
+                    items.append(dict(ssi, instanceId=ssi['instanceId'] + '-r', launchedAt='2019-04-04T08:36:44.000Z'))
+            return 200, spotinst_response(items)
+        return route
+
+    def _recycle_route(self, ssi):
+        def route(handler, body):
+            self.recycled[ssi] = time.time()
+            return 200, spotinst_response([])
+        return route
+
+    def stats(self):
+        with self.lock:
+            requests = [r for r in self.requests if '__stats' not in r[1]]
+            return {'requests': len(requests), 'connections': self.connections}
+
+
+def _serve(queue, stop, groups, instances, latency, recycle_time):
+    server = FakeSpotinst(groups, instances, latency=latency, recycle_time=recycle_time).start()
+    queue.put(server.url)
+    stop.wait()
+    server.stop()
+
+
+class FakeSpotinstProcess(object):
+    """Run a FakeSpotinst in a child process."""
+
+    def __init__(self, groups, instances, latency=0, recycle_time=0.5):
+        queue = multiprocessing.Queue()
+        self._stop = multiprocessing.Event()
+        self._process = multiprocessing.Process(target=_serve, args=(queue, self._stop, groups, instances, latency, recycle_time))
+        self._process.daemon = True
+        self._process.start()
+        self.url = queue.get(timeout=30)
+        self._client = SpotinstClient('stats', api_url=self.url)
+
+    def stats(self):
+        return self._client.get('__stats')
+
+    def stop(self):
+        self._stop.set()
+        self._process.join()
+
+
+class FakeEC2(object):
+    """Stubbed boto3 EC2 client answering DescribeInstances with made up private IPs."""
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.calls = 0
+        self._lock = threading.Lock()
+        self._ips = {}
+
+    def _private_ip(self, instance_id):
+        with self._lock:
+            if instance_id not in self._ips:
+                n = len(self._ips) + 1
+                self._ips[instance_id] = '10.{}.{}.{}'.format(n >> 16 & 255, n >> 8 & 255, n & 255)
+            return self._ips[instance_id]
+
+    def get_paginator(self, operation):
+        return self
+
+    def paginate(self, Filters=None, InstanceIds=None):
+        with self._lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+        ids = list(InstanceIds or [])
+        for f in Filters or []:
+            if f['Name'] == 'instance-id':
+                ids.extend(f['Values'])
+        instances = [{'InstanceId': i, 'PrivateIpAddress': self._private_ip(i), 'State': {'Name': 'running'}} for i in ids]
+        return _Page({'Reservations': [{'Instances': instances}]})
+
+
+class _Page(object):
+
+    def __init__(self, result):
+        self.result = result
+
+    def build_full_result(self):
+        return self.result
+
+
+def measure(func, memory=False):
+    """Call func and return its result, wall time and peak memory (None unless memory is set)."""
+    gc.collect()
+    if memory and tracemalloc is not None:
+        tracemalloc.start()
+    start = time.time()
+    try:
+        result = func()
+    finally:
+        wall = time.time() - start
+        peak = None
+        if memory and tracemalloc is not None:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+    return result, wall, peak
+
+
+def _inventory_plugin(url, ec2, max_concurrency):
+    plugin = spotinst_esg.InventoryModule()
+    options = {
+        'max_concurrency': max_concurrency, 'strict': False, 'esg_cache_ttl': 3600, 'cache_compression': 'none',
+        'include_groups': [], 'exclude_groups': [], 'regions': [], 'non_stateful_groups': True,
+    }
+    plugin.get_option = options.get
+    plugin._get_credentials = lambda: {}
+    plugin._get_connection = lambda credentials, region='us-east-1': ec2
+    plugin.spotinst_client = SpotinstClient('token', api_url=url)
+    plugin.inventory = InventoryData()
+    return plugin
+
+
+def bench_inventory(server, args, memory=False):
+    """Time the inventory queries (_query) and the population of the inventory (_populate), parse runs both."""
+    ec2 = FakeEC2(latency=args.ec2_latency)
+    plugin = _inventory_plugin(server.url, ec2, args.max_concurrency)
+
+    before = server.stats()
+    results, query_time, query_peak = measure(lambda: plugin._query(ACCOUNT_ID), memory=memory)
+    after = server.stats()
+    _, populate_time, populate_peak = measure(lambda: plugin._populate(results), memory=memory)
+
+    return [
+        {'scenario': 'inventory._query', 'wall': query_time, 'peak': query_peak, 'ec2_calls': ec2.calls,
+         'spotinst_calls': after['requests'] - before['requests'],
+         'connections': after['connections'] - before['connections'], 'hosts': len(results['hosts'])},
+        {'scenario': 'inventory._populate', 'wall': populate_time, 'peak': populate_peak, 'ec2_calls': 0,
+         'spotinst_calls': 0, 'connections': 0, 'hosts': len(plugin.inventory.hosts)},
+    ]
+
+
+def bench_recycle(server, args, memory=False):
+    """Time the recycle of one stateful instance in each of the first groups, all of them at once."""
+    ec2 = FakeEC2(latency=args.ec2_latency)
+    client = SpotinstClient('token', api_url=server.url)
+    recycles = []
+    for g in range(min(args.recycles, args.groups)):
+        group = StatefulGroup(client, ACCOUNT_ID, esg_id(g), ec2_connection=lambda region=None, refresh=False: ec2)
+        recycles.append(StatefulRecycle(group, ssi_id(g, 0), wait_timeout=60, poll_min_interval=0.05,
+                                        poll_max_interval=0.5))
+
+    before = server.stats()
+    _, wall, peak = measure(lambda: FleetRecycle(recycles, max_concurrency=args.max_concurrency).run(), memory=memory)
+    after = server.stats()
+
+    failed = [r.error for r in recycles if r.state != StatefulRecycle.DONE]
+    if failed:
+        raise RuntimeError("Recycles failed: {}".format(failed))
+
+    return [{'scenario': 'recycle', 'wall': wall, 'peak': peak, 'ec2_calls': ec2.calls,
+             'spotinst_calls': after['requests'] - before['requests'],
+             'connections': after['connections'] - before['connections'], 'hosts': len(recycles)}]
+
+
+def run(args):
+    """Run every scenario and return a list of results, the best wall time of args.runs runs each."""
+    results = []
+    scenarios = [bench_inventory] + ([bench_recycle] if args.recycles else [])
+    for scenario in scenarios:
+        # Every run uses a fresh server as recycles change its state
+        runs = []
+        for i in range(args.runs + (1 if args.memory else 0)):
+            server = FakeSpotinstProcess(args.groups, args.instances, latency=args.latency, recycle_time=args.recycle_time)
+            try:
+                # Tracing allocations slows everything down, peak memory is measured on a separate run
+                runs.append(scenario(server, args, memory=args.memory and i == args.runs))
+            finally:
+                server.stop()
+
+        timed = runs[:args.runs]
+        for index, result in enumerate(timed[0]):
+            result = dict(result, wall=min(run[index]['wall'] for run in timed))
+            if args.memory:
+                result['peak'] = runs[-1][index]['peak']
+            results.append(result)
+    return results
+
+
+def report(results):
+    header = "{:<22} {:>10} {:>14} {:>11} {:>12} {:>8} {:>12}".format(
+        'scenario', 'wall (s)', 'spotinst calls', 'ec2 calls', 'connections', 'hosts', 'peak (MB)')
+    lines = [header, '-' * len(header)]
+    for r in results:
+        peak = '{:.1f}'.format(r['peak'] / 1e6) if r['peak'] is not None else '-'
+        lines.append("{:<22} {:>10.3f} {:>14} {:>11} {:>12} {:>8} {:>12}".format(
+            r['scenario'], r['wall'], r['spotinst_calls'], r['ec2_calls'], r['connections'], r['hosts'], peak))
+    return '\n'.join(lines)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--groups', type=int, default=100, help="number of ESGs (default 100)")
+    parser.add_argument('--instances', type=int, default=10, help="number of stateful instances per ESG (default 10)")
+    parser.add_argument('--latency', type=float, default=0.02, help="Spotinst API latency in seconds (default 0.02)")
+    parser.add_argument('--ec2-latency', type=float, default=0.05, help="EC2 API latency in seconds (default 0.05)")
+    parser.add_argument('--max-concurrency', type=int, default=10, help="inventory and fleet max_concurrency (default 10)")
+    parser.add_argument('--recycles', type=int, default=5, help="number of ESGs recycling an instance, 0 to skip (default 5)")
+    parser.add_argument('--recycle-time', type=float, default=0.5, help="seconds a recycle takes (default 0.5)")
+    parser.add_argument('--runs', type=int, default=3, help="timed runs per scenario, the best is kept (default 3)")
+    parser.add_argument('--no-memory', dest='memory', action='store_false', help="skip the peak memory run")
+    parser.add_argument('--json', action='store_true', help="print results as JSON")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = run(args)
+    print(json.dumps(results, indent=2) if args.json else report(results))
+
+
+if __name__ == '__main__':
+    main()
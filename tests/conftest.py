@@ -0,0 +1,21 @@
+import os
+import sys
+
+import pytest
+
+import ansible.module_utils
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Expose the custom module_utils the same way ansible does through ansible.cfg
+ansible.module_utils.__path__.append(os.path.join(HERE, '..', 'module_utils'))
+sys.path.insert(0, HERE)
+
+from spotinst_stub import SpotinstStub  # noqa: E402
+
+
+@pytest.fixture
+def spotinst_stub():
+    stub = SpotinstStub().start()
+    yield stub
+    stub.stop()
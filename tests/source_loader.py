@@ -0,0 +1,26 @@
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+"""Load the plugins and scripts under test from their path, they are not part of any package."""
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import sys
+
+
+def load_source(name, path):
+    """Import the python file at path as the module name, as imp.load_source did before python 3.12."""
+    try:
+        from importlib.machinery import SourceFileLoader
+        from importlib.util import module_from_spec, spec_from_file_location
+    except ImportError:
+        # python 2, whose imp is still there
+        import imp
+        return imp.load_source(name, path)
+
+    # The loader is explicit for scripts without a .py extension
+    spec = spec_from_file_location(name, path, loader=SourceFileLoader(name, path))
+    module = module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
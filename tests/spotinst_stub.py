@@ -0,0 +1,117 @@
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+"""Local stand-in for Spotinst API used by the tests."""
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import gzip
+import io
+import json
+import threading
+import time
+
+from ansible.module_utils.six.moves import socketserver
+from ansible.module_utils.six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from ansible.module_utils.six.moves.urllib.parse import urlsplit
+
+
+class SpotinstStubHandler(BaseHTTPRequestHandler):
+
+    # Needed for keep-alive connections
+    protocol_version = 'HTTP/1.1'
+    # Send headers and body in one segment, avoids Nagle / delayed ACK stalls on kept-alive connections
+    wbufsize = -1
+
+    def log_message(self, format, *args):
+        pass
+
+    def _handle(self):
+        server = self.server
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else None
+
+        path = urlsplit(self.path).path.strip('/')
+        with server.lock:
+            server.requests.append((self.command, self.path))
+
+        if server.latency:
+            time.sleep(server.latency)
+
+        route = server.routes.get((self.command, path))
+        headers = {}
+        if route is None:
+            status, payload = 404, {'response': {'status': {'code': 404}, 'errors': [{'message': 'Not found'}]}}
+        elif callable(route):
+            result = route(self, body)
+            status, payload = result[:2]
+            if len(result) > 2:
+                headers = result[2]
+        else:
+            status, payload = 200, route
+
+        content = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if 'gzip' in (self.headers.get('Accept-Encoding') or ''):
+            out = io.BytesIO()
+            with gzip.GzipFile(fileobj=out, mode='wb') as f:
+                f.write(content)
+            content = out.getvalue()
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    do_GET = _handle
+    do_PUT = _handle
+
+
+class SpotinstStub(socketserver.ThreadingMixIn, HTTPServer):
+    """HTTP server answering Spotinst API routes with canned payloads.
+
+    Routes map (method, path) to either a payload or a callable(handler, body) returning (status, payload) or
+    (status, payload, headers).
+    Accepted TCP connections are counted, which gives the number of handshakes clients paid for.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, latency=0):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), SpotinstStubHandler)
+        self.latency = latency
+        self.routes = {}
+        self.requests = []
+        self.connections = 0
+        self.lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        return "http://{}:{}".format(*self.server_address)
+
+    def get_request(self):
+        request = HTTPServer.get_request(self)
+        with self.lock:
+            self.connections += 1
+        return request
+
+    def add_route(self, path, payload, method='GET'):
+        self.routes[(method, path.strip('/'))] = payload
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def spotinst_response(items):
+    """Wrap items the way Spotinst API does."""
+    return {'response': {'status': {'code': 200, 'message': 'OK'}, 'kind': 'spotinst:aws:ec2:group', 'items': items, 'count': len(items)}}
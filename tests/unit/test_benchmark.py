@@ -0,0 +1,28 @@
+import os
+
+from source_loader import load_source
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+benchmark = load_source('benchmark', os.path.join(HERE, '..', 'benchmarks', 'benchmark.py'))
+
+
+def test_benchmark_smoke():
+    args = benchmark.parse_args(['--groups', '4', '--instances', '3', '--latency', '0', '--ec2-latency', '0',
+                                 '--recycles', '2', '--recycle-time', '0.2', '--runs', '1', '--no-memory'])
+    results = benchmark.run(args)
+    assert len(benchmark.report(results).splitlines()) == 2 + 3
+    results = dict((r['scenario'], r) for r in results)
+
+    query = results['inventory._query']
+    # One list of ESGs plus one list of stateful instances per ESG, and one DescribeInstances per region
+    assert query['spotinst_calls'] == 4 + 1
+    assert query['ec2_calls'] == len(benchmark.REGIONS)
+    assert query['hosts'] == 4 * 3
+    assert results['inventory._populate']['hosts'] == 4 * 3
+
+    recycle = results['recycle']
+    assert recycle['hosts'] == 2
+    # Each recycle looks up the private IP of its new instance
+    assert recycle['ec2_calls'] == 2
+    assert recycle['spotinst_calls'] >= 2 * 3
@@ -0,0 +1,234 @@
+import errno
+import io
+import json
+import socket
+import threading
+import time
+
+import pytest
+
+from ansible.module_utils.six.moves import http_client
+from ansible.module_utils.urls import open_url
+from ansible.module_utils.spotinst_api import JsonItemsReader, SpotinstApiError, SpotinstClient, TokenBucket, get_spotinst_client
+from ansible.module_utils.spotinst_metrics import Metrics
+
+from spotinst_stub import SpotinstStub, spotinst_response
+
+GROUPS = [{'id': 'sig-{}'.format(i), 'name': 'esg-{}'.format(i), 'region': 'us-east-1'} for i in range(50)]
+
+
+def test_request_decodes_gzip_response(spotinst_stub):
+    spotinst_stub.add_route('aws/ec2/group', spotinst_response(GROUPS))
+    client = SpotinstClient('token', api_url=spotinst_stub.url)
+
+    result = client.get('aws/ec2/group?accountId=act-123')
+
+    assert result['response']['items'] == GROUPS
+
+
+def test_request_sends_auth_once_configured(spotinst_stub):
+    seen = []
+
+    def route(handler, body):
+        seen.append(handler.headers.get('Authorization'))
+        return 200, spotinst_response([])
+
+    spotinst_stub.add_route('aws/ec2/group/sig-1/statefulInstance/ssi-1/recycle', route, method='PUT')
+    client = SpotinstClient('token', api_url=spotinst_stub.url)
+
+    client.put('aws/ec2/group/sig-1/statefulInstance/ssi-1/recycle?accountId=act-123')
+
+    assert seen == ['Bearer token']
+
+
+def test_request_raises_on_http_error(spotinst_stub):
+    client = SpotinstClient('token', api_url=spotinst_stub.url)
+
+    with pytest.raises(SpotinstApiError) as e:
+        client.get('aws/ec2/group/sig-unknown?accountId=act-123')
+
+    assert e.value.status == 404
+
+
+def test_connection_is_reused_after_server_closed_it(spotinst_stub):
+    spotinst_stub.add_route('aws/ec2/group', spotinst_response(GROUPS))
+    client = SpotinstClient('token', api_url=spotinst_stub.url)
+    client.get('aws/ec2/group')
+
+    # Simulate the server dropping the idle keep-alive connection
+    client._pool[0].sock.close()
+
+    assert client.get('aws/ec2/group')['response']['items'] == GROUPS
+    assert client.connections_opened == 2
+
+
+class BrokenConnection(object):
+    """A kept-alive connection the server broke, either while sending the request or while answering it."""
+
+    def __init__(self, error, on_send=False):
+        self.error = error
+        self.on_send = on_send
+        self.sent = []
+
+    def request(self, method, path, body=None, headers=None):
+        self.sent.append(method)
+        if self.on_send:
+            raise self.error
+
+    def getresponse(self):
+        raise self.error
+
+    def close(self):
+        pass
+
+
+@pytest.mark.parametrize('method, error, on_send, resent', [
+    ('GET', socket.error(errno.ECONNRESET, 'Connection reset by peer'), False, True),
+    ('PUT', socket.error(errno.EPIPE, 'Broken pipe'), True, True),
+    ('PUT', http_client.BadStatusLine(''), False, True),
+    ('PUT', socket.error(errno.ECONNRESET, 'Connection reset by peer'), False, False),
+    ('PUT', http_client.BadStatusLine('garbage'), False, False),
+])
+def test_stale_connection_is_only_resent_when_nothing_was_processed(spotinst_stub, method, error, on_send, resent):
+    spotinst_stub.add_route('aws/ec2/group/sig-1/statefulInstance/ssi-1/recycle', spotinst_response([]), method=method)
+    client = SpotinstClient('token', api_url=spotinst_stub.url, max_retries=0)
+    broken = BrokenConnection(error, on_send=on_send)
+    client._pool.append(broken)
+
+    if resent:
+        client.request('aws/ec2/group/sig-1/statefulInstance/ssi-1/recycle', method=method)
+        assert [m for m, path in spotinst_stub.requests] == [method]
+    else:
+        with pytest.raises(SpotinstApiError):
+            client.request('aws/ec2/group/sig-1/statefulInstance/ssi-1/recycle', method=method)
+        assert spotinst_stub.requests == []
+    assert broken.sent == [method]
+
+
+def test_shared_client_is_not_keyed_by_metrics(spotinst_stub):
+    spotinst_stub.add_route('aws/ec2/group', spotinst_response(GROUPS))
+    first, second = Metrics(), Metrics()
+
+    client = get_spotinst_client('shared-token', api_url=spotinst_stub.url, metrics=first)
+    client.get('aws/ec2/group')
+
+    assert get_spotinst_client('shared-token', api_url=spotinst_stub.url, metrics=second) is client
+    client.get('aws/ec2/group')
+    # The connection is shared, calls are recorded in the Metrics given last
+    assert client.connections_opened == 1
+    assert first.get('api_connections_opened') == 1
+    assert second.get('api_requests', endpoint='aws/ec2/group', method='GET', status='200') == 1
+
+
+def test_keep_alive_reduces_handshakes(spotinst_stub):
+    spotinst_stub.add_route('aws/ec2/group', spotinst_response(GROUPS))
+    calls = 50
+
+    for _ in range(calls):
+        open_url("{}/aws/ec2/group".format(spotinst_stub.url), headers={'Authorization': 'Bearer token'}).read()
+    open_url_connections = spotinst_stub.connections
+
+    client = SpotinstClient('token', api_url=spotinst_stub.url)
+    for _ in range(calls):
+        client.get('aws/ec2/group')
+    client_connections = spotinst_stub.connections - open_url_connections
+
+    assert open_url_connections == calls
+    assert client_connections == 1
+    assert client.connections_opened == 1
+
+
+@pytest.mark.parametrize('chunk_size', [1, 3, 64, 65536])
+def test_items_reader_parses_items_across_chunks(chunk_size):
+    items = [{'id': 'sig-1', 'name': u'caf\u00e9'}, 1.5e3, -7, 'items', None, [1, 2]]
+    document = {'request': {'id': 'x', 'url': '/items'}, 'response': {'status': {'code': 200}, 'items': items, 'count': 6}}
+    content = json.dumps(document, ensure_ascii=False).encode('utf-8')
+
+    assert list(JsonItemsReader(io.BytesIO(content).read, chunk_size=chunk_size).items()) == items
+
+
+def test_items_reader_raises_on_truncated_document():
+    with pytest.raises(ValueError):
+        list(JsonItemsReader(io.BytesIO(b'{"response": {"items": [1, 2').read, chunk_size=4).items())
+
+
+def test_iter_items_streams_gzip_response_and_reuses_connection(spotinst_stub):
+    spotinst_stub.add_route('aws/ec2/group', spotinst_response(GROUPS))
+    client = SpotinstClient('token', api_url=spotinst_stub.url)
+
+    assert list(client.iter_items('aws/ec2/group?accountId=act-123', chunk_size=128)) == GROUPS
+    assert list(client.iter_items('aws/ec2/group?accountId=act-123')) == GROUPS
+    assert client.connections_opened == 1
+
+
+def test_iter_items_drops_connection_left_half_read(spotinst_stub):
+    spotinst_stub.add_route('aws/ec2/group', spotinst_response(GROUPS))
+    client = SpotinstClient('token', api_url=spotinst_stub.url)
+
+    items = client.iter_items('aws/ec2/group?accountId=act-123', chunk_size=128)
+    next(items)
+    items.close()
+
+    assert client.get('aws/ec2/group')['response']['items'] == GROUPS
+    assert client.connections_opened == 2
+
+
+def test_throttled_request_is_retried_after_retry_after(spotinst_stub):
+    answers = [(429, {}, {'Retry-After': '0.2'}), (200, spotinst_response(GROUPS))]
+    spotinst_stub.add_route('aws/ec2/group', lambda handler, body: answers.pop(0))
+    client = SpotinstClient('token', api_url=spotinst_stub.url)
+
+    start = time.time()
+    assert client.get('aws/ec2/group')['response']['items'] == GROUPS
+    assert time.time() - start >= 0.2
+    assert client.retries == 1
+    assert client.connections_opened == 1
+
+
+def test_server_errors_are_only_retried_for_get(spotinst_stub):
+    def route(handler, body):
+        return 503, {}
+
+    spotinst_stub.add_route('aws/ec2/group', route)
+    spotinst_stub.add_route('aws/ec2/group/sig-1/statefulInstance/ssi-1/recycle', route, method='PUT')
+    client = SpotinstClient('token', api_url=spotinst_stub.url, max_retries=2, backoff=0.01)
+
+    with pytest.raises(SpotinstApiError):
+        client.put('aws/ec2/group/sig-1/statefulInstance/ssi-1/recycle')
+    with pytest.raises(SpotinstApiError) as e:
+        client.get('aws/ec2/group')
+
+    assert e.value.status == 503
+    assert [method for method, path in spotinst_stub.requests] == ['PUT', 'GET', 'GET', 'GET']
+
+
+def test_identical_gets_in_flight_share_one_response():
+    stub = SpotinstStub(latency=0.3).start()
+    try:
+        stub.add_route('aws/ec2/group/sig-1/statefulInstance', spotinst_response(GROUPS))
+        client = SpotinstClient('token', api_url=stub.url)
+        results = []
+
+        threads = [threading.Thread(target=lambda: results.append(client.get('aws/ec2/group/sig-1/statefulInstance')))
+                   for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert len(stub.requests) == 1
+        assert client.coalesced == 9
+        # Every caller gets its own copy of the response
+        assert len(set(id(result) for result in results)) == 10
+    finally:
+        stub.stop()
+
+
+def test_token_bucket_spreads_calls():
+    bucket = TokenBucket(50, burst=1)
+
+    start = time.time()
+    for _ in range(11):
+        bucket.acquire()
+
+    assert time.time() - start >= 0.2
@@ -0,0 +1,92 @@
+from botocore.exceptions import ClientError
+
+from ansible.module_utils.spotinst_aws import ClientCache, is_expired_credentials_error
+from ansible.module_utils.spotinst_api import SpotinstClient
+from ansible.module_utils.spotinst_stateful import StatefulGroup
+
+
+class FakeSession(object):
+
+    def __init__(self):
+        self.created = []
+
+    def client(self, service, **params):
+        self.created.append((service, params))
+        return object()
+
+
+def make_cache(sessions):
+    cache = ClientCache()
+    cache._get_session = lambda profile: sessions.setdefault(profile, FakeSession())
+    return cache
+
+
+def expired_token_error():
+    return ClientError({'Error': {'Code': 'ExpiredToken', 'Message': 'The security token has expired'}},
+                       'DescribeInstances')
+
+
+def test_clients_are_keyed_by_credentials_hash():
+    sessions = {}
+    cache = make_cache(sessions)
+
+    client = cache.get_client('ec2', region='us-east-1', aws_access_key_id='AKIA1', aws_secret_access_key='s1')
+
+    assert cache.get_client('ec2', region='us-east-1', aws_access_key_id='AKIA1', aws_secret_access_key='s1') is client
+    assert cache.get_client('ec2', region='us-east-1', aws_access_key_id='AKIA1', aws_secret_access_key='s2') is not client
+    assert cache.get_client('ec2', region='eu-west-1', aws_access_key_id='AKIA1', aws_secret_access_key='s1') is not client
+    assert len(sessions[None].created) == 3
+    # Secrets are only kept hashed
+    assert not any('s1' in str(key) for key in cache._clients)
+
+
+def test_invalidate_only_drops_the_clients_of_a_profile():
+    sessions = {}
+    cache = make_cache(sessions)
+    default = cache.get_client('ec2', region='us-east-1')
+    prod = cache.get_client('ec2', region='us-east-1', profile='prod')
+
+    cache.invalidate(profile='prod')
+
+    assert cache.get_client('ec2', region='us-east-1') is default
+    assert cache.get_client('ec2', region='us-east-1', profile='prod') is not prod
+
+
+def test_expired_credentials_evict_cached_clients_once():
+    sessions = {}
+    cache = make_cache(sessions)
+    calls = []
+
+    class Paginator(object):
+
+        def __init__(self, expired):
+            self.expired = expired
+
+        def paginate(self, InstanceIds):
+            return self
+
+        def build_full_result(self):
+            if self.expired:
+                raise expired_token_error()
+            return {'Reservations': [{'Instances': [{'InstanceId': 'i-1', 'PrivateIpAddress': '10.0.0.1'}]}]}
+
+    def connection(region, refresh=False):
+        calls.append(refresh)
+        if refresh:
+            cache.invalidate()
+        cache.get_client('ec2', region=region)
+        # Only the first client built has expired credentials
+        client_paginator = Paginator(expired=len(sessions[None].created) == 1)
+        return type('Client', (object,), {'get_paginator': lambda self, name: client_paginator})()
+
+    group = StatefulGroup(SpotinstClient('token'), 'act-1', 'sig-1', ec2_connection=connection, region='us-east-1')
+
+    assert group.get_private_ip('i-1') == '10.0.0.1'
+    assert calls == [False, True]
+    assert len(sessions[None].created) == 2
+
+
+def test_is_expired_credentials_error():
+    assert is_expired_credentials_error(expired_token_error())
+    assert not is_expired_credentials_error(ClientError({'Error': {'Code': 'UnauthorizedOperation'}}, 'DescribeInstances'))
+    assert not is_expired_credentials_error(ValueError('ExpiredToken'))
@@ -0,0 +1,224 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from ansible.errors import AnsibleParserError
+from ansible.inventory.data import InventoryData
+from ansible.module_utils.spotinst_watch import Snapshot, serve
+from ansible.parsing.dataloader import DataLoader
+from ansible.template import Templar
+
+from source_loader import load_source
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+spotinst_esg = load_source('spotinst_esg', os.path.join(HERE, '..', '..', 'library', 'plugins', 'inventory', 'spotinst_esg.py'))
+
+GROUPS = [
+    {'id': 'sig-1', 'name': 'va-prism-kafka--prod', 'region': 'us-east-1',
+     'compute': {'launchSpecification': {'tags': [{'tagKey': 'team', 'tagValue': 'data'}]}}},
+    {'id': 'sig-2', 'name': 'va-prism-kafka--dev', 'region': 'us-east-1', 'compute': {'launchSpecification': {}}},
+    {'id': 'sig-3', 'name': 'va-prism-zookeeper--prod', 'region': 'eu-west-1',
+     'compute': {'launchSpecification': {'tags': [{'tagKey': 'team', 'tagValue': 'infra'}]}}},
+]
+
+
+@pytest.fixture
+def inventory():
+    options = {'include_groups': [], 'exclude_groups': [], 'regions': [], 'max_concurrency': 1, 'strict': False,
+               'esg_cache_ttl': 3600, 'non_stateful_groups': True}
+    plugin = spotinst_esg.InventoryModule()
+    plugin.get_option = options.get
+    plugin.options = options
+    plugin.endpoints = []
+
+    def iter_spotinst(endpoint):
+        plugin.endpoints.append(endpoint)
+        path = endpoint.split('?')[0].split('/')
+        if path[-1] == 'statefulInstance':
+            return iter([])
+        return iter([g for g in GROUPS if len(path) == 3 or g['id'] == path[3]])
+
+    plugin._iter_spotinst = iter_spotinst
+    return plugin
+
+
+@pytest.mark.parametrize('include, exclude, regions, expected', [
+    ([], [], [], ['sig-1', 'sig-2', 'sig-3']),
+    (['va-prism-kafka--*'], [], [], ['sig-1', 'sig-2']),
+    (['regex:--prod$'], [], [], ['sig-1', 'sig-3']),
+    (['tag:team=data'], [], [], ['sig-1']),
+    (['tag:team'], ['sig-3'], [], ['sig-1']),
+    ([], ['*--dev'], ['us-east-1'], ['sig-1']),
+])
+def test_list_esgs_filters(inventory, include, exclude, regions, expected):
+    inventory.options.update(include_groups=include, exclude_groups=exclude, regions=regions)
+
+    assert [esg['id'] for esg in inventory._list_esgs('act-123')] == expected
+    assert inventory.endpoints == ['aws/ec2/group?accountId=act-123']
+
+
+def test_list_esgs_fetches_included_ids_directly(inventory):
+    inventory.options.update(include_groups=['sig-3'])
+
+    assert [esg['id'] for esg in inventory._list_esgs('act-123')] == ['sig-3']
+    assert inventory.endpoints == ['aws/ec2/group/sig-3?accountId=act-123']
+
+
+def test_query_finds_non_stateful_instances_by_tag_once_per_region(inventory):
+    calls = []
+
+    def get_instances_by_region(regions, filters):
+        calls.append((regions, filters))
+        return [{'InstanceId': 'i-{}'.format(esg_id), 'PrivateIpAddress': '10.0.0.{}'.format(esg_id[-1]),
+                 'State': {'Name': 'running'}, 'Tags': [{'Key': 'spotinst:aws:ec2:group:id', 'Value': esg_id}]}
+                for esg_id in filters[0]['Values']]
+
+    inventory._get_instances_by_region = get_instances_by_region
+
+    result = inventory._query('act-123')
+
+    assert sorted(regions[0] for regions, filters in calls) == ['eu-west-1', 'us-east-1']
+    assert [esg['instances'] for esg in result['esgs']] == [['i-sig-1'], ['i-sig-2'], ['i-sig-3']]
+    assert result['hosts']['i-sig-3']['privateIp'] == '10.0.0.3'
+    assert result['hosts']['i-sig-3']['stateful'] is False
+    assert result['esgs'][2]['tags'] == [{'tagKey': 'team', 'tagValue': 'infra'}]
+
+
+def test_refresh_lists_stateful_instances_again_but_only_describes_new_ones(inventory):
+    stateful = {'sig-1': [{'id': 'ssi-1', 'instanceId': 'i-1', 'state': 'ACTIVE'}]}
+    described = []
+
+    listed = []
+    looked_up = []
+
+    def get_stateful_instances(account_id, esg):
+        listed.append(esg['id'])
+        return [dict(instance, esg_id=esg['id'], esg_name=esg['name'], region=esg['region'], stateful=True)
+                for instance in stateful.get(esg['id'], [])]
+
+    def get_instances_by_region(regions, filters):
+        if filters[0]['Name'] != 'instance-id':
+            return []
+        described.extend(filters[0]['Values'])
+        return [{'InstanceId': i, 'PrivateIpAddress': '10.0.0.{}'.format(len(described)),
+                 'Placement': {'AvailabilityZone': 'us-east-1a'}} for i in filters[0]['Values']]
+
+    inventory._get_stateful_instances = get_stateful_instances
+    inventory._get_instances_by_region = get_instances_by_region
+    inventory._get_fingerprint = lambda esg: '2019-02-04T10:10:31.000Z'
+    cached = inventory._query('act-123')
+    assert cached['hosts']['ssi-1']['privateIp'] == '10.0.0.1'
+
+    # A recycle moves the instance to another EC2 instance without changing the updatedAt of its ESG
+    stateful['sig-1'] = [{'id': 'ssi-1', 'instanceId': 'i-2', 'state': 'ACTIVE'}]
+    del listed[:]
+    inventory._get_non_stateful_instances = lambda account_id, esgs: looked_up.extend(esg['id'] for esg in esgs) or {}
+    result = inventory._query('act-123', cached)
+
+    assert result['hosts']['ssi-1']['instanceId'] == 'i-2'
+    assert result['hosts']['ssi-1']['privateIp'] == '10.0.0.2'
+    assert described == ['i-1', 'i-2']
+    assert [esg['stateful'] for esg in result['esgs']] == [True, False, False]
+    # Unchanged ESGs without stateful instances are not listed again, but their instances are looked up again
+    assert listed == ['sig-1']
+    assert sorted(looked_up) == ['sig-2', 'sig-3']
+
+
+def test_refresh_looks_up_instances_of_unchanged_non_stateful_esgs_again(inventory):
+    ec2s = {'sig-1': 'i-old'}
+
+    def get_instances_by_region(regions, filters):
+        return [{'InstanceId': ec2s[esg_id], 'PrivateIpAddress': '10.0.0.1', 'State': {'Name': 'running'},
+                 'Tags': [{'Key': 'spotinst:aws:ec2:group:id', 'Value': esg_id}]}
+                for esg_id in filters[0]['Values'] if esg_id in ec2s]
+
+    inventory._get_instances_by_region = get_instances_by_region
+    inventory._get_fingerprint = lambda esg: '2019-02-04T10:10:31.000Z'
+    cached = inventory._query('act-123')
+    assert cached['esgs'][0]['instances'] == ['i-old']
+
+    # A spot replacement does not change the updatedAt of the ESG
+    ec2s['sig-1'] = 'i-new'
+    result = inventory._query('act-123', cached)
+
+    assert result['esgs'][0]['instances'] == ['i-new']
+    assert list(result['hosts']) == ['i-new']
+    assert cached['esgs'][0]['instances'] == ['i-old']
+
+
+def test_snapshot_is_scoped_by_the_inventory_options(inventory, tmpdir):
+    address = 'unix://{}'.format(os.path.join(str(tmpdir), 'watch.sock'))
+    esgs = [dict(id=g['id'], name=g['name'], region=g['region'], tags=inventory._get_tags(g)) for g in GROUPS]
+    esgs[0].update(stateful=True, instances=['ssi-1'])
+    esgs[1].update(stateful=True, instances=['ssi-2'])
+    esgs[2].update(stateful=False, instances=['i-3'])
+    hosts = dict((host_id, {'id': host_id, 'privateIp': '10.0.0.{}'.format(host_id[-1])}) for host_id in ('ssi-1', 'ssi-2', 'i-3'))
+    snapshot = Snapshot('act-123')
+    snapshot.update({'esgs': esgs, 'hosts': hosts}, {})
+    server = serve(snapshot, address)
+
+    try:
+        inventory.options.update(watch_address=address, watch_max_age=5, include_groups=['*--prod'],
+                                 non_stateful_groups=False)
+        result = inventory._get_snapshot('act-123')
+        assert [esg['id'] for esg in result['esgs']] == ['sig-1', 'sig-3']
+        assert result['esgs'][1]['instances'] == []
+        assert list(result['hosts']) == ['ssi-1']
+
+        inventory.options.update(include_groups=['tag:team=infra'], non_stateful_groups=True)
+        result = inventory._get_snapshot('act-123')
+        assert [esg['id'] for esg in result['esgs']] == ['sig-3']
+        assert list(result['hosts']) == ['i-3']
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    inventory.options.update(watch_address='tcp://127.0.0.1')
+    with pytest.raises(AnsibleParserError):
+        inventory._get_snapshot('act-123')
+
+
+def test_populate_adds_each_host_once_with_constructed_groups(inventory):
+    inventory.inventory = InventoryData()
+    inventory.templar = Templar(loader=DataLoader())
+    inventory.options.update(compose={'ansible_host': 'spotinst_privateIp'},
+                             groups={'kafka': "'kafka' in spotinst_esg_name"},
+                             keyed_groups=[{'key': 'spotinst_availabilityZone', 'prefix': 'az'}])
+    host = {'id': 'ssi-1', 'privateIp': '10.0.0.1', 'region': 'us-east-1', 'availabilityZone': 'us-east-1a',
+            'esg_name': 'va-prism-kafka--prod'}
+
+    inventory._populate({'esgs': [{'id': 'sig-1', 'name': 'va-prism-kafka--prod', 'region': 'us-east-1',
+                                   'instances': ['ssi-1']}],
+                         'hosts': {'ssi-1': host}})
+
+    assert list(inventory.inventory.hosts) == ['10.0.0.1']
+    hostvars = inventory.inventory.get_host('10.0.0.1').get_vars()
+    assert hostvars['spotinst_id'] == 'ssi-1'
+    assert hostvars['ansible_host'] == '10.0.0.1'
+    for group in ('sig-1', 'va-prism-kafka--prod', 'kafka', 'az_us_east_1a'):
+        assert [h.name for h in inventory.inventory.groups[group].get_hosts()] == ['10.0.0.1']
+
+
+BOTO_IMPORTS = """
+import sys
+sys.path.insert(0, {tests!r})
+from source_loader import load_source
+spotinst_esg = load_source('spotinst_esg', {path!r})
+plugin = spotinst_esg.InventoryModule()
+plugin.get_option = {{'spotinst_api_token': 'token', 'spotinst_api_url': 'https://api.spotinst.io',
+                     'aws_access_key': 'key', 'aws_secret_key': 'secret'}}.get
+plugin._set_credentials()
+print('boto3' in sys.modules)
+plugin._get_credentials()
+print('boto3' in sys.modules)
+"""
+
+
+def test_boto_is_only_imported_once_aws_credentials_are_needed():
+    path = os.path.join(HERE, '..', '..', 'library', 'plugins', 'inventory', 'spotinst_esg.py')
+    output = subprocess.check_output([sys.executable, '-c', BOTO_IMPORTS.format(tests=os.path.join(HERE, '..'), path=path)])
+
+    assert output.split() == [b'False', b'True']
@@ -0,0 +1,71 @@
+import json
+import os
+import socket
+import stat
+
+from ansible.module_utils.spotinst_api import SpotinstClient
+from ansible.module_utils.spotinst_metrics import Metrics, endpoint_label
+
+from spotinst_stub import spotinst_response
+
+
+def test_endpoint_label_drops_ids_and_query():
+    assert endpoint_label('aws/ec2/group/sig-1a2b/statefulInstance/ssi-3c4d/recycle?accountId=act-123') == \
+        'aws/ec2/group/{esg_id}/statefulInstance/{stateful_instance_id}/recycle'
+
+
+def test_client_records_calls_per_endpoint(spotinst_stub):
+    spotinst_stub.add_route('aws/ec2/group/sig-1/statefulInstance', spotinst_response([{'id': 'ssi-1'}]))
+    client = SpotinstClient('token', api_url=spotinst_stub.url)
+
+    client.get('aws/ec2/group/sig-1/statefulInstance?accountId=act-123')
+    list(client.iter_items('aws/ec2/group/sig-1/statefulInstance?accountId=act-123'))
+
+    metrics = client.metrics.to_dict()
+    route = 'aws/ec2/group/{esg_id}/statefulInstance'
+    assert metrics['counters']['api_requests{{endpoint="{}",method="GET",status="200"}}'.format(route)] == 2
+    assert metrics['counters']['api_bytes_received{{endpoint="{}"}}'.format(route)] > 0
+    assert metrics['histograms']['api_request_seconds{{endpoint="{}",method="GET"}}'.format(route)]['count'] == 2
+
+
+def test_prometheus_export(tmpdir):
+    metrics = Metrics(buckets=(0.1, 1))
+    metrics.incr('api_requests', method='GET', status=200)
+    metrics.incr('api_requests', method='GET', status='error')
+    metrics.observe('recycle_state_seconds', 0.5, state='RECYCLING')
+
+    path = str(tmpdir.join('spotinst.prom'))
+    metrics.export(path)
+
+    with open(path) as f:
+        lines = f.read().splitlines()
+    assert 'spotinst_api_requests_total{method="GET",status="200"} 1' in lines
+    assert 'spotinst_recycle_state_seconds_bucket{state="RECYCLING",le="0.1"} 0' in lines
+    assert 'spotinst_recycle_state_seconds_bucket{state="RECYCLING",le="1"} 1' in lines
+    assert 'spotinst_recycle_state_seconds_bucket{state="RECYCLING",le="+Inf"} 1' in lines
+    assert 'spotinst_recycle_state_seconds_count{state="RECYCLING"} 1' in lines
+    # Readable by a node_exporter running as another user
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o644
+
+    metrics.export(str(tmpdir.join('spotinst.json')))
+    assert json.loads(tmpdir.join('spotinst.json').read())['counters']['api_requests{method="GET",status="error"}'] == 1
+
+
+def test_statsd_export():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    sock.settimeout(5)
+    try:
+        metrics = Metrics()
+        metrics.incr('recycle_polls', 3, state='RECYCLING')
+        metrics.observe('api_request_seconds', 0.25)
+
+        metrics.export('statsd://127.0.0.1:{}'.format(sock.getsockname()[1]))
+
+        lines = sock.recv(65536).decode('utf-8').splitlines()
+    finally:
+        sock.close()
+    assert lines == ['spotinst.recycle_polls:3|c|#state:RECYCLING',
+                     'spotinst.api_request_seconds.count:1|c',
+                     'spotinst.api_request_seconds.sum:250|g',
+                     'spotinst.api_request_seconds.max:250|g']
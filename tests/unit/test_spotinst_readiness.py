@@ -0,0 +1,76 @@
+import socket
+import threading
+import time
+
+import pytest
+
+from ansible.module_utils.spotinst_readiness import JolokiaCheck, PortCheck, wait_for_jolokia, wait_until_ready
+from ansible.module_utils.spotinst_stateful import SpotinstStatefulError
+
+ENDPOINT = 'kafka.server:type=ReplicaManager,name=UnderReplicatedPartitions'
+
+
+def _free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def test_checks_are_probed_concurrently(spotinst_stub):
+    values = [3, 1, 0]
+
+    def route(handler, body):
+        return 200, {'value': {'Value': values.pop(0) if len(values) > 1 else values[0]}, 'status': 200}
+
+    spotinst_stub.add_route('jolokia/read/' + ENDPOINT, route)
+    port = _free_port()
+    listener = socket.socket()
+
+    def listen_later():
+        time.sleep(0.3)
+        listener.bind(('127.0.0.1', port))
+        listener.listen(5)
+
+    thread = threading.Thread(target=listen_later)
+    thread.start()
+    try:
+        start = time.time()
+        checks = wait_until_ready([PortCheck('127.0.0.1', port, timeout=1),
+                                   JolokiaCheck('127.0.0.1', spotinst_stub.server_address[1], ENDPOINT, '0')],
+                                  timeout=10, min_interval=0.05, max_interval=0.1)
+        elapsed = time.time() - start
+    finally:
+        thread.join()
+        listener.close()
+
+    assert all(check.ready for check in checks)
+    assert checks[0].elapsed >= 0.3
+    assert checks[1].attempts == 3
+    assert checks[1].to_dict()['value'] == 0
+    # Both conditions were waited for at the same time
+    assert elapsed < 1
+
+
+def test_checks_not_ready_before_timeout():
+    port = _free_port()
+
+    checks = wait_until_ready([PortCheck('127.0.0.1', port, timeout=1)], timeout=0.3, min_interval=0.05,
+                              max_interval=0.1)
+
+    assert not checks[0].ready
+    assert checks[0].attempts > 1
+    assert checks[0].msg == "127.0.0.1:{} is not reachable".format(port)
+
+
+def test_wait_for_jolokia_raises_when_not_in_sync(spotinst_stub):
+    spotinst_stub.add_route('jolokia/read/' + ENDPOINT, {'value': {'Value': 3}, 'status': 200})
+    jolokia = {'port': spotinst_stub.server_address[1], 'endpoint': ENDPOINT, 'expect': 0}
+
+    with pytest.raises(SpotinstStatefulError) as e:
+        wait_for_jolokia('127.0.0.1', jolokia, 0.3, min_interval=0.05, max_interval=0.1)
+
+    assert str(e.value) == "127.0.0.1 is still not ready after 0.3s: jolokia {} is 3, expecting 0".format(ENDPOINT)
+    with pytest.raises(ValueError):
+        wait_for_jolokia('127.0.0.1', {'port': 8778}, 0.3)
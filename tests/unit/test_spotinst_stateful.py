@@ -0,0 +1,400 @@
+import os
+import threading
+import time
+
+import pytest
+
+from ansible.module_utils.spotinst_api import SpotinstClient
+from ansible.module_utils.spotinst_cache import FileCache
+from ansible.module_utils.spotinst_readiness import wait_for_jolokia
+from ansible.module_utils.spotinst_stateful import FleetRecycle, StatefulGroup, StatefulRecycle, poll_jobs
+
+from source_loader import load_source
+from spotinst_stub import SpotinstStub, spotinst_response
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+spotinst_aws_stateful = load_source('spotinst_aws_stateful',
+                                    os.path.join(HERE, '..', '..', 'library', 'plugins', 'spotinst_aws_stateful.py'))
+
+
+class FakeGroup(object):
+
+    def __init__(self, esg_id, instances=None):
+        self.esg_id = esg_id
+        self.instances = instances or []
+        self.list_calls = 0
+
+    def list_instances(self):
+        self.list_calls += 1
+        return self.instances
+
+
+class FakeRecycle(StatefulRecycle):
+    """A recycle taking a little time, tracking how many recycles run at once."""
+
+    lock = threading.Lock()
+
+    def __init__(self, group, ssi, counters, fail=False):
+        super(FakeRecycle, self).__init__(group, ssi)
+        self.counters = counters
+        self.fail = fail
+
+    def run(self):
+        with self.lock:
+            self.counters['total'] += 1
+            self.counters[self.group.esg_id] = self.counters.get(self.group.esg_id, 0) + 1
+            self.counters['max_total'] = max(self.counters['max_total'], self.counters['total'])
+            key = 'max_' + self.group.esg_id
+            self.counters[key] = max(self.counters.get(key, 0), self.counters[self.group.esg_id])
+        time.sleep(0.05)
+        with self.lock:
+            self.counters['total'] -= 1
+            self.counters[self.group.esg_id] -= 1
+        self._transition(self.FAILED if self.fail else self.DONE)
+        return self
+
+
+def _recycles(counters, groups, fail=()):
+    return [FakeRecycle(FakeGroup(esg_id), "ssi-{}-{}".format(esg_id, i), counters, fail=(esg_id, i) in fail)
+            for esg_id, count in groups for i in range(count)]
+
+
+def test_fleet_recycle_respects_limits():
+    counters = {'total': 0, 'max_total': 0}
+    recycles = _recycles(counters, [('sig-a', 3), ('sig-b', 3), ('sig-c', 3), ('sig-d', 4)])
+
+    FleetRecycle(recycles, max_concurrency=3, max_in_flight=1, group_max_in_flight={'sig-d': 2}).run()
+
+    assert all(r.state == StatefulRecycle.DONE for r in recycles)
+    assert counters['max_total'] == 3
+    assert counters['max_sig-a'] == 1
+    assert counters['max_sig-d'] <= 2
+
+
+def test_fleet_recycle_skips_rest_of_failed_group():
+    counters = {'total': 0, 'max_total': 0}
+    recycles = _recycles(counters, [('sig-a', 3), ('sig-b', 3)], fail=[('sig-a', 0)])
+
+    FleetRecycle(recycles, max_concurrency=10).run()
+
+    states = dict((r.ssi, r.state) for r in recycles)
+    assert states['ssi-sig-a-0'] == StatefulRecycle.FAILED
+    assert states['ssi-sig-a-1'] == states['ssi-sig-a-2'] == StatefulRecycle.SKIPPED
+    assert all(states['ssi-sig-b-{}'.format(i)] == StatefulRecycle.DONE for i in range(3))
+
+
+def test_poll_jobs_lists_instances_once_per_group():
+    now = time.time()
+    group = FakeGroup('sig-a', [
+        {'id': 'ssi-1', 'state': 'ACTIVE', 'instanceId': 'i-new', 'privateIp': '10.0.0.1'},
+        {'id': 'ssi-2', 'state': 'RECYCLING', 'instanceId': 'i-2'},
+        {'id': 'ssi-3', 'state': 'ACTIVE', 'instanceId': 'i-3'},
+    ])
+    jobs = [
+        {'esg_id': 'sig-a', 'stateful_instance_id': 'ssi-1', 'instance_id': 'i-1', 'requested_at': now},
+        {'esg_id': 'sig-a', 'stateful_instance_id': 'ssi-2', 'instance_id': 'i-2', 'requested_at': now},
+        {'esg_id': 'sig-a', 'stateful_instance_id': 'ssi-3', 'instance_id': 'i-3', 'requested_at': now - 700},
+    ]
+
+    statuses = poll_jobs({'sig-a': group}, jobs, 600)
+
+    assert group.list_calls == 1
+    assert [(s['finished'], s['failed']) for s in statuses] == [(True, False), (False, False), (True, True)]
+    assert statuses[0]['stateful']['privateIp'] == '10.0.0.1'
+    assert statuses[1]['state'] == 'RECYCLING'
+
+
+class FastRecycleGroup(object):
+    """A group whose instance is recycled between two polls, RECYCLING is never seen."""
+
+    def __init__(self, after):
+        self.esg_id = 'sig-a'
+        self.recycled = False
+        self.polls = 0
+        self.after = after
+
+    def get_instance(self, ssi):
+        self.polls += 1
+        if self.recycled:
+            return dict(self.after, id=ssi)
+        return {'id': ssi, 'state': 'ACTIVE', 'instanceId': 'i-1', 'launchedAt': '2019-02-04T10:10:31.000Z',
+                'privateIp': '10.0.0.1'}
+
+    def recycle_instance(self, ssi):
+        self.recycled = True
+
+
+@pytest.mark.parametrize('after', [
+    {'instanceId': 'i-2', 'launchedAt': '2019-02-04T10:10:31.000Z'},
+    {'instanceId': 'i-1', 'launchedAt': '2019-02-04T10:15:02.000Z'},
+])
+def test_recycle_completes_on_a_new_instance_without_seeing_recycling(after):
+    group = FastRecycleGroup(dict(after, state='ACTIVE', privateIp='10.0.0.2'))
+    recycle = StatefulRecycle(group, 'ssi-1', wait_timeout=1, poll_min_interval=0.01, poll_max_interval=0.01)
+
+    recycle.run()
+
+    assert recycle.state == StatefulRecycle.DONE
+    assert recycle.instance['launchedAt'] == after['launchedAt']
+    assert recycle.instance['instanceId'] == after['instanceId']
+
+
+def test_recycle_keeps_waiting_while_the_instance_is_unchanged():
+    group = FastRecycleGroup({'state': 'ACTIVE', 'instanceId': 'i-1', 'launchedAt': '2019-02-04T10:10:31.000Z',
+                              'privateIp': '10.0.0.1'})
+    recycle = StatefulRecycle(group, 'ssi-1', wait_timeout=0.2, poll_min_interval=0.01, poll_max_interval=0.01)
+
+    recycle.run()
+
+    assert recycle.state == StatefulRecycle.FAILED
+    assert 'could not transition from RECYCLING to ACTIVE' in recycle.error
+    assert group.polls > 2
+
+
+def test_group_region_is_cached_across_forks(spotinst_stub, tmpdir):
+    spotinst_stub.add_route('aws/ec2/group/sig-1', spotinst_response([{'id': 'sig-1', 'name': 'esg', 'region': 'eu-west-1'}]))
+    client = SpotinstClient('token', api_url=spotinst_stub.url)
+
+    regions = [StatefulGroup(client, 'act-1', 'sig-1', metadata_cache=FileCache(str(tmpdir), ttl=60)).region
+               for _ in range(3)]
+
+    assert regions == ['eu-west-1'] * 3
+    assert len(spotinst_stub.requests) == 1
+    assert StatefulGroup(client, 'act-1', 'sig-1', region='us-east-1').region == 'us-east-1'
+    assert len(spotinst_stub.requests) == 1
+
+
+def test_concurrent_polls_of_a_group_share_one_request(tmpdir):
+    stub = SpotinstStub(latency=0.2).start()
+    try:
+        stub.add_route('aws/ec2/group/sig-1/statefulInstance', spotinst_response([{'id': 'ssi-1', 'state': 'ACTIVE'}]))
+        results = []
+
+        def poll():
+            # Each poller stands for a fork, with its own client and cache handle
+            client = SpotinstClient('token', api_url=stub.url)
+            group = StatefulGroup(client, 'act-1', 'sig-1', poll_cache=FileCache(str(tmpdir), ttl=5))
+            results.append(group.list_instances())
+
+        threads = [threading.Thread(target=poll) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert len(results) == 8
+        assert all(result == [{'id': 'ssi-1', 'state': 'ACTIVE'}] for result in results)
+        assert len(stub.requests) == 1
+    finally:
+        stub.stop()
+
+
+class PipelineGroup(object):
+    """A group whose instances stay RECYCLING for recycle_time seconds, then are ACTIVE on a new EC2 instance."""
+
+    def __init__(self, esg_id, ssis, recycle_time):
+        self.esg_id = esg_id
+        self.ssis = ssis
+        self.recycle_time = recycle_time
+        self.requested = {}
+        self.events = []
+        self.lock = threading.Lock()
+
+    def get_instance(self, ssi):
+        now = time.time()
+        with self.lock:
+            self.events.append(('get', ssi, now))
+        instance = {'id': ssi, 'state': 'ACTIVE', 'instanceId': 'i-' + ssi, 'privateIp': '10.0.0.1'}
+        requested = self.requested.get(ssi)
+        if requested is not None:
+            if now - requested < self.recycle_time:
+                instance['state'] = 'RECYCLING'
+            else:
+                instance['instanceId'] += '-new'
+        return instance
+
+    def recycle_instance(self, ssi):
+        now = time.time()
+        with self.lock:
+            self.requested[ssi] = now
+            self.events.append(('put', ssi, now))
+
+    def warm_up(self):
+        with self.lock:
+            self.events.append(('warm_up', None, time.time()))
+
+    def first(self, kind, ssi=None):
+        return next(t for k, s, t in self.events if k == kind and s == ssi)
+
+
+def test_fleet_recycle_pipeline_prepares_next_instance():
+    group = PipelineGroup('sig-a', ['ssi-1', 'ssi-2'], recycle_time=0.3)
+    recycles = [StatefulRecycle(group, ssi, poll_min_interval=0.01, poll_max_interval=0.02) for ssi in group.ssis]
+
+    FleetRecycle(recycles, max_in_flight=1, pipeline=True).run()
+
+    assert all(r.state == StatefulRecycle.DONE for r in recycles)
+    put_1, put_2 = group.first('put', 'ssi-1'), group.first('put', 'ssi-2')
+    # ssi-2 was checked ACTIVE and its group warmed up while ssi-1 was still recycling
+    assert group.first('get', 'ssi-2') < put_1 + group.recycle_time
+    assert group.first('warm_up') < put_1 + group.recycle_time
+    assert 'READY' in recycles[1].timings
+    # But only requested once ssi-1 was done
+    assert put_2 >= put_1 + group.recycle_time
+
+
+def test_fleet_recycle_pipeline_waits_for_jolokia_readiness(spotinst_stub):
+    endpoint = 'kafka.server:type=ReplicaManager,name=UnderReplicatedPartitions'
+    under_replicated = [4, 2]
+
+    def route(handler, body):
+        return 200, {'value': {'Value': under_replicated.pop(0) if under_replicated else 0}}
+
+    spotinst_stub.add_route('jolokia/read/' + endpoint, route)
+    group = PipelineGroup('sig-a', ['ssi-1', 'ssi-2'], recycle_time=0.1)
+    jolokia = {'port': spotinst_stub.server_address[1], 'endpoint': endpoint, 'expect': 0}
+
+    def readiness(host):
+        wait_for_jolokia('127.0.0.1', jolokia, 5, min_interval=0.1, max_interval=0.1)
+        group.events.append(('ready', None, time.time()))
+
+    recycles = [StatefulRecycle(group, ssi, poll_min_interval=0.01, poll_max_interval=0.02, readiness=readiness)
+                for ssi in group.ssis]
+
+    FleetRecycle(recycles, max_in_flight=1, pipeline=True).run()
+
+    assert all(r.state == StatefulRecycle.DONE for r in recycles)
+    # ssi-2 was prepared meanwhile, but only requested once ssi-1 partitions were back in sync
+    assert group.first('get', 'ssi-2') < group.first('ready')
+    assert group.first('put', 'ssi-2') >= group.first('ready')
+    assert recycles[0].timings['CHECKING_READINESS'] >= 0.2
+
+
+def test_fleet_recycle_without_pipeline_waits_for_previous_instance():
+    group = PipelineGroup('sig-a', ['ssi-1', 'ssi-2'], recycle_time=0.1)
+    recycles = [StatefulRecycle(group, ssi, poll_min_interval=0.01, poll_max_interval=0.02) for ssi in group.ssis]
+
+    FleetRecycle(recycles, max_in_flight=1).run()
+
+    assert all(r.state == StatefulRecycle.DONE for r in recycles)
+    assert group.first('get', 'ssi-2') >= group.first('put', 'ssi-1') + group.recycle_time
+    assert 'READY' not in recycles[1].timings
+
+
+class ModuleExit(Exception):
+    pass
+
+
+class BatchModule(object):
+    """Just enough of an AnsibleModule to run spotinst_aws_stateful, its result is raised as a ModuleExit."""
+
+    def __init__(self, api_url, **params):
+        self.params = dict(api_token='token', api_url=api_url, api_rate_limit=0, api_max_retries=0, account_id='act-1',
+                           region='us-east-1', esg_id=None, stateful_instance_ids=[], max_in_flight=1, wait=True,
+                           wait_timeout=10, poll_min_interval=0.01, poll_max_interval=0.02, metadata_cache_ttl=0,
+                           poll_cache_ttl=0, metrics_sink=None, watch_address=None)
+        self.params.update(params)
+
+    def exit_json(self, **result):
+        raise ModuleExit(dict(result, failed=False))
+
+    def fail_json(self, **result):
+        raise ModuleExit(dict(result, failed=True))
+
+
+def _stub_batch(stub, groups, recycle_time):
+    """Serve stateful instances staying RECYCLING for recycle_time seconds once requested, recording the PUTs."""
+    puts = []
+
+    def make_list(esg_id):
+        def route(handler, body):
+            items = []
+            for ssi in groups[esg_id]:
+                item = {'id': ssi, 'state': 'ACTIVE', 'instanceId': 'i-' + ssi, 'privateIp': '10.0.0.1'}
+                requested = next((t for e, s, t in puts if s == ssi), None)
+                if requested is not None:
+                    if time.time() - requested < recycle_time:
+                        item['state'] = 'RECYCLING'
+                    else:
+                        item['instanceId'] += '-new'
+                items.append(item)
+            return 200, spotinst_response(items)
+        return route
+
+    def make_recycle(esg_id, ssi):
+        def route(handler, body):
+            puts.append((esg_id, ssi, time.time()))
+            return 200, spotinst_response([])
+        return route
+
+    for esg_id, ssis in groups.items():
+        stub.add_route('aws/ec2/group/{}/statefulInstance'.format(esg_id), make_list(esg_id))
+        for ssi in ssis:
+            stub.add_route('aws/ec2/group/{}/statefulInstance/{}/recycle'.format(esg_id, ssi), make_recycle(esg_id, ssi),
+                           method='PUT')
+    return puts
+
+
+def test_batch_recycles_instances_of_many_groups(spotinst_stub):
+    puts = _stub_batch(spotinst_stub, {'sig-1': ['ssi-1', 'ssi-2', 'ssi-3'], 'sig-2': ['ssi-4']}, recycle_time=0.3)
+    module = BatchModule(spotinst_stub.url, esg_id='sig-1', max_in_flight=2,
+                         stateful_instance_ids=['ssi-1', 'ssi-2', 'ssi-3', 'ssi-1',
+                                                {'esg_id': 'sig-2', 'stateful_instance_id': 'ssi-4', 'region': 'eu-west-1'}])
+
+    with pytest.raises(ModuleExit) as e:
+        spotinst_aws_stateful.recycle_batch(module)
+    result = e.value.args[0]
+
+    assert not result['failed'] and result['changed']
+    assert [(r['esg_id'], r['stateful_instance_id'], r['state']) for r in result['recycled']] == [
+        ('sig-1', 'ssi-1', 'DONE'), ('sig-1', 'ssi-2', 'DONE'), ('sig-1', 'ssi-3', 'DONE'), ('sig-2', 'ssi-4', 'DONE')]
+    assert result['recycled'][0]['stateful']['instanceId'] == 'i-ssi-1-new'
+    assert set(result['recycled'][0]['timings']) == set(['QUEUED', 'WAITING_ACTIVE', 'RECYCLING'])
+    assert 'counters' in result['metrics']
+
+    times = dict((ssi, t) for esg_id, ssi, t in puts)
+    # Two instances of sig-1 at once, the third one once the first two are done, sig-2 in parallel
+    assert len(puts) == 4
+    assert abs(times['ssi-2'] - times['ssi-1']) < 0.25
+    assert times['ssi-3'] >= min(times['ssi-1'], times['ssi-2']) + 0.3
+    assert times['ssi-4'] < times['ssi-3']
+
+
+def test_batch_without_wait_returns_jobs(spotinst_stub):
+    _stub_batch(spotinst_stub, {'sig-1': ['ssi-1', 'ssi-2']}, recycle_time=10)
+    module = BatchModule(spotinst_stub.url, esg_id='sig-1', wait=False, stateful_instance_ids=['ssi-1', 'ssi-2'])
+
+    with pytest.raises(ModuleExit) as e:
+        spotinst_aws_stateful.recycle_batch(module)
+    result = e.value.args[0]
+
+    assert [r['state'] for r in result['recycled']] == ['RECYCLING', 'RECYCLING']
+    assert [(job['stateful_instance_id'], job['instance_id']) for job in result['jobs']] == [('ssi-1', 'i-ssi-1'),
+                                                                                             ('ssi-2', 'i-ssi-2')]
+
+
+@pytest.mark.parametrize('item', ['ssi-1', {'stateful_instance_id': 'ssi-1'}, {'esg_id': 'sig-1'}])
+def test_batch_items_need_an_esg_and_an_instance(item):
+    module = BatchModule('http://127.0.0.1:1', stateful_instance_ids=[item])
+
+    with pytest.raises(ModuleExit) as e:
+        spotinst_aws_stateful.recycle_batch(module)
+
+    assert e.value.args[0]['failed']
+    assert e.value.args[0]['msg'].startswith("Every item of stateful_instance_ids must be")
+
+
+def test_batch_region_applies_to_every_instance_of_its_group():
+    module = BatchModule('http://127.0.0.1:1', esg_id='sig-1', stateful_instance_ids=[
+        'ssi-1', {'stateful_instance_id': 'ssi-2', 'region': 'eu-west-1'}, 'ssi-1',
+        {'esg_id': 'sig-2', 'stateful_instance_id': 'ssi-3'}])
+
+    assert spotinst_aws_stateful._get_batch(module) == [('sig-1', 'eu-west-1', 'ssi-1'), ('sig-1', 'eu-west-1', 'ssi-2'),
+                                                        ('sig-2', None, 'ssi-3')]
+
+    module.params['stateful_instance_ids'].append({'stateful_instance_id': 'ssi-4', 'region': 'us-east-1'})
+    with pytest.raises(ModuleExit) as e:
+        spotinst_aws_stateful._get_batch(module)
+
+    assert e.value.args[0]['msg'] == "Conflicting regions given for sig-1: eu-west-1 and us-east-1"
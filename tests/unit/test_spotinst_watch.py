@@ -0,0 +1,121 @@
+import os
+import time
+
+import pytest
+
+from ansible.module_utils.spotinst_api import SpotinstClient
+from ansible.module_utils.spotinst_stateful import StatefulGroup
+from ansible.module_utils.spotinst_watch import Snapshot, SnapshotClient, serve
+
+from source_loader import load_source
+from spotinst_stub import spotinst_response
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+watch = load_source('spotinst_esg_watch', os.path.join(HERE, '..', '..', 'bin', 'spotinst-esg-watch'))
+
+INVENTORY = {
+    'esgs': [{'id': 'sig-1', 'name': 'kafka', 'region': 'us-east-1', 'instances': ['ssi-1']}],
+    'hosts': {'ssi-1': {'id': 'ssi-1', 'instanceId': 'i-1', 'privateIp': '10.0.0.1', 'state': 'ACTIVE'}},
+}
+ITEMS = [{'id': 'ssi-1', 'instanceId': 'i-1', 'state': 'RECYCLING'}]
+
+
+def test_snapshot_is_served_while_fresh(tmpdir):
+    address = 'unix://{}'.format(os.path.join(str(tmpdir), 'watch.sock'))
+    snapshot = Snapshot('act-1')
+    snapshot.update(INVENTORY, {'sig-1': ITEMS})
+    server = serve(snapshot, address)
+    try:
+        client = SnapshotClient(address, max_age=0.5)
+
+        assert client.get_inventory('act-1') == INVENTORY
+        assert client.list_instances('act-1', 'sig-1') == ITEMS
+        assert client.list_instances('act-1', 'sig-2') is None
+        assert client.get_inventory('act-2') is None
+
+        time.sleep(0.6)
+        assert client.list_instances('act-1', 'sig-1') is None
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_group_polls_the_snapshot_instead_of_spotinst(spotinst_stub, tmpdir):
+    address = 'unix://{}'.format(os.path.join(str(tmpdir), 'watch.sock'))
+    spotinst_stub.add_route('aws/ec2/group/sig-1/statefulInstance', spotinst_response([dict(ITEMS[0], state='ACTIVE')]))
+    snapshot = Snapshot('act-1')
+    snapshot.update(INVENTORY, {'sig-1': ITEMS})
+    server = serve(snapshot, address)
+    group = StatefulGroup(SpotinstClient('token', api_url=spotinst_stub.url), 'act-1', 'sig-1',
+                          snapshot=SnapshotClient(address, max_age=0.5))
+
+    try:
+        for _ in range(10):
+            assert group.get_instance('ssi-1')['state'] == 'RECYCLING'
+        assert spotinst_stub.requests == []
+
+        # Once the snapshot is too old, Spotinst API is polled again
+        time.sleep(0.6)
+        assert group.get_instance('ssi-1')['state'] == 'ACTIVE'
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert group.metrics.get('watch_snapshot_reads', result='hit') == 10
+    assert group.metrics.get('watch_snapshot_reads', result='miss') == 1
+
+
+@pytest.fixture
+def plugin(tmpdir):
+    path = tmpdir.join('demo.spotinst_esg.yml')
+    path.write("plugin: spotinst_esg\nspotinst_account_id: act-1\nspotinst_api_token: token\n"
+               "aws_access_key: key\naws_secret_key: secret\nmax_concurrency: 1\n")
+    return watch.load_plugin(str(path))
+
+
+def test_load_plugin_reads_the_inventory_file(plugin):
+    assert plugin.get_option('spotinst_account_id') == 'act-1'
+    assert plugin.spotinst_api_token == 'token'
+
+
+def test_query_keeps_stateful_instances_as_listed(plugin):
+    groups = [{'id': 'sig-1', 'name': 'kafka', 'region': 'us-east-1', 'updatedAt': '2019-02-04T10:10:31.000Z'},
+              {'id': 'sig-2', 'name': 'zookeeper', 'region': 'us-east-1', 'updatedAt': '2019-02-04T10:10:31.000Z'}]
+    stateful = {'sig-1': [{'id': 'ssi-1', 'instanceId': 'i-1', 'state': 'ACTIVE'}],
+                'sig-2': [{'id': 'ssi-2', 'instanceId': 'i-2', 'state': 'ACTIVE'}]}
+    described = []
+
+    def iter_spotinst(endpoint):
+        path = endpoint.split('?')[0].split('/')
+        if path[-1] == 'statefulInstance':
+            return iter([dict(instance) for instance in stateful[path[3]]])
+        return iter([dict(group) for group in groups])
+
+    def get_instances_by_region(regions, filters):
+        described.extend(filters[0]['Values'])
+        # The recycled instance has no private IP yet
+        return [{'InstanceId': i, 'PrivateIpAddress': '10.0.0.{}'.format(i[-1])} for i in filters[0]['Values']
+                if i != 'i-3']
+
+    plugin.set_option('strict', True)
+    plugin._iter_spotinst = iter_spotinst
+    plugin._get_instances_by_region = get_instances_by_region
+    query = watch.make_query(plugin, 'act-1')
+
+    inventory, instances = query(None)
+    assert sorted(inventory['hosts']) == ['ssi-1', 'ssi-2']
+    assert instances['sig-1'] == [{'id': 'ssi-1', 'instanceId': 'i-1', 'state': 'ACTIVE'}]
+    assert inventory['hosts']['ssi-1']['esg_id'] == 'sig-1'
+
+    # ssi-1 is being recycled and sig-2 was deleted, without any ESG updatedAt change
+    stateful['sig-1'] = [{'id': 'ssi-1', 'instanceId': 'i-3', 'state': 'RECYCLING'}]
+    groups.pop()
+    inventory, instances = query(inventory)
+
+    # Served to the modules polling the recycle even though the inventory can not expose it yet, without failing
+    # the poll in strict mode
+    assert instances['sig-1'] == [{'id': 'ssi-1', 'instanceId': 'i-3', 'state': 'RECYCLING'}]
+    assert inventory['hosts'] == {}
+    assert list(instances) == ['sig-1']
+    assert described == ['i-1', 'i-2', 'i-3']